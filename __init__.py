@@ -7,24 +7,49 @@
 """
 from trytond.pool import Pool
 
-from party import Address
-from carrier import FedexShipmentMethod, Carrier
+from party import Party, ContactMechanism, Address, Country, Subdivision
+from carrier import FedexShipmentMethod, Carrier, CarrierFedexAccount
 from sale import Configuration, Sale
-from stock import ShipmentOut, GenerateFedexLabelMessage, GenerateShippingLabel
+from product import Template, Product
+from rate_cache import FedexRateCache
+from address_validation import FedexAddressValidation
+from tracking import FedexPackageTracking, FedexTrackingEvent
+from close import FedexClose
+from shipping_cost import FedexShippingCost
+from stock import (
+    ShipmentOut, GenerateFedexLabelMessage, GenerateShippingLabel,
+    VoidFedexLabelsStart, VoidFedexLabelsResult, VoidFedexLabels,
+)
 
 
 def register():
     Pool.register(
+        Party,
+        ContactMechanism,
         Address,
+        Country,
+        Subdivision,
         FedexShipmentMethod,
         Carrier,
+        CarrierFedexAccount,
         Configuration,
         Sale,
+        Template,
+        Product,
+        FedexRateCache,
+        FedexAddressValidation,
+        FedexPackageTracking,
+        FedexTrackingEvent,
+        FedexClose,
+        FedexShippingCost,
         ShipmentOut,
         GenerateFedexLabelMessage,
+        VoidFedexLabelsStart,
+        VoidFedexLabelsResult,
         module='shipping_fedex', type_='model'
     )
     Pool.register(
         GenerateShippingLabel,
+        VoidFedexLabels,
         module='shipping_fedex', type_='wizard'
     )
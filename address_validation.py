@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+    address_validation.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+import logging
+from datetime import datetime, timedelta
+from functools import partial
+
+from trytond.model import ModelSQL, fields
+from trytond.transaction import Transaction
+
+import metrics
+from carrier import fedex_fingerprint
+from fedexlib import fedex
+
+__all__ = ['FedexAddressValidation']
+
+logger = logging.getLogger(__name__)
+
+# Number of addresses FedEx validates in a request at most
+VALIDATION_BATCH_SIZE = 100
+
+
+def normalize_fedex_address(address):
+    """
+    Returns the text of an address dictionary (see address_to_fedex_dict)
+    with case, punctuation and spacing removed, so that the same address
+    typed differently is validated once.
+    """
+    parts = list(address['streetlines']) + [
+        address['city'], (address['state_code'] or '')[-2:],
+        address['postal_code'], address['country_code'],
+    ]
+    return '|'.join(
+        ' '.join(re.sub(r'[^0-9A-Z]+', ' ', (part or '').upper()).split())
+        for part in parts
+    )
+
+
+class FedexAddressValidation(ModelSQL):
+    """
+    FedEx Address Validation
+
+    Result of the validation of an address by FedEx, reused until it
+    expires.
+    """
+    __name__ = 'fedex.address.validation'
+
+    key = fields.Char('Key', required=True, select=True, readonly=True)
+    valid = fields.Boolean('Valid', readonly=True)
+    message = fields.Char('Message', readonly=True)
+    expire = fields.DateTime(
+        'Expire', required=True, select=True, readonly=True
+    )
+
+    @classmethod
+    def get_results(cls, keys):
+        """
+        Returns a dictionary mapping the keys validated and not expired yet
+        to their result as (valid, message)
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        now = datetime.utcnow()
+        keys = list(set(keys))
+        results = {}
+        for i in xrange(0, len(keys), cursor.IN_MAX):
+            cursor.execute(*table.select(
+                table.key, table.valid, table.message,
+                where=table.key.in_(keys[i:i + cursor.IN_MAX])
+                & (table.expire > now),
+            ))
+            for key, valid, message in cursor.fetchall():
+                results[key] = (bool(valid), message)
+        return results
+
+    @classmethod
+    def set_results(cls, results, ttl):
+        """
+        Keep the results for ttl seconds.
+
+        :param results: dictionary mapping keys to (valid, message)
+        """
+        expire = datetime.utcnow() + timedelta(seconds=ttl)
+
+        cls.delete(cls.search([('key', 'in', results.keys())]))
+        cls.create([{
+            'key': key,
+            'valid': valid,
+            'message': message,
+            'expire': expire,
+        } for key, (valid, message) in results.iteritems()])
+
+    @staticmethod
+    def get_fedex_validation_request(fedex_credentials, addresses):
+        """
+        Returns the request validating the addresses. It does not use the
+        ORM.
+
+        :param addresses: list of address dictionaries, identified in the
+            reply by their index
+        """
+        request = fedex.AddressValidationService(fedex_credentials)
+        request.AddressValidationOptions.VerifyAddresses = True
+        request.AddressValidationOptions.MaximumNumberOfMatches = 1
+
+        for index, address in enumerate(addresses):
+            item = request.get_element_from_type('AddressToValidate')
+            item.AddressId = str(index)
+            item.Address.StreetLines = address['streetlines']
+            item.Address.City = address['city']
+            item.Address.StateOrProvinceCode = \
+                (address['state_code'] or '')[-2:] or None
+            item.Address.PostalCode = address['postal_code']
+            item.Address.CountryCode = address['country_code']
+            request.AddressToValidate.append(item)
+        return request
+
+    @staticmethod
+    def parse_fedex_validation_reply(response):
+        """
+        Returns a dictionary mapping the index of the addresses of the
+        request to their result as (valid, message). An address is invalid
+        when FedEx proposes no address for it or cannot confirm it can be
+        delivered to.
+        """
+        results = {}
+        for result in getattr(response, 'AddressResults', []):
+            details = getattr(result, 'ProposedAddressDetails', None)
+            if not details:
+                results[int(result.AddressId)] = (False, 'NOT_FOUND')
+                continue
+            detail = details[0]
+            changes = ', '.join(
+                str(change) for change in getattr(detail, 'Changes', [])
+            )
+            results[int(result.AddressId)] = (
+                getattr(detail, 'DeliveryPointValidation', None)
+                != 'UNCONFIRMED',
+                changes or None,
+            )
+        return results
+
+    @classmethod
+    def validate_fedex_addresses(cls, carrier, addresses):
+        """
+        Validates the addresses with FedEx, using the results of earlier
+        validations until they expire (see fedex_address_validation_ttl on
+        the carrier). The addresses not validated yet are sent in batches
+        of VALIDATION_BATCH_SIZE, the batches being sent concurrently.
+
+        :param addresses: list of address dictionaries (see
+            address_to_fedex_dict)
+        :return: list of (valid, message) in the order of the addresses.
+            Addresses FedEx could not be asked about are taken as valid, so
+            that labels are not held by the validation.
+        """
+        keys = [normalize_fedex_address(address) for address in addresses]
+        results = cls.get_results(keys)
+        metrics.increment('address_validation.hit', len(
+            [key for key in keys if key in results]
+        ))
+
+        missing = {}
+        for key, address in zip(keys, addresses):
+            if key not in results:
+                missing.setdefault(key, address)
+        if missing:
+            metrics.increment('address_validation.miss', len(missing))
+            missing = missing.items()
+            batches = [
+                missing[i:i + VALIDATION_BATCH_SIZE]
+                for i in xrange(0, len(missing), VALIDATION_BATCH_SIZE)
+            ]
+            transport = carrier.get_fedex_transport()
+
+            def validate(batch):
+                return cls.parse_fedex_validation_reply(transport.send(
+                    partial(
+                        cls.get_fedex_validation_request,
+                        addresses=[address for _, address in batch]
+                    ), 'validate-%s' % fedex_fingerprint(
+                        [key for key, _ in batch]
+                    )[:8]
+                ))
+
+            validated = {}
+            for batch, (result, exc_info) in zip(
+                    batches, transport.map(validate, batches)):
+                if exc_info is not None:
+                    metrics.increment('address_validation.errors')
+                    logger.warning(
+                        'FedEx address validation failed for %s addresses',
+                        len(batch), exc_info=exc_info
+                    )
+                    continue
+                for index, (key, _) in enumerate(batch):
+                    if index in result:
+                        validated[key] = result[index]
+            if validated:
+                cls.set_results(
+                    validated, carrier.fedex_address_validation_ttl
+                )
+            results.update(validated)
+
+        return [results.get(key, (True, None)) for key in keys]
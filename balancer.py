@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+    balancer.py
+
+    Distributes FedEx requests across the accounts of a carrier, keeping
+    track of the requests in flight and of the accounts which are failing.
+    The state is kept per process.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import random
+from threading import Lock
+
+__all__ = ['AccountBalancer', 'balancer']
+
+
+class AccountBalancer(object):
+    """
+    Keeps the health and the number of requests in flight of FedEx accounts
+    identified by a key (account and meter number).
+
+    An account failing `max_failures` times in a row is left out for
+    `cooldown` seconds, doubled on each new failure up to `max_cooldown`.
+    """
+
+    def __init__(self, max_failures=3, cooldown=30, max_cooldown=600):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = Lock()
+        self._failures = {}
+        self._disabled_until = {}
+        self._in_flight = {}
+
+    def health(self, key):
+        """
+        Returns the health of the account: healthy, failing (errors were
+        seen but it is still used) or disabled (left out for now)
+        """
+        with self._lock:
+            if self._disabled_until.get(key, 0) > time.time():
+                return 'disabled'
+            if self._failures.get(key):
+                return 'failing'
+            return 'healthy'
+
+    def in_flight(self, key):
+        with self._lock:
+            return self._in_flight.get(key, 0)
+
+    def order(self, accounts):
+        """
+        Returns the accounts in the order they should be tried: the ones
+        which are not disabled in a random order respecting their weight,
+        followed by the disabled ones as a last resort.
+
+        :param accounts: list of (key, weight, account)
+        :return: list of (key, account)
+        """
+        available, disabled = [], []
+        for key, weight, account in accounts:
+            if self.health(key) == 'disabled':
+                disabled.append((key, account))
+            else:
+                # Weighted random order: sort on u ** (1 / weight)
+                available.append(
+                    (random.random() ** (1.0 / max(weight, 1)), key, account)
+                )
+        available.sort(reverse=True)
+        return [(key, account) for _, key, account in available] + disabled
+
+    def acquire(self, key, max_concurrency=0):
+        """
+        Reserves a slot for a request with the account.
+
+        :return: False if the account already has max_concurrency requests
+            in flight
+        """
+        with self._lock:
+            in_flight = self._in_flight.get(key, 0)
+            if max_concurrency and in_flight >= max_concurrency:
+                return False
+            self._in_flight[key] = in_flight + 1
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._in_flight[key] = max(self._in_flight.get(key, 0) - 1, 0)
+
+    def record_success(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+            self._disabled_until.pop(key, None)
+
+    def record_failure(self, key):
+        with self._lock:
+            failures = self._failures.get(key, 0) + 1
+            self._failures[key] = failures
+            if failures >= self.max_failures:
+                cooldown = min(
+                    self.cooldown * 2 ** (failures - self.max_failures),
+                    self.max_cooldown
+                )
+                self._disabled_until[key] = time.time() + cooldown
+
+    def reset(self):
+        with self._lock:
+            self._failures.clear()
+            self._disabled_until.clear()
+            self._in_flight.clear()
+
+
+balancer = AccountBalancer()
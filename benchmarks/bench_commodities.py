@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/bench_commodities.py
+
+    Compares the size of the commodities of the customs clearance detail
+    and the time to build and write them for a large order, declaring one
+    commodity per line as before and aggregating the lines with
+    CommodityBuilder.
+
+    Usage: python benchmarks/bench_commodities.py [lines] [products]
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+import random
+from decimal import Decimal
+from xml.etree import cElementTree as ElementTree
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+from commodities import CommodityBuilder  # noqa
+
+NS = 'http://fedex.com/ws/ship/v15'
+REPEAT = 20
+
+
+class Element(object):
+    """
+    Stands for the objects the SOAP client creates
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = Element()
+        setattr(self, name, value)
+        return value
+
+
+class Request(object):
+
+    def get_element_from_type(self, type_name):
+        return Element()
+
+
+def make_lines(count, products):
+    """
+    Returns the lines of an order as (product id, quantity, unit price,
+    weight) with `products` distinct products
+    """
+    random.seed(count)
+    prices = dict(
+        (product, Decimal(random.randint(100, 100000)) / 100)
+        for product in xrange(products)
+    )
+    lines = []
+    for _ in xrange(count):
+        product = random.randrange(products)
+        quantity = random.randint(1, 50)
+        lines.append((product, quantity, prices[product], quantity * 0.35))
+    return lines
+
+
+def build_per_line(request, lines):
+    commodities = []
+    for product, quantity, unit_price, weight in lines:
+        commodity = request.get_element_from_type('Commodity')
+        commodity.NumberOfPieces = len(lines)
+        commodity.Name = 'Product %s' % product
+        commodity.Description = 'Description of product %s' % product
+        commodity.HarmonizedCode = '8471.30.%04d' % product
+        commodity.CountryOfManufacture = 'US'
+        commodity.Weight.Units = 'LB'
+        commodity.Weight.Value = weight
+        commodity.Quantity = quantity
+        commodity.QuantityUnits = 'EA'
+        commodity.UnitPrice.Amount = int(unit_price)
+        commodity.UnitPrice.Currency = 'USD'
+        commodity.CustomsValue.Currency = 'USD'
+        commodity.CustomsValue.Amount = int(quantity * unit_price)
+        commodities.append(commodity)
+    return commodities
+
+
+def build_aggregated(request, lines):
+    builder = CommodityBuilder()
+    for product, quantity, unit_price, weight in lines:
+        builder.add(
+            product, 'Product %s' % product,
+            'Description of product %s' % product,
+            '8471.30.%04d' % product, 'US', quantity, unit_price, weight,
+        )
+    return builder.get_fedex_commodities(request, 'USD')
+
+
+def to_xml(parent, name, value):
+    node = ElementTree.SubElement(parent, '{%s}%s' % (NS, name))
+    if isinstance(value, Element):
+        for child_name, child in sorted(vars(value).items()):
+            to_xml(node, child_name, child)
+    else:
+        node.text = unicode(value)
+
+
+def request_size(commodities):
+    """
+    Returns the size of the commodities written as in the SOAP message
+    """
+    root = ElementTree.Element('{%s}CustomsClearanceDetail' % NS)
+    for commodity in commodities:
+        to_xml(root, 'Commodities', commodity)
+    return len(ElementTree.tostring(root))
+
+
+def main(lines=500, products=40):
+    order = make_lines(lines, products)
+    request = Request()
+    print 'order: %s lines, %s products' % (lines, products)
+    for name, build in (
+            ('per line', build_per_line), ('aggregated', build_aggregated)):
+        start = time.time()
+        for _ in xrange(REPEAT):
+            commodities = build(request, order)
+        elapsed = (time.time() - start) / REPEAT
+        start = time.time()
+        for _ in xrange(REPEAT):
+            size = request_size(commodities)
+        written = (time.time() - start) / REPEAT
+        print '%s: %s commodities, %.1f KB, built in %.2f ms, ' \
+            'written in %.2f ms' % (
+                name, len(commodities), size / 1024.0, elapsed * 1000,
+                written * 1000
+            )
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/bench_import.py
+
+    Measures the time taken to import and register the module in a fresh
+    interpreter, as a worker does when it starts, and checks that the fedex
+    library and its SOAP stack are not loaded by it.
+
+    Usage: python benchmarks/bench_import.py [runs]
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import subprocess
+
+SCRIPT = '''
+import sys
+import time
+import trytond.pool
+start = time.time()
+import trytond.modules.shipping_fedex as module
+module.register()
+elapsed = time.time() - start
+soap_loaded = 'fedex' in sys.modules or 'suds' in sys.modules
+start = time.time()
+import fedex
+fedex_elapsed = time.time() - start
+print elapsed, fedex_elapsed, int(soap_loaded)
+'''
+
+
+def main(runs=5):
+    results = []
+    for _ in xrange(runs):
+        output = subprocess.check_output([
+            sys.executable, '-c', SCRIPT
+        ])
+        register, fedex, soap_loaded = output.split()
+        results.append((float(register), float(fedex), int(soap_loaded)))
+
+    register = min(result[0] for result in results) * 1000
+    fedex = min(result[1] for result in results) * 1000
+    print 'import and register shipping_fedex: %.1f ms' % register
+    print 'fedex library loaded on first use:  %.1f ms' % fedex
+    if any(result[2] for result in results):
+        print 'WARNING: the SOAP stack is loaded when registering'
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
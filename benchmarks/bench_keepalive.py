@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/bench_keepalive.py
+
+    Compares the latency of SOAP calls opening a new connection each time,
+    as the default suds transport does, with the keep-alive transport,
+    against a local TLS stand-in of FedEx.
+
+    Usage: python benchmarks/bench_keepalive.py [calls]
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import ssl
+import gzip
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from StringIO import StringIO
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+from suds.transport import Request  # noqa
+
+import keepalive  # noqa
+
+# About the size of the reply of a label request, mostly base64
+REPLY = (
+    '<?xml version="1.0" encoding="UTF-8"?><soapenv:Envelope '
+    'xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soapenv:Body><Image>%s</Image></soapenv:Body></soapenv:Envelope>'
+) % ('iVBORw0KGgoAAAANSUhEUgAA' * 2000)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send the reply at once, not header by header
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = REPLY
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+                gzip_file.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing their connection are expected
+        pass
+
+
+def start_standin(directory):
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-keyout', keyfile, '-out', certfile, '-days', '1',
+        '-subj', '/CN=localhost',
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    server = StandinServer(('localhost', 0), StandinHandler)
+    server.socket = ssl.wrap_socket(
+        server.socket, certfile=certfile, keyfile=keyfile, server_side=True
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run(transport, url, calls):
+    message = '<soapenv:Envelope>%s</soapenv:Envelope>' % ('x' * 2000)
+    start = time.time()
+    for _ in xrange(calls):
+        request = Request(url, message)
+        request.headers = {'Content-Type': 'text/xml; charset=utf-8'}
+        transport.send(request)
+    return (time.time() - start) / calls * 1000
+
+
+def main(calls=200):
+    directory = tempfile.mkdtemp()
+    try:
+        server = start_standin(directory)
+        host, port = server.server_address
+        url = 'https://localhost:%s/web-services' % port
+        context = ssl._create_unverified_context()
+        transport = keepalive.KeepAliveTransport(context=context)
+
+        # A pool keeping no connection opens one per call
+        keepalive._pools[('https', 'localhost', port)] = \
+            keepalive.ConnectionPool(
+                'https', 'localhost', port, size=0, context=context
+            )
+        new_connection = run(transport, url, calls)
+
+        keepalive._pools.clear()
+        pooled = run(transport, url, calls)
+
+        print 'calls: %s, reply: %s bytes' % (calls, len(REPLY))
+        print 'new connection per call: %.2f ms/call' % new_connection
+        print 'keep-alive connection:   %.2f ms/call' % pooled
+        print 'pool stats: %s' % keepalive.get_pool_stats()
+        server.shutdown()
+        for pool in keepalive._pools.values():
+            pool.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/bench_leanparse.py
+
+    Compares the peak memory and time of reading a label reply with a
+    full parse of the document, as the SOAP client does, and with the lean
+    parser streaming the images to files. Each mode runs in its own
+    process, so that the peak memory of one does not hide the other.
+
+    Usage: python benchmarks/bench_leanparse.py [parts] [image size in KB]
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+import base64
+import shutil
+import resource
+import tempfile
+import subprocess
+from xml.etree import cElementTree as ElementTree
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+import leanparse  # noqa
+
+NS = 'http://fedex.com/ws/ship/v13'
+
+
+def write_reply(path, parts, size):
+    """
+    Writes a ProcessShipmentReply with a label of `parts` images of `size`
+    bytes each
+    """
+    image = base64.b64encode(os.urandom(size))
+    with open(path, 'wb') as reply:
+        reply.write(
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<soapenv:Envelope xmlns:soapenv='
+            '"http://schemas.xmlsoap.org/soap/envelope/"><soapenv:Body>'
+            '<ProcessShipmentReply xmlns="%s">'
+            '<HighestSeverity>SUCCESS</HighestSeverity>'
+            '<CompletedShipmentDetail><ShipmentRating><ShipmentRateDetails>'
+            '<TotalNetCharge><Currency>USD</Currency><Amount>25.17</Amount>'
+            '</TotalNetCharge></ShipmentRateDetails></ShipmentRating>'
+            '<CompletedPackageDetails><TrackingIds>'
+            '<TrackingNumber>794000000001</TrackingNumber></TrackingIds>'
+            '<Label><Parts>' % NS
+        )
+        for index in xrange(parts):
+            reply.write(
+                '<DocumentPartSequenceNumber>%s'
+                '</DocumentPartSequenceNumber><Image>' % (index + 1)
+            )
+            reply.write(image)
+            reply.write('</Image>')
+        reply.write(
+            '</Parts></Label></CompletedPackageDetails>'
+            '</CompletedShipmentDetail></ProcessShipmentReply>'
+            '</soapenv:Body></soapenv:Envelope>'
+        )
+
+
+def read_full(path):
+    with open(path, 'rb') as reply:
+        root = ElementTree.fromstring(reply.read())
+    return [
+        base64.b64decode(element.text)
+        for element in root.iter('{%s}Image' % NS)
+    ]
+
+
+def read_lean(path, directory):
+    with open(path, 'rb') as reply:
+        _, lean_reply = leanparse.parse(reply, directory)
+    # Read back one image at a time, as the labels are saved
+    for index in xrange(len(lean_reply.images)):
+        lean_reply.read_image(index)
+
+
+def measure(mode, path, directory):
+    start = time.time()
+    if mode == 'full':
+        read_full(path)
+    else:
+        read_lean(path, directory)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    print '%s %s' % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, elapsed
+    )
+
+
+def main(parts=4, size=2048):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'reply.xml')
+        write_reply(path, parts, size * 1024)
+        print 'reply: %s parts, %.1f MB' % (
+            parts, os.path.getsize(path) / 1024.0 / 1024
+        )
+        for mode in ('full', 'lean'):
+            output = subprocess.check_output([
+                sys.executable, __file__, '--measure', mode, path, directory
+            ])
+            peak, elapsed = output.split()
+            print '%s parse: peak %.1f MB, %.3f s' % (
+                mode, int(peak) / 1024.0, float(elapsed)
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        measure(*sys.argv[2:])
+    else:
+        main(*map(int, sys.argv[1:]))
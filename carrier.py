@@ -5,22 +5,90 @@
     :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import hashlib
+import math
 from decimal import Decimal
+from functools import partial
 from collections import namedtuple
 
+from sql import Column
+
+from trytond import backend
 from trytond.pool import PoolMeta, Pool
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
+from trytond.rpc import RPC
+from trytond.config import config
+
+import metrics
+from fedexlib import fedex
+from balancer import balancer
+from ratelimit import TokenBucket
+from transport import FedexTransport, FedexThrottled, FedexFuture
+from party import set_fedex_address_from_dict
 
 
 REQUIRED_IF_FEDEX = {
     'required': Eval('carrier_cost_method') == 'fedex',
 }
 
-__all__ = ['Carrier', 'FedexShipmentMethod']
+__all__ = ['Carrier', 'FedexShipmentMethod', 'CarrierFedexAccount']
 __metaclass__ = PoolMeta
 
+FedexSettings = namedtuple('FedexSettings', [
+    'Key',
+    'Password',
+    'AccountNumber',
+    'MeterNumber',
+    'IntegratorId',
+    'ProductId',
+    'ProductVersion'
+])
+
+# Codes of the notifications of FedEx caused by the account a request was
+# sent with (1000: Authentication Failed): the request is sent again with
+# another account. Other codes can be added with account_error_codes in the
+# fedex section of the configuration.
+ACCOUNT_ERROR_CODES = ('1000',)
+
+
+def fedex_fingerprint(values):
+    """
+    Returns a stable digest of the values which decide a FedEx rate, so
+    that two rate requests built from the same inputs can be recognised
+    without sending them.
+
+    :param values: tuple of plain python values (no records)
+    """
+    return hashlib.sha1(repr(values)).hexdigest()
+
+
+def format_fedex_problems(records, problems):
+    """
+    Returns the problems found by the get_fedex_problems methods as a text
+    giving the problems of each record on a line
+
+    :param problems: dictionary mapping record ids to lists of messages
+    """
+    return '\n'.join(
+        '%s: %s' % (record.rec_name, ' '.join(problems[record.id]))
+        for record in records if record.id in problems
+    )
+
+
+def clear_fedex_cache(model_name, ids):
+    """
+    Drops what the transaction keeps of the records, as writing them with
+    the ORM does, once they were updated with SQL
+    """
+    transaction = Transaction()
+    transaction.counter += 1
+    for cache in transaction.cursor.cache.itervalues():
+        if model_name in cache:
+            for id_ in ids:
+                cache[model_name].pop(id_, None)
+
 
 class FedexShipmentMethod(ModelSQL, ModelView):
     "FedEx Shipment methods"
@@ -35,6 +103,67 @@ class FedexShipmentMethod(ModelSQL, ModelView):
     ], 'Type', required=True, select=True)
 
 
+class CarrierFedexAccount(ModelSQL, ModelView):
+    "FedEx Account"
+    __name__ = 'carrier.fedex.account'
+
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, select=True, ondelete='CASCADE'
+    )
+    active = fields.Boolean('Active', select=True)
+    key = fields.Char('Key', required=True)
+    password = fields.Char('Password', required=True)
+    account_number = fields.Char('Account Number', required=True)
+    meter_number = fields.Char('Meter Number', required=True)
+    weight = fields.Integer(
+        'Weight', required=True, help='Share of the requests sent with this '
+        'account, relative to the other accounts of the carrier.'
+    )
+    max_concurrency = fields.Integer(
+        'Max Concurrent Requests', help='Number of requests which can be '
+        'in flight at once with this account in a process. 0 for no limit.'
+    )
+    health = fields.Function(
+        fields.Selection([
+            ('healthy', 'Healthy'),
+            ('failing', 'Failing'),
+            ('disabled', 'Disabled'),
+        ], 'Health'), 'get_health'
+    )
+
+    @staticmethod
+    def default_active():
+        return True
+
+    @staticmethod
+    def default_weight():
+        return 1
+
+    @staticmethod
+    def default_max_concurrency():
+        return 0
+
+    def get_health(self, name):
+        return balancer.health(
+            '%s-%s' % (self.account_number, self.meter_number)
+        )
+
+    def get_fedex_credentials(self):
+        """
+        Returns the credentials of the account, the application details are
+        the ones of the carrier.
+        """
+        return FedexSettings(
+            self.key,
+            self.password,
+            self.account_number,
+            self.meter_number,
+            self.carrier.fedex_integrator_id,
+            self.carrier.fedex_product_id,
+            self.carrier.fedex_product_version,
+        )
+
+
 class Carrier:
     "Carrier"
     __name__ = 'carrier'
@@ -50,6 +179,83 @@ class Carrier:
     fedex_product_version = fields.Char(
         'Product Version', states=REQUIRED_IF_FEDEX
     )
+    fedex_weight = fields.Integer(
+        'Weight', help='Share of the requests sent with the account above, '
+        'relative to the additional accounts.'
+    )
+    fedex_max_concurrency = fields.Integer(
+        'Max Concurrent Requests', help='Number of requests which can be '
+        'in flight at once with the account above in a process. 0 for no '
+        'limit.'
+    )
+    fedex_accounts = fields.One2Many(
+        'carrier.fedex.account', 'carrier', 'Additional FedEx Accounts',
+        help='Requests are distributed across the account above and these '
+        'accounts, and sent with another account when one fails.'
+    )
+    fedex_rate_cache_ttl = fields.Integer(
+        'Rate Cache TTL', help='Number of seconds a rate returned by FedEx '
+        'is reused for the same lane and weight. 0 disables the cache.'
+    )
+    fedex_max_packages = fields.Integer(
+        'Max Packages per Shipment', help='Shipments with more packages are '
+        'sent to FedEx as several multiple-package shipments. 0 for no '
+        'limit.'
+    )
+    fedex_address_validation_ttl = fields.Integer(
+        'Address Validation TTL', help='Number of seconds the validation '
+        'of a delivery address by FedEx is reused. Addresses are validated '
+        'before labels are generated unless it is 0.'
+    )
+    fedex_rate_limit = fields.Float(
+        'Requests per Second', help='Sustained number of requests per '
+        'second sent to FedEx for an account. 0 disables the limit.'
+    )
+    fedex_rate_burst = fields.Integer(
+        'Request Burst', help='Number of requests which can be sent at once '
+        'before requests are queued.'
+    )
+    fedex_rate_max_wait = fields.Float(
+        'Max Queue Time', help='Number of seconds a request waits in the '
+        'queue before it fails.'
+    )
+    fedex_rate_utilization = fields.Function(
+        fields.Float('Rate Limit Utilization', digits=(16, 2)),
+        'get_fedex_rate_utilization'
+    )
+
+    @staticmethod
+    def default_fedex_weight():
+        return 1
+
+    @staticmethod
+    def default_fedex_max_concurrency():
+        return 0
+
+    @staticmethod
+    def default_fedex_rate_cache_ttl():
+        return 3600
+
+    @staticmethod
+    def default_fedex_max_packages():
+        # The most packages FedEx takes in a multiple-package shipment
+        return 200
+
+    @staticmethod
+    def default_fedex_address_validation_ttl():
+        return 0
+
+    @staticmethod
+    def default_fedex_rate_limit():
+        return 5.0
+
+    @staticmethod
+    def default_fedex_rate_burst():
+        return 10
+
+    @staticmethod
+    def default_fedex_rate_max_wait():
+        return 10.0
 
     @classmethod
     def __setup__(cls):
@@ -60,13 +266,73 @@ class Carrier:
 
         cls._error_messages.update({
             'fedex_settings_missing': 'FedEx settings are incomplete',
+            'warehouse_address_required': 'Warehouse address is required.',
+            'fedex_rates_error':
+                "Error while getting rates from Fedex: \n\n%s",
+            'fedex_rate_limited': 'Too many requests are being sent to '
+                'FedEx for account "%s", please try again later.',
+            'fedex_account_unknown':
+                'FedEx account "%s" is not an account of this carrier.',
+        })
+        cls.__rpc__.update({
+            'get_fedex_metrics': RPC(),
+            'get_fedex_connection_stats': RPC(),
+            'get_fedex_rate_estimates': RPC(instantiate=0),
         })
 
-    def get_fedex_credentials(self):
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+
+        table = TableHandler(cursor, cls, module_name)
+        # The carriers existing before the rate cache and the rate limit
+        # keep rating as they did until they are enabled
+        disabled = [
+            column for column in ('fedex_rate_cache_ttl', 'fedex_rate_limit')
+            if not table.column_exist(column)
+        ]
+
+        super(Carrier, cls).__register__(module_name)
+
+        if disabled:
+            cursor.execute(*sql_table.update(
+                [Column(sql_table, column) for column in disabled],
+                [0] * len(disabled)
+            ))
+
+    @classmethod
+    def get_fedex_metrics(cls):
         """
-        Returns the fedex account credentials in tuple
-        :return: (key, account_number, password, meter_number, integrator_id,
-            product_id, product_version)
+        Returns the counters kept by this process for the FedEx integration,
+        for example how many rate requests were sent versus skipped because
+        the rated inputs did not change.
+        """
+        return metrics.snapshot()
+
+    @classmethod
+    def get_fedex_connection_stats(cls):
+        """
+        Returns the statistics of the pools of connections to FedEx kept by
+        this process, by endpoint.
+        """
+        return fedex.keepalive.get_pool_stats()
+
+    @staticmethod
+    def get_fedex_account_key(credentials):
+        """
+        Returns the key identifying the account of the credentials in the
+        rate limiter and the balancer
+        """
+        return '%s-%s' % (credentials.AccountNumber, credentials.MeterNumber)
+
+    def get_fedex_problems(self):
+        """
+        Returns the problems of the carrier which would make any FedEx
+        request fail, without sending anything.
+
+        :return: list of messages
         """
         if not all([
             self.fedex_key, self.fedex_account_number,
@@ -74,25 +340,185 @@ class Carrier:
             self.fedex_integrator_id, self.fedex_product_id,
             self.fedex_product_version
         ]):
+            return [self.raise_user_error(
+                'fedex_settings_missing', raise_exception=False
+            )]
+        return []
+
+    def get_fedex_accounts(self):
+        """
+        Returns the FedEx accounts of the carrier, the account set on the
+        carrier first, followed by the active additional accounts.
+
+        :return: list of (weight, max_concurrency, credentials)
+        """
+        if self.get_fedex_problems():
             self.raise_user_error('fedex_settings_missing')
 
-        FedexSettings = namedtuple('FedexSettings', [
-            'Key',
-            'Password',
-            'AccountNumber',
-            'MeterNumber',
-            'IntegratorId',
-            'ProductId',
-            'ProductVersion'
+        accounts = [(
+            self.fedex_weight or 1, self.fedex_max_concurrency or 0,
+            FedexSettings(
+                self.fedex_key,
+                self.fedex_password,
+                self.fedex_account_number,
+                self.fedex_meter_number,
+                self.fedex_integrator_id,
+                self.fedex_product_id,
+                self.fedex_product_version,
+            )
+        )]
+        for account in self.fedex_accounts:
+            if not account.active:
+                continue
+            accounts.append((
+                account.weight, account.max_concurrency or 0,
+                account.get_fedex_credentials()
+            ))
+        return accounts
+
+    def get_fedex_credentials(self, account_number=None):
+        """
+        Returns the credentials of the FedEx account to use for the next
+        request, picked among the healthy accounts of the carrier in
+        proportion to their weight.
+
+        :param account_number: Returns the credentials of this account
+            instead, for requests about a shipment made with it.
+        :return: (key, account_number, password, meter_number, integrator_id,
+            product_id, product_version)
+        """
+        accounts = self.get_fedex_accounts()
+
+        if account_number is not None:
+            for _, _, credentials in accounts:
+                if credentials.AccountNumber == account_number:
+                    return credentials
+            self.raise_user_error(
+                'fedex_account_unknown', error_args=(account_number, )
+            )
+
+        ordered = balancer.order([
+            (self.get_fedex_account_key(credentials), weight, credentials)
+            for weight, _, credentials in accounts
         ])
-        return FedexSettings(
-            self.fedex_key,
-            self.fedex_password,
-            self.fedex_account_number,
-            self.fedex_meter_number,
-            self.fedex_integrator_id,
-            self.fedex_product_id,
-            self.fedex_product_version,
+        _, credentials = ordered[0]
+        return credentials
+
+    def get_fedex_rate_utilization(self, name):
+        """
+        Returns the share of the request rate in use for the busiest FedEx
+        account of the carrier
+        """
+        # A carrier being configured has no account to report on yet
+        if self.carrier_cost_method != 'fedex' or self.get_fedex_problems():
+            return None
+        utilization = 0.0
+        for _, _, credentials in self.get_fedex_accounts():
+            bucket = self.get_fedex_rate_limiter(credentials)
+            if bucket is not None:
+                utilization = max(utilization, bucket.utilization())
+        return utilization
+
+    def get_fedex_rate_limiter(self, credentials):
+        """
+        Returns the token bucket shared by all the processes sending
+        requests for the account, or None if requests are not limited.
+        """
+        if not self.fedex_rate_limit:
+            return None
+        return TokenBucket(
+            self.get_fedex_account_key(credentials),
+            self.fedex_rate_limit, self.fedex_rate_burst or 1,
+        )
+
+    @staticmethod
+    def is_fedex_account_error(codes):
+        """
+        Returns True if the error returned by FedEx is caused by the account
+        the request was sent with rather than by the request itself
+
+        :param codes: codes of the error notifications of the reply
+        """
+        account_codes = set(ACCOUNT_ERROR_CODES)
+        account_codes.update(
+            code.strip() for code in
+            (config.get('fedex', 'account_error_codes') or '').split(',')
+            if code.strip()
+        )
+        return bool(account_codes.intersection(codes))
+
+    def get_fedex_transport(self):
+        """
+        Returns a transport sending requests with the accounts of the
+        carrier. It can be used from threads without a transaction.
+        """
+        return FedexTransport(
+            [
+                (self.get_fedex_account_key(credentials), weight,
+                    max_concurrency, credentials,
+                    self.get_fedex_rate_limiter(credentials))
+                for weight, max_concurrency, credentials
+                in self.get_fedex_accounts()
+            ],
+            max_wait=self.fedex_rate_max_wait,
+            is_account_error=self.is_fedex_account_error,
+        )
+
+    def send_fedex_request(
+        self, build_request, transaction_id=None, credentials=None
+    ):
+        """
+        Builds the request with the credentials of one of the accounts of
+        the carrier and sends it to FedEx.
+
+        Accounts are tried in an order given by their weight and health,
+        skipping the ones with max_concurrency requests in flight or whose
+        rate limit is reached. When the request fails because of the
+        account (see is_fedex_account_error) or of the network it is sent
+        again with the next account. If no account can take the request it
+        waits for fedex_rate_max_wait seconds at most.
+
+        :param build_request: function returning the request to send when
+            called with the credentials of the account to use
+        :param credentials: send the request with these credentials only,
+            for example for the packages of a shipment started with them
+        :return: the response of FedEx
+        """
+        try:
+            return self.get_fedex_transport().send(
+                build_request, transaction_id, credentials
+            )
+        except FedexThrottled, exc:
+            self.check_fedex_throttled(exc)
+
+    def check_fedex_throttled(self, exc):
+        """
+        Raises a user error if no account could take the request
+        """
+        if isinstance(exc, FedexThrottled):
+            self.raise_user_error('fedex_rate_limited', error_args=(
+                '%s' % exc,
+            ))
+
+    def async_send_fedex_request(
+        self, build_request, transaction_id=None, credentials=None,
+        callback=None, errback=None
+    ):
+        """
+        Sends the request in the background (see send_fedex_request) and
+        returns a FedexFuture for its response. build_request is called in
+        another thread and must not use the ORM.
+
+        :param callback: function called with the response when the result
+            of the future is asked for, its return value is the result
+        :param errback: function called with the exception raised by the
+            request, eg: to raise a user error instead
+        """
+        errbacks = [self.check_fedex_throttled]
+        if errback is not None:
+            errbacks.append(errback)
+        return self.get_fedex_transport().submit(
+            build_request, transaction_id, credentials, callback, errbacks
         )
 
     def get_sale_price(self):
@@ -123,3 +549,224 @@ class Carrier:
             return Shipment(shipment).get_fedex_shipping_cost()
 
         return Decimal('0'), company.currency.id
+
+    def get_fedex_rate_cache_key(
+        self, shipper, recipient, weight, currency_code, drop_off_type,
+        packaging_type, service_type=None
+    ):
+        """
+        Returns the key of the lane a single package is rated on in the rate
+        cache. Only the parts of the addresses FedEx prices on are used and
+        the weight is rounded up to the pound FedEx bills.
+
+        :param shipper: address dictionary (see address_to_fedex_dict)
+        :param recipient: address dictionary (see address_to_fedex_dict)
+        :param weight: weight of the package in pounds
+        """
+        return fedex_fingerprint((
+            self.id,
+            drop_off_type,
+            packaging_type,
+            service_type,
+            currency_code,
+            shipper['postal_code'], shipper['state_code'],
+            shipper['country_code'],
+            recipient['postal_code'], recipient['state_code'],
+            recipient['country_code'],
+            int(math.ceil(weight)),
+        ))
+
+    def get_fedex_rates(
+        self, shipper, recipient, weight, currency_code, drop_off_type,
+        packaging_type, service_type=None, persist=True
+    ):
+        """
+        Rates a single package shipped from the shipper address to the
+        recipient address, using the rate cache when it is enabled.
+
+        :param shipper: address dictionary (see address_to_fedex_dict)
+        :param recipient: address dictionary (see address_to_fedex_dict)
+        :param weight: weight of the package in pounds
+        :param service_type: FedEx service type to rate, all the services
+            available on the lane are rated if not given.
+        :param persist: If False the rates fetched are not written to the
+            rate cache table (for read only transactions).
+        :return: list of (service_type, amount, currency_code)
+        """
+        return self.async_get_rates(
+            shipper, recipient, weight, currency_code, drop_off_type,
+            packaging_type, service_type, persist
+        ).result()
+
+    def async_get_rates(
+        self, shipper, recipient, weight, currency_code, drop_off_type,
+        packaging_type, service_type=None, persist=True
+    ):
+        """
+        Same as get_fedex_rates, but sends the rate request in the
+        background, so that many lanes can be rated at the same time.
+
+        :return: a FedexFuture whose result is the list of rates
+        """
+        RateCache = Pool().get('fedex.rate.cache')
+
+        key = self.get_fedex_rate_cache_key(
+            shipper, recipient, weight, currency_code, drop_off_type,
+            packaging_type, service_type
+        )
+        if self.fedex_rate_cache_ttl:
+            rates = RateCache.get_rates(key)
+            if rates is not None:
+                return FedexFuture(value=rates)
+
+        def store(response):
+            metrics.increment('rate.performed')
+            rates = self.parse_fedex_rates(response)
+            if self.fedex_rate_cache_ttl:
+                RateCache.set_rates(
+                    key, self, rates, self.fedex_rate_cache_ttl,
+                    persist=persist
+                )
+            return rates
+
+        def error(exc):
+            if isinstance(exc, fedex.RequestError):
+                self.raise_user_error(
+                    'fedex_rates_error', error_args=(exc.message, )
+                )
+
+        return self.async_send_fedex_request(
+            partial(
+                self.get_fedex_rate_request, shipper=shipper,
+                recipient=recipient, weight=weight,
+                currency_code=currency_code, drop_off_type=drop_off_type,
+                packaging_type=packaging_type, service_type=service_type,
+            ), 'rate-%s' % key[:8], callback=store, errback=error
+        )
+
+    @staticmethod
+    def parse_fedex_rates(response):
+        """
+        Returns the rates of a RateService response as a list of
+        (service_type, amount, currency_code)
+        """
+        rates = []
+        for rate_detail in response.RateReplyDetails:
+            net_charge = rate_detail.RatedShipmentDetails[0]. \
+                ShipmentRateDetail.TotalNetCharge
+            rates.append((
+                str(rate_detail.ServiceType),
+                Decimal(str(net_charge.Amount)),
+                str(net_charge.Currency),
+            ))
+        return rates
+
+    def get_fedex_rate_request(
+        self, fedex_credentials, shipper, recipient, weight, currency_code,
+        drop_off_type, packaging_type, service_type=None
+    ):
+        """
+        Returns the request rating a single package with the given
+        credentials (see get_fedex_rates for the other arguments). It does
+        not use the ORM, so it can be called from any thread.
+        """
+        rate_request = fedex.RateService(fedex_credentials)
+        requested_shipment = rate_request.RequestedShipment
+
+        requested_shipment.DropoffType = drop_off_type
+        if service_type:
+            requested_shipment.ServiceType = service_type
+        requested_shipment.PackagingType = packaging_type
+        requested_shipment.PreferredCurrency = currency_code
+
+        requested_shipment.Shipper.AccountNumber = \
+            fedex_credentials.AccountNumber
+        set_fedex_address_from_dict(shipper, requested_shipment.Shipper)
+        set_fedex_address_from_dict(recipient, requested_shipment.Recipient)
+
+        shipping_charges = requested_shipment.ShippingChargesPayment
+        shipping_charges.PaymentType = 'SENDER'
+        shipping_charges.Payor.ResponsibleParty = requested_shipment.Shipper
+
+        requested_shipment.RateRequestTypes = ['ACCOUNT']
+
+        item = rate_request.get_element_from_type('RequestedPackageLineItem')
+        item.SequenceNumber = 1
+        item.Weight.Units = 'LB'
+        item.Weight.Value = weight
+        item.GroupPackageCount = 1
+        requested_shipment.PackageCount = 1
+        requested_shipment.RequestedPackageLineItems = [item]
+
+        return rate_request
+
+    def get_fedex_rate_estimates(
+        self, address, lines, service_type=None, warehouse=None
+    ):
+        """
+        Estimates the FedEx rates to ship products to an address without
+        creating or writing any record, for example to show shipping
+        estimates on a web shop cart.
+
+        :param address: dictionary with the keys city, state_code,
+            postal_code, country_code and optionally streetlines
+        :param lines: list of (product id, quantity) with the quantities in
+            the default unit of the products
+        :param service_type: FedEx service type (eg: FEDEX_2_DAY), all the
+            services available are rated if not given
+        :param warehouse: id of the warehouse the goods are shipped from,
+            defaults to the default warehouse of sales
+        :return: list of dictionaries with the service_type, amount and
+            currency, cheapest first
+        """
+        Sale = Pool().get('sale.sale')
+        Location = Pool().get('stock.location')
+        Product = Pool().get('product.product')
+        Company = Pool().get('company.company')
+        Config = Pool().get('sale.configuration')
+
+        if warehouse is None:
+            warehouse = Sale.default_warehouse()
+        ship_from_address = warehouse and Location(warehouse).address
+        if not ship_from_address:
+            self.raise_user_error('warehouse_address_required')
+
+        config = Config(1)
+        if not all([
+            config.fedex_drop_off_type, config.fedex_packaging_type
+        ]):
+            self.raise_user_error('fedex_settings_missing')
+
+        weights = Product.get_fedex_weights(
+            [product for product, _ in lines]
+        )
+        weight = sum(
+            weights[product] * quantity for product, quantity in lines
+        )
+
+        recipient = {
+            'company_name': None,
+            'person_name': None,
+            'phone': None,
+            'email': None,
+            'streetlines': [],
+            'city': None,
+            'state_code': '',
+            'postal_code': None,
+            'country_code': None,
+        }
+        recipient.update(address)
+
+        company = Company(Transaction().context.get('company'))
+        rates = self.get_fedex_rates(
+            ship_from_address.address_to_fedex_dict(), recipient, weight,
+            company.currency.code, config.fedex_drop_off_type.value,
+            config.fedex_packaging_type.value, service_type,
+            persist=False,
+        )
+        estimates = [{
+            'service_type': rate_service_type,
+            'amount': amount,
+            'currency': currency_code,
+        } for rate_service_type, amount, currency_code in rates]
+        return sorted(estimates, key=lambda estimate: estimate['amount'])
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+    close.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import base64
+import logging
+from datetime import datetime
+from functools import partial
+from collections import defaultdict
+
+from sql import Null
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+import metrics
+from carrier import clear_fedex_cache
+from fedexlib import fedex
+from stock import GROUND_SERVICES
+
+__all__ = ['FedexClose']
+
+logger = logging.getLogger(__name__)
+
+
+class FedexClose(ModelSQL, ModelView):
+    """
+    FedEx Close
+
+    End of day close of the FedEx Ground shipments labeled with an account,
+    the manifest returned by FedEx is attached to it.
+    """
+    __name__ = 'fedex.close'
+    _rec_name = 'account_number'
+
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, select=True, readonly=True,
+        ondelete='RESTRICT'
+    )
+    account_number = fields.Char(
+        'FedEx Account', required=True, select=True, readonly=True
+    )
+    close_date = fields.DateTime('Close Date', required=True, readonly=True)
+    shipment_count = fields.Integer('Shipments Closed', readonly=True)
+    shipments = fields.One2Many(
+        'stock.shipment.out', 'fedex_close', 'Shipments', readonly=True
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(FedexClose, cls).__setup__()
+        cls._order.insert(0, ('close_date', 'DESC'))
+        cls.__rpc__.update({
+            'close_fedex_shipments': RPC(readonly=False),
+        })
+
+    @classmethod
+    def get_pending_fedex_shipments(cls, carriers, close_date):
+        """
+        Returns the ids of the FedEx Ground shipments of the carriers which
+        were labeled up to close_date but not closed yet, by (carrier id,
+        account number). The shipments labeled later are left to the next
+        close, FedEx does not close them with this one.
+        """
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+        Method = pool.get('fedex.shipment.method')
+        cursor = Transaction().cursor
+        shipment = Shipment.__table__()
+        method = Method.__table__()
+
+        carrier_ids = [carrier.id for carrier in carriers]
+        pending = defaultdict(list)
+        for i in xrange(0, len(carrier_ids), cursor.IN_MAX):
+            cursor.execute(*shipment.join(
+                method, condition=shipment.fedex_service_type == method.id
+            ).select(
+                shipment.id, shipment.carrier, shipment.fedex_account_number,
+                where=(shipment.fedex_close == Null)
+                & (shipment.fedex_account_number != Null)
+                & (shipment.tracking_number != Null)
+                # Labeled before the label date was kept
+                & ((shipment.fedex_label_date == Null)
+                    | (shipment.fedex_label_date <= close_date))
+                & (shipment.state != 'cancel')
+                & shipment.carrier.in_(carrier_ids[i:i + cursor.IN_MAX])
+                & method.value.in_(GROUND_SERVICES),
+                order_by=shipment.id,
+            ))
+            for shipment_id, carrier_id, account_number in cursor.fetchall():
+                pending[(carrier_id, account_number)].append(shipment_id)
+        return pending
+
+    @staticmethod
+    def get_fedex_close_request(fedex_credentials, close_date, wsdl=None):
+        """
+        Returns the request closing the shipments of the account made up to
+        close_date. It does not use the ORM.
+        """
+        close_request = fedex.GroundCloseRequest(fedex_credentials, wsdl=wsdl)
+        close_request.TimeUpToWhichShipmentsAreToBeClosed = \
+            close_date.replace(microsecond=0).isoformat()
+        return close_request
+
+    @staticmethod
+    def get_fedex_manifest(response):
+        """
+        Returns the manifest of a close reply as (file name, data), or None
+        if FedEx returned none as there was nothing to close.
+        """
+        manifest = getattr(response, 'Manifest', None)
+        if manifest is None or not getattr(manifest, 'File', None):
+            return None
+        return manifest.FileName, base64.decodestring(manifest.File)
+
+    @classmethod
+    def close_fedex_shipments(cls, carriers=None):
+        """
+        Closes the FedEx Ground shipments labeled since the last close, one
+        request by account, the accounts of a carrier being closed
+        concurrently. Run by a cron at the end of the day.
+
+        The Close Service WSDL is read from close_wsdl in the fedex section
+        of the configuration.
+
+        :param carriers: close the shipments of these carriers (records or
+            ids) instead of all the FedEx carriers
+        :return: the closes created
+        """
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        Attachment = pool.get('ir.attachment')
+
+        if carriers is None:
+            carriers = Carrier.search([
+                ('carrier_cost_method', '=', 'fedex'),
+            ])
+        else:
+            # Only ids are sent over RPC
+            carriers = Carrier.browse(map(int, carriers))
+        # The shipments closed are those labeled up to the time FedEx is
+        # asked to close
+        close_date = datetime.utcnow()
+        pending = cls.get_pending_fedex_shipments(carriers, close_date)
+        wsdl = config.get('fedex', 'close_wsdl')
+
+        closed = []
+        for carrier in carriers:
+            groups = sorted(
+                (account_number, shipment_ids)
+                for (carrier_id, account_number), shipment_ids
+                in pending.iteritems() if carrier_id == carrier.id
+            )
+            if not groups:
+                continue
+            credentials = dict(
+                (account_credentials.AccountNumber, account_credentials)
+                for _, _, account_credentials in carrier.get_fedex_accounts()
+            )
+            for account_number, shipment_ids in groups:
+                if account_number not in credentials:
+                    logger.warning(
+                        'FedEx account %s of %s shipments is not on carrier '
+                        '%s anymore', account_number, len(shipment_ids),
+                        carrier.id
+                    )
+            groups = [
+                group for group in groups if group[0] in credentials
+            ]
+            transport = carrier.get_fedex_transport()
+
+            def send_close(account_number):
+                return transport.send(
+                    partial(
+                        cls.get_fedex_close_request, close_date=close_date,
+                        wsdl=wsdl
+                    ), 'close-%s' % account_number,
+                    credentials=credentials[account_number]
+                )
+
+            for (account_number, shipment_ids), (response, exc_info) in zip(
+                    groups, transport.map(send_close, [g[0] for g in groups])):
+                metrics.increment('close.requests')
+                if exc_info is not None:
+                    metrics.increment('close.errors')
+                    logger.warning(
+                        'FedEx close failed for account %s', account_number,
+                        exc_info=exc_info
+                    )
+                    continue
+                closed.append((
+                    carrier, account_number, shipment_ids,
+                    cls.get_fedex_manifest(response)
+                ))
+
+        if not closed:
+            return []
+
+        closes = cls.create([{
+            'carrier': carrier.id,
+            'account_number': account_number,
+            'close_date': close_date,
+            'shipment_count': len(shipment_ids),
+        } for carrier, account_number, shipment_ids, _ in closed])
+        attachments = []
+        for close, (_, _, _, manifest) in zip(closes, closed):
+            if manifest is None:
+                continue
+            file_name, data = manifest
+            attachments.append({
+                'name': file_name or 'Manifest_%s' % close.account_number,
+                'type': 'data',
+                'data': buffer(data),
+                'resource': '%s,%s' % (cls.__name__, close.id),
+            })
+        Attachment.create(attachments)
+        cls.set_fedex_closed([
+            (close, shipment_ids)
+            for close, (_, _, shipment_ids, _) in zip(closes, closed)
+        ])
+        return closes
+
+    @classmethod
+    def set_fedex_closed(cls, closed):
+        """
+        Links the shipments to their close with one update by close.
+
+        :param closed: list of (close, shipment ids)
+        """
+        Shipment = Pool().get('stock.shipment.out')
+        cursor = Transaction().cursor
+        shipment = Shipment.__table__()
+
+        for close, shipment_ids in closed:
+            for i in xrange(0, len(shipment_ids), cursor.IN_MAX):
+                cursor.execute(*shipment.update(
+                    [shipment.fedex_close], [close.id],
+                    where=shipment.id.in_(shipment_ids[i:i + cursor.IN_MAX])
+                ))
+            clear_fedex_cache(Shipment.__name__, shipment_ids)
+            metrics.increment('close.shipments', len(shipment_ids))
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+    commodities.py
+
+    Commodities of the customs clearance detail of international shipments.
+    The goods are aggregated by product, harmonized code and country of
+    origin, so that an order repeating the same products is declared with
+    a few commodities, and merged further when they go past the number of
+    commodities FedEx accepts.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+from collections import OrderedDict
+
+__all__ = ['Commodity', 'CommodityBuilder', 'MAX_COMMODITIES']
+
+# Number of commodities FedEx accepts for a shipment at most
+MAX_COMMODITIES = 99
+
+# Length of the description of a commodity FedEx accepts at most
+MAX_DESCRIPTION = 450
+
+CENT = Decimal('0.01')
+TENTH = Decimal('0.1')
+
+
+def to_decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value or 0))
+
+
+class Commodity(object):
+    """
+    Goods declared together to the customs
+    """
+    __slots__ = (
+        'name', 'description', 'harmonized_code', 'country', 'quantity',
+        'value', 'weight', 'pieces',
+    )
+
+    def __init__(self, name, description, harmonized_code, country):
+        self.name = name
+        self.description = description
+        self.harmonized_code = harmonized_code
+        self.country = country
+        self.quantity = Decimal(0)
+        self.value = Decimal(0)
+        self.weight = Decimal(0)
+        # Packages the goods are in
+        self.pieces = set()
+
+    @property
+    def unit_price(self):
+        if not self.quantity:
+            return self.value.quantize(CENT, ROUND_HALF_UP)
+        return (self.value / self.quantity).quantize(CENT, ROUND_HALF_UP)
+
+    @classmethod
+    def merge(cls, commodities):
+        """
+        Returns a commodity declaring all the goods of the commodities. The
+        harmonized code and the country of origin are kept when they are
+        the same for all, the country of the most valuable goods is used
+        otherwise.
+        """
+        main = max(commodities, key=lambda commodity: commodity.value)
+        codes = set(commodity.harmonized_code for commodity in commodities)
+        countries = set(commodity.country for commodity in commodities)
+        descriptions = []
+        for commodity in commodities:
+            if commodity.description not in descriptions:
+                descriptions.append(commodity.description)
+        description = ', '.join(filter(None, descriptions))
+        if len(description) > MAX_DESCRIPTION:
+            description = description[:MAX_DESCRIPTION - 3] + '...'
+
+        merged = cls(
+            main.name, description,
+            codes.pop() if len(codes) == 1 else None,
+            countries.pop() if len(countries) == 1 else main.country,
+        )
+        for commodity in commodities:
+            merged.quantity += commodity.quantity
+            merged.value += commodity.value
+            merged.weight += commodity.weight
+            merged.pieces |= commodity.pieces
+        return merged
+
+
+class CommodityBuilder(object):
+    """
+    Aggregates the goods of a sale or a shipment into commodities in one
+    pass. Values and weights are summed as Decimal and only rounded when
+    the commodities are written to the request.
+
+    :param max_commodities: number of commodities the goods are merged
+        into at most
+    """
+
+    def __init__(self, max_commodities=MAX_COMMODITIES):
+        self.max_commodities = max_commodities
+        self.commodities = OrderedDict()
+
+    def add(
+        self, product_id, name, description, harmonized_code, country,
+        quantity, unit_price, weight, piece=None
+    ):
+        """
+        Adds goods to the commodity of their product, harmonized code and
+        country of origin.
+
+        :param quantity: number of units of the product
+        :param unit_price: price of a unit in the currency of the customs
+            value
+        :param weight: weight of the goods in pounds
+        :param piece: package the goods are in, if known
+        """
+        key = (product_id, harmonized_code, country)
+        commodity = self.commodities.get(key)
+        if commodity is None:
+            commodity = self.commodities[key] = Commodity(
+                name, description, harmonized_code, country
+            )
+        quantity = to_decimal(quantity)
+        commodity.quantity += quantity
+        commodity.value += quantity * to_decimal(unit_price)
+        commodity.weight += to_decimal(weight)
+        if piece is not None:
+            commodity.pieces.add(piece)
+
+    @property
+    def customs_value(self):
+        return sum(
+            (commodity.value for commodity in self.commodities.itervalues()),
+            Decimal(0)
+        ).quantize(CENT, ROUND_HALF_UP)
+
+    def get_commodities(self):
+        """
+        Returns the commodities. When there are more than max_commodities,
+        the commodities with the same harmonized code and country of origin
+        are merged first, then the least valuable ones into one.
+        """
+        commodities = self.commodities.values()
+        if len(commodities) <= self.max_commodities:
+            return commodities
+
+        by_code = OrderedDict()
+        for commodity in commodities:
+            if commodity.harmonized_code:
+                key = (commodity.harmonized_code, commodity.country)
+            else:
+                # Nothing tells goods without code can be declared together
+                key = id(commodity)
+            by_code.setdefault(key, []).append(commodity)
+        commodities = [
+            group[0] if len(group) == 1 else Commodity.merge(group)
+            for group in by_code.itervalues()
+        ]
+        if len(commodities) <= self.max_commodities:
+            return commodities
+
+        commodities.sort(key=lambda commodity: commodity.value, reverse=True)
+        kept = commodities[:self.max_commodities - 1]
+        return kept + [Commodity.merge(commodities[len(kept):])]
+
+    def get_fedex_commodities(self, fedex_request, currency_code):
+        """
+        Returns the Commodity elements of the request for the commodities
+        """
+        elements = []
+        for commodity in self.get_commodities():
+            element = fedex_request.get_element_from_type('Commodity')
+            element.NumberOfPieces = len(commodity.pieces) or 1
+            element.Name = commodity.name
+            element.Description = commodity.description or commodity.name
+            if commodity.harmonized_code:
+                element.HarmonizedCode = commodity.harmonized_code
+            element.CountryOfManufacture = commodity.country
+            element.Weight.Units = 'LB'
+            element.Weight.Value = max(
+                commodity.weight.quantize(TENTH, ROUND_HALF_UP), TENTH
+            )
+            element.Quantity = int(
+                commodity.quantity.to_integral_value(ROUND_HALF_UP)
+            )
+            element.QuantityUnits = 'EA'
+            element.UnitPrice.Amount = commodity.unit_price
+            element.UnitPrice.Currency = currency_code
+            element.CustomsValue.Amount = commodity.value.quantize(
+                CENT, ROUND_HALF_UP
+            )
+            element.CustomsValue.Currency = currency_code
+            elements.append(element)
+        return elements
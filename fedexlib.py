@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+    fedexlib.py
+
+    Facade loading the fedex library and its SOAP stack on first use, so
+    that registering the module in workers which never talk to FedEx (cron
+    or report workers) stays cheap.
+
+    Use `fedex.RateService` instead of importing RateService from fedex.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+from threading import Lock
+
+__all__ = ['fedex']
+
+PACKAGE = __name__.rpartition('.')[0]
+
+# name: (module, attribute of the module or None for the module itself)
+NAMES = {
+    'RateService': ('fedex', 'RateService'),
+    'ProcessShipmentRequest': ('fedex', 'ProcessShipmentRequest'),
+    'AddressValidationService': ('fedex', 'AddressValidationService'),
+    'RequestError': ('fedex.exceptions', 'RequestError'),
+    'DeleteShipmentRequest': (
+        '%s.fedexservices' % PACKAGE if PACKAGE else 'fedexservices',
+        'DeleteShipmentRequest'
+    ),
+    'GroundCloseRequest': (
+        '%s.fedexservices' % PACKAGE if PACKAGE else 'fedexservices',
+        'GroundCloseRequest'
+    ),
+    'TrackRequest': (
+        '%s.fedexservices' % PACKAGE if PACKAGE else 'fedexservices',
+        'TrackRequest'
+    ),
+    # Modules of this package using the SOAP stack
+    'keepalive': ('%s.keepalive' % PACKAGE if PACKAGE else 'keepalive', None),
+}
+
+
+class LazyFedex(object):
+    """
+    Gives the names of NAMES, importing their module when they are first
+    used
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+
+    def __getattr__(self, name):
+        if name not in NAMES:
+            raise AttributeError(name)
+        module_name, attribute = NAMES[name]
+        with self._lock:
+            __import__(module_name)
+            value = sys.modules[module_name]
+            if attribute is not None:
+                value = getattr(value, attribute)
+            # The next lookups do not go through __getattr__
+            setattr(self, name, value)
+        return value
+
+
+fedex = LazyFedex()
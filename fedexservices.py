@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+    fedexservices.py
+
+    Requests of the FedEx web services which the fedex library does not
+    provide, built on its API classes and WSDL. Use them from the fedexlib
+    facade, eg: `fedex.DeleteShipmentRequest`.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import string
+from datetime import datetime
+
+from fedex.api import APIBase
+from fedex.structures import VersionInformation
+
+__all__ = ['DeleteShipmentRequest', 'GroundCloseRequest', 'TrackRequest']
+
+
+class DeleteShipmentRequest(APIBase):
+    """
+    Deletes (voids) a shipment of the Ship Service, identified by its
+    master tracking number
+    """
+    __slots__ = (
+        'ShipTimestamp',
+        'TrackingId',
+        'DeletionControl',
+    )
+
+    version_info = VersionInformation('ship', 15, 0, 0)
+    service_name = 'deleteShipment'
+
+    def __init__(self, account_info):
+        """
+        :param account_info: Instance of `structures.AccountInformation`
+                             with all the details of accounts
+        """
+        self.account_info = account_info
+        self.set_wsdl_client('ShipService_v15.wsdl')
+        self.TrackingId = self.get_element_from_type('TrackingId')
+        self.DeletionControl = 'DELETE_ALL_PACKAGES'
+        super(DeleteShipmentRequest, self).__init__()
+
+    def send_request(self, transaction_id=None):
+        """
+        Inherit and implement send_request
+
+        :param transaction_id: ID of the transaction
+        """
+        if transaction_id is not None:
+            self.set_transaction_details(transaction_id)
+        self.ShipTimestamp = datetime.utcnow().replace(
+            microsecond=0).isoformat()
+
+        fields = self.__slots__ + super(
+            DeleteShipmentRequest,
+            self).__slots__
+        fields = [x for x in fields if x[0] in string.uppercase]
+        return self._send_request(fields)
+
+
+class GroundCloseRequest(APIBase):
+    """
+    Closes the FedEx Ground shipments of the account made up to a time
+    and returns their manifest.
+
+    The fedex library does not bundle the WSDL of the Close Service, the
+    path or URL of CloseService_v2.wsdl can be given instead.
+    """
+    __slots__ = (
+        'TimeUpToWhichShipmentsAreToBeClosed',
+    )
+
+    version_info = VersionInformation('clos', 2, 0, 0)
+    service_name = 'groundClose'
+
+    def __init__(self, account_info, wsdl=None):
+        """
+        :param account_info: Instance of `structures.AccountInformation`
+                             with all the details of accounts
+        :param wsdl: location of the WSDL of the Close Service
+        """
+        self.account_info = account_info
+        self.set_wsdl_client(wsdl or 'CloseService_v2.wsdl')
+        self.TimeUpToWhichShipmentsAreToBeClosed = None
+        super(GroundCloseRequest, self).__init__()
+
+    def send_request(self, transaction_id=None):
+        """
+        Inherit and implement send_request
+
+        :param transaction_id: ID of the transaction
+        """
+        if transaction_id is not None:
+            self.set_transaction_details(transaction_id)
+        if self.TimeUpToWhichShipmentsAreToBeClosed is None:
+            self.TimeUpToWhichShipmentsAreToBeClosed = \
+                datetime.utcnow().replace(microsecond=0).isoformat()
+
+        fields = self.__slots__ + super(
+            GroundCloseRequest,
+            self).__slots__
+        # The Close Service has no request timestamp
+        fields = [
+            x for x in fields
+            if x[0] in string.uppercase and x != 'RequestTimestamp'
+        ]
+        return self._send_request(fields)
+
+
+class TrackRequest(APIBase):
+    """
+    Asks for the status of packages identified by their tracking number.
+
+    The fedex library does not bundle the WSDL of the Track Service, the
+    path or URL of TrackService_v10.wsdl can be given instead.
+    """
+    __slots__ = (
+        'SelectionDetails',
+        'ProcessingOptions',
+    )
+
+    version_info = VersionInformation('trck', 10, 0, 0)
+    service_name = 'track'
+
+    def __init__(self, account_info, wsdl=None):
+        """
+        :param account_info: Instance of `structures.AccountInformation`
+                             with all the details of accounts
+        :param wsdl: location of the WSDL of the Track Service
+        """
+        self.account_info = account_info
+        self.set_wsdl_client(wsdl or 'TrackService_v10.wsdl')
+        self.SelectionDetails = []
+        self.ProcessingOptions = None
+        super(TrackRequest, self).__init__()
+
+    def send_request(self, transaction_id=None):
+        """
+        Inherit and implement send_request
+
+        :param transaction_id: ID of the transaction
+        """
+        if transaction_id is not None:
+            self.set_transaction_details(transaction_id)
+
+        fields = self.__slots__ + super(
+            TrackRequest,
+            self).__slots__
+        # The Track Service has no request timestamp
+        fields = [
+            x for x in fields
+            if x[0] in string.uppercase and x != 'RequestTimestamp'
+            and getattr(self, x, None) is not None
+        ]
+        return self._send_request(fields)
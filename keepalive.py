@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+    keepalive.py
+
+    Transport for the SOAP client of the fedex library keeping the HTTPS
+    connections to FedEx open between requests, so that the TLS handshake
+    is only paid once per connection, and compressing the messages.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import zlib
+import gzip
+import errno
+import socket
+import httplib
+import urlparse
+from StringIO import StringIO
+import threading
+from threading import Lock
+from collections import deque
+
+from suds.transport import Transport, Reply, TransportError
+from suds.transport.http import HttpTransport
+
+from trytond.config import config
+
+from fedex import ProcessShipmentRequest
+
+import metrics
+import leanparse
+
+__all__ = [
+    'ConnectionPool', 'KeepAliveTransport', 'get_pool_stats', 'install',
+    'pop_lean_reply',
+]
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_TIMEOUT = 90
+
+_pools = {}
+_pools_lock = Lock()
+
+
+class ConnectionPool(object):
+    """
+    Idle connections to a host, reused by the next requests to the host.
+
+    :param size: number of idle connections kept, more connections are
+        opened when needed but closed once used
+    :param idle_timeout: seconds after which an idle connection is closed
+        instead of being reused, as the server may have closed it already
+    """
+
+    def __init__(
+        self, scheme, host, port=None, size=DEFAULT_POOL_SIZE,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=DEFAULT_TIMEOUT,
+        context=None
+    ):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.context = context
+        self._lock = Lock()
+        self._idle = deque()
+        self.stats = {
+            'created': 0,
+            'reused': 0,
+            'expired': 0,
+            'discarded': 0,
+            'in_use': 0,
+        }
+
+    def _connect(self):
+        if self.scheme == 'https':
+            kwargs = {}
+            if self.context is not None:
+                kwargs['context'] = self.context
+            return httplib.HTTPSConnection(
+                self.host, self.port, timeout=self.timeout, **kwargs
+            )
+        return httplib.HTTPConnection(
+            self.host, self.port, timeout=self.timeout
+        )
+
+    def get(self):
+        """
+        Returns an idle connection or a new one.
+
+        :return: a tuple (connection, reused)
+        """
+        now = time.time()
+        with self._lock:
+            self.stats['in_use'] += 1
+            while self._idle:
+                connection, released = self._idle.pop()
+                if now - released < self.idle_timeout:
+                    self.stats['reused'] += 1
+                    metrics.increment('http.connections.reused')
+                    return connection, True
+                self.stats['expired'] += 1
+                connection.close()
+            self.stats['created'] += 1
+        metrics.increment('http.connections.created')
+        return self._connect(), False
+
+    def put(self, connection, reusable=True):
+        """
+        Gives back a connection once its response was read
+        """
+        with self._lock:
+            self.stats['in_use'] -= 1
+            if reusable and len(self._idle) < self.size:
+                self._idle.append((connection, time.time()))
+                return
+            self.stats['discarded'] += 1
+        connection.close()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, idle=len(self._idle), size=self.size)
+        return stats
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                connection, _ = self._idle.pop()
+                connection.close()
+
+
+def get_pool(scheme, host, port=None, context=None):
+    """
+    Returns the connection pool of the endpoint, shared by the process
+    """
+    key = (scheme, host, port)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(
+                scheme, host, port,
+                size=int(
+                    config.get('fedex', 'pool_size') or DEFAULT_POOL_SIZE
+                ),
+                idle_timeout=float(
+                    config.get('fedex', 'pool_idle_timeout')
+                    or DEFAULT_IDLE_TIMEOUT
+                ),
+                context=context,
+            )
+        return pool
+
+
+def get_pool_stats():
+    """
+    Returns the statistics of the connection pools of the process by
+    endpoint (host:port)
+    """
+    with _pools_lock:
+        pools = _pools.items()
+    return dict(
+        ('%s:%s' % (host, port or ''), pool.get_stats())
+        for (_, host, port), pool in pools
+    )
+
+
+class DecodedReader(object):
+    """
+    Reads the body of a response, decompressing it on the fly
+    """
+
+    def __init__(self, response):
+        self.response = response
+        encoding = response.getheader('content-encoding')
+        if encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.decompressor = None
+        self.buffer = ''
+        self.eof = False
+
+    def read(self, size=-1):
+        if self.decompressor is None:
+            return self.response.read(*([size] if size >= 0 else []))
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.response.read(64 * 1024)
+            if chunk:
+                self.buffer += self.decompressor.decompress(chunk)
+            else:
+                self.buffer += self.decompressor.flush()
+                self.eof = True
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def is_closed_before_reply(exc):
+    """
+    Tells if the error raised while waiting for a response shows that the
+    server closed the connection without sending a byte: an empty status
+    line or a reset connection. A timeout is not, the server may still be
+    processing the request.
+    """
+    if isinstance(exc, socket.timeout):
+        return False
+    if isinstance(exc, httplib.BadStatusLine):
+        # Python 2.7 versions differ in the line they give for no line
+        return exc.line in ('', "''") or \
+            exc.line.startswith('No status line received')
+    if isinstance(exc, socket.error):
+        return exc.errno in (errno.ECONNRESET, errno.EPIPE)
+    return False
+
+
+class KeepAliveTransport(Transport):
+    """
+    Sends the SOAP messages over pooled keep-alive connections, asking
+    for compressed responses. Requests are compressed too when
+    compress_requests is set in the fedex section of the configuration,
+    as not all the FedEx endpoints accept it.
+    """
+
+    def __init__(self, context=None):
+        Transport.__init__(self)
+        self.context = context
+        # Documents (WSDL, schemas) are rarely fetched, no need to pool
+        self._fallback = HttpTransport()
+
+    def open(self, request):
+        return self._fallback.open(request)
+
+    def send(self, request):
+        url = urlparse.urlsplit(request.url)
+        pool = get_pool(url.scheme, url.hostname, url.port, self.context)
+
+        body = request.message
+        headers = dict(request.headers)
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        headers['Connection'] = 'keep-alive'
+        if config.getboolean('fedex', 'compress_requests', default=False):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+                gzip_file.write(body)
+            body = buf.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+
+        # A request is sent again on another connection only if the server
+        # closed the idle connection it was sent on before reading it, never
+        # once it may have been processed (a shipment would be billed twice)
+        while True:
+            connection, reused = pool.get()
+            try:
+                connection.request('POST', path, body, headers)
+            except (httplib.HTTPException, socket.error), exc:
+                pool.put(connection, reusable=False)
+                if reused and not isinstance(exc, socket.timeout):
+                    continue
+                raise
+            try:
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error), exc:
+                pool.put(connection, reusable=False)
+                if reused and is_closed_before_reply(exc):
+                    continue
+                raise
+            break
+
+        reusable = False
+        try:
+            reader = DecodedReader(response)
+            if getattr(_local, 'lean', False) and response.status == 200:
+                data, _local.reply = leanparse.parse(reader)
+                # The parser may stop before the end of the body
+                reader.read()
+            else:
+                data = reader.read()
+            reusable = not response.will_close
+        finally:
+            pool.put(connection, reusable=reusable)
+
+        reply_headers = dict(response.getheaders())
+        if response.status in (202, 204):
+            return None
+        if response.status >= 300:
+            raise TransportError(
+                response.reason, response.status, StringIO(data)
+            )
+        return Reply(response.status, reply_headers, data)
+
+
+_transport = None
+_local = threading.local()
+
+
+def install(fedex_request):
+    """
+    Makes the SOAP client of a request of the fedex library send it with
+    the keep-alive transport. The replies of shipment requests, which
+    carry the labels, are read by the lean parser (see pop_lean_reply).
+    """
+    global _transport
+    client = getattr(fedex_request, 'wsdl_client', None)
+    _local.lean = isinstance(fedex_request, ProcessShipmentRequest)
+    _local.reply = None
+    if client is None:
+        return
+    if _transport is None:
+        _transport = KeepAliveTransport()
+    client.set_options(transport=_transport)
+
+
+def pop_lean_reply():
+    """
+    Returns the LeanReply of the last request sent by this thread, or None
+    if it was not read by the lean parser
+    """
+    reply, _local.reply = getattr(_local, 'reply', None), None
+    return reply
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+    leanparse.py
+
+    Fast path for the replies of FedEx carrying labels. The reply is read
+    incrementally, each label image is written to a file as soon as it is
+    read and removed from the reply, so that the SOAP client only builds
+    objects for the small remainder.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import base64
+import tempfile
+from xml.etree import cElementTree as ElementTree
+
+__all__ = ['LeanReply', 'parse']
+
+ERROR_SEVERITIES = ('ERROR', 'FAILURE')
+
+
+class LeanReply(object):
+    """
+    The fields of a reply read by the lean parser
+    """
+
+    def __init__(self):
+        self.severity = None
+        self.tracking_numbers = []
+        self.amount = None
+        self.currency = None
+        # Files holding the decoded label images, in the order of the reply
+        self.images = []
+
+    def read_image(self, index):
+        """
+        Returns the content of an image and removes its file
+        """
+        path = self.images[index]
+        with open(path, 'rb') as image_file:
+            data = image_file.read()
+        os.remove(path)
+        return data
+
+    def remove_images(self):
+        for path in self.images:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def write_image(text, directory=None):
+    fd, path = tempfile.mkstemp(prefix='fedex-label-', dir=directory)
+    with os.fdopen(fd, 'wb') as image_file:
+        image_file.write(base64.b64decode(text))
+    return path
+
+
+def parse(fileobj, directory=None):
+    """
+    Reads a reply from the file object.
+
+    :param directory: directory the images are written to, the temporary
+        directory by default
+    :return: a tuple (xml of the reply without the images, LeanReply) with
+        None instead of the LeanReply for errors and faults, which are then
+        left to the SOAP client
+    """
+    lean = LeanReply()
+    names = []
+    root = None
+    for event, element in ElementTree.iterparse(
+            fileobj, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            names.append(local_name(element.tag))
+            continue
+
+        name = names.pop()
+        parent = names and names[-1]
+        if name == 'Image':
+            lean.images.append(write_image(element.text or '', directory))
+            element.text = ''
+        elif name == 'HighestSeverity':
+            lean.severity = element.text
+        elif name == 'Fault':
+            lean.severity = 'FAILURE'
+        elif name == 'TrackingNumber' and parent == 'TrackingIds':
+            lean.tracking_numbers.append(element.text)
+        elif parent == 'TotalNetCharge' and 'ShipmentRateDetails' in names:
+            # The first rate detail is the one of the account
+            if name == 'Amount' and lean.amount is None:
+                lean.amount = element.text
+            elif name == 'Currency' and lean.currency is None:
+                lean.currency = element.text
+
+    xml = ElementTree.tostring(root)
+    if lean.severity in ERROR_SEVERITIES:
+        lean.remove_images()
+        return xml, None
+    return xml, lean
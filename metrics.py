@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics.py
+
+    Process wide counters of the work done (and avoided) by the FedEx
+    integration.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from collections import defaultdict
+from threading import Lock
+
+__all__ = ['increment', 'get', 'snapshot', 'reset']
+
+_lock = Lock()
+_counters = defaultdict(int)
+
+
+def increment(name, value=1):
+    """
+    Increment the counter `name` by `value`
+    """
+    with _lock:
+        _counters[name] += value
+
+
+def get(name):
+    """
+    Returns the current value of the counter `name`
+    """
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot():
+    """
+    Returns a copy of all the counters as a dictionary
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    """
+    Reset all the counters, mostly useful in tests
+    """
+    with _lock:
+        _counters.clear()
@@ -7,10 +7,104 @@
 """
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
+from trytond.cache import Cache
 
-__all__ = ['Address']
+__all__ = [
+    'Party', 'ContactMechanism', 'Address', 'Country', 'Subdivision'
+]
 __metaclass__ = PoolMeta
 
+# Countries whose addresses need a state and a postal code for FedEx
+STATE_COUNTRIES = ('US', 'CA')
+
+
+def set_fedex_address_from_dict(address, fedex_object):
+    """
+    Passes the address details in the dictionary (as returned by
+    address_to_fedex_dict) to the shipper or recipient object of a request.
+    It does not use the pool, so requests can be built in any thread.
+    """
+    fedex_object.Contact.CompanyName = address['company_name']
+    fedex_object.Contact.PersonName = address['person_name']
+    fedex_object.Contact.PhoneNumber = address['phone']
+    fedex_object.Contact.EMailAddress = address['email']
+    fedex_object.Address.StreetLines = address['streetlines']
+    fedex_object.Address.City = address['city']
+    # Subdivision codes are like US-FL, FedEx wants the part after the dash
+    fedex_object.Address.StateOrProvinceCode = \
+        (address['state_code'] or '')[-2:] or None
+    fedex_object.Address.PostalCode = address['postal_code']
+    fedex_object.Address.CountryCode = address['country_code']
+
+
+class Party:
+    "Party"
+    __name__ = 'party.party'
+
+    @classmethod
+    def write(cls, *args):
+        super(Party, cls).write(*args)
+        Pool().get('party.address')._fedex_address_cache.clear()
+
+    @classmethod
+    def delete(cls, parties):
+        super(Party, cls).delete(parties)
+        Pool().get('party.address')._fedex_address_cache.clear()
+
+
+class Country:
+    "Country"
+    __name__ = 'country.country'
+
+    @classmethod
+    def write(cls, *args):
+        super(Country, cls).write(*args)
+        # The country codes sent to FedEx may have changed
+        Pool().get('party.address')._fedex_address_cache.clear()
+
+    @classmethod
+    def delete(cls, countries):
+        super(Country, cls).delete(countries)
+        Pool().get('party.address')._fedex_address_cache.clear()
+
+
+class Subdivision:
+    "Subdivision"
+    __name__ = 'country.subdivision'
+
+    @classmethod
+    def write(cls, *args):
+        super(Subdivision, cls).write(*args)
+        # The state codes sent to FedEx may have changed
+        Pool().get('party.address')._fedex_address_cache.clear()
+
+    @classmethod
+    def delete(cls, subdivisions):
+        super(Subdivision, cls).delete(subdivisions)
+        Pool().get('party.address')._fedex_address_cache.clear()
+
+
+class ContactMechanism:
+    "Contact Mechanism"
+    __name__ = 'party.contact_mechanism'
+
+    @classmethod
+    def create(cls, vlist):
+        mechanisms = super(ContactMechanism, cls).create(vlist)
+        # The phone and email sent to FedEx may have changed
+        Pool().get('party.address')._fedex_address_cache.clear()
+        return mechanisms
+
+    @classmethod
+    def write(cls, *args):
+        super(ContactMechanism, cls).write(*args)
+        Pool().get('party.address')._fedex_address_cache.clear()
+
+    @classmethod
+    def delete(cls, mechanisms):
+        super(ContactMechanism, cls).delete(mechanisms)
+        Pool().get('party.address')._fedex_address_cache.clear()
+
 
 class Address:
     """
@@ -18,6 +112,88 @@ class Address:
     """
     __name__ = 'party.address'
 
+    # Addresses as sent to FedEx by company, cleared when the addresses,
+    # their parties, contact mechanisms, countries or subdivisions are
+    # modified.
+    _fedex_address_cache = Cache('party.address.fedex_dict', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(Address, cls).__setup__()
+        cls._error_messages.update({
+            'fedex_country_missing': 'The country is missing.',
+            'fedex_city_missing': 'The city is missing.',
+            'fedex_street_missing': 'The street is missing.',
+            'fedex_zip_missing': 'The postal code is missing.',
+            'fedex_subdivision_missing':
+                'The state is required for addresses in "%s".',
+            'fedex_subdivision_invalid':
+                'The state code "%s" is not a valid FedEx state code.',
+            'fedex_phone_missing': 'The phone number of "%s" is missing.',
+        })
+
+    @classmethod
+    def get_fedex_address_problems(cls, addresses, phone=True):
+        """
+        Checks that FedEx will accept the addresses, without sending
+        anything. The addresses are read together, so checking many of
+        them only takes a few queries.
+
+        :param phone: check the phone numbers of the parties, which FedEx
+            only requires for labels, not for rates
+
+        :return: dictionary mapping the id of each address with problems to
+            the list of its problems
+        """
+        addresses = cls.browse([address.id for address in addresses])
+
+        def problem(error, *args):
+            return cls.raise_user_error(
+                error, error_args=args, raise_exception=False
+            )
+
+        problems = {}
+        for address in addresses:
+            messages = []
+            country_code = address.country and address.country.code
+            if not country_code:
+                messages.append(problem('fedex_country_missing'))
+            if not address.city:
+                messages.append(problem('fedex_city_missing'))
+            if not (address.street or address.streetbis):
+                messages.append(problem('fedex_street_missing'))
+            if country_code in STATE_COUNTRIES:
+                if not address.zip:
+                    messages.append(problem('fedex_zip_missing'))
+                if not address.subdivision:
+                    messages.append(
+                        problem('fedex_subdivision_missing', country_code)
+                    )
+                elif len((address.subdivision.code or '').split('-')[-1]) \
+                        != 2:
+                    messages.append(problem(
+                        'fedex_subdivision_invalid', address.subdivision.code
+                    ))
+            # Only the digits of the phone number are sent
+            if phone and not any(
+                    char.isdigit() for char in address.party.phone or ''):
+                messages.append(
+                    problem('fedex_phone_missing', address.party.rec_name)
+                )
+            if messages:
+                problems[address.id] = messages
+        return problems
+
+    @classmethod
+    def write(cls, *args):
+        super(Address, cls).write(*args)
+        cls._fedex_address_cache.clear()
+
+    @classmethod
+    def delete(cls, addresses):
+        super(Address, cls).delete(addresses)
+        cls._fedex_address_cache.clear()
+
     def address_to_fedex_dict(self):
         """
         This method creates a dict of address details
@@ -26,43 +202,77 @@ class Address:
         :return: returns the dictionary comprising of the details
                 of the package recipient.
         """
+        return self.addresses_to_fedex_dicts([self])[self.id]
+
+    @classmethod
+    def addresses_to_fedex_dicts(cls, addresses):
+        """
+        Returns a dictionary mapping the ids of the addresses to their
+        dictionary for FedEx (see address_to_fedex_dict). Addresses are
+        cached, so the warehouse address is only read once for a batch of
+        quotes or labels, and the addresses not cached yet are read
+        together.
+        """
         Company = Pool().get('company.company')
 
-        streetlines = []
-        company = Company(Transaction().context.get('company'))
-
-        phone = self.party.phone
-        if phone:
-            # FedEx accepts only numeric numbers in phone
-            phone = filter(lambda char: char.isdigit(), phone)
-        if self.street:
-            streetlines.append(self.street)
-        if self.streetbis:
-            streetlines.append(self.streetbis)
-        return {
-            'company_name': company.party.name,
-            'person_name': self.name,
-            'phone': phone,
-            'email': self.party.email,
-            'streetlines': streetlines,
-            'city': self.city,
-            'state_code': self.subdivision and self.subdivision.code,
-            'postal_code': self.zip,
-            'country_code': self.country and self.country.code,
-        }
+        company_id = Transaction().context.get('company')
+        result = {}
+        missing = []
+        for address_id in set(address.id for address in addresses):
+            address = cls._fedex_address_cache.get((company_id, address_id))
+            if address is None:
+                missing.append(address_id)
+            else:
+                result[address_id] = address
+
+        if missing:
+            company = Company(company_id)
+            for address in cls.browse(missing):
+                phone = address.party.phone
+                if phone:
+                    # FedEx accepts only numeric numbers in phone
+                    phone = filter(lambda char: char.isdigit(), phone)
+                streetlines = []
+                if address.street:
+                    streetlines.append(address.street)
+                if address.streetbis:
+                    streetlines.append(address.streetbis)
+                result[address.id] = {
+                    'company_name': company.party.name,
+                    'person_name': address.name,
+                    'phone': phone,
+                    'email': address.party.email,
+                    'streetlines': streetlines,
+                    'city': address.city,
+                    'state_code':
+                        address.subdivision and address.subdivision.code,
+                    'postal_code': address.zip,
+                    'country_code': address.country and address.country.code,
+                }
+                cls._fedex_address_cache.set(
+                    (company_id, address.id), result[address.id]
+                )
+
+        # The cached dictionaries are shared, callers get their own copy
+        return dict(
+            (address_id, dict(address, streetlines=address['streetlines'][:]))
+            for address_id, address in result.iteritems()
+        )
 
     def set_fedex_address(self, fedex_object):
         '''
         Computes the details of the shipper or recipient depending on object,
         passes the values to ship request
         '''
-        address = self.address_to_fedex_dict()
-        fedex_object.Contact.CompanyName = address['company_name']
-        fedex_object.Contact.PersonName = address['person_name']
-        fedex_object.Contact.PhoneNumber = address['phone']
-        fedex_object.Contact.EMailAddress = address['email']
-        fedex_object.Address.StreetLines = address['streetlines']
-        fedex_object.Address.City = address['city']
-        fedex_object.Address.StateOrProvinceCode = address['state_code'][-2:]
-        fedex_object.Address.PostalCode = address['postal_code']
-        fedex_object.Address.CountryCode = address['country_code']
+        self.set_fedex_address_from_dict(
+            self.address_to_fedex_dict(), fedex_object
+        )
+
+    @staticmethod
+    def set_fedex_address_from_dict(address, fedex_object):
+        """
+        Passes the address details in the dictionary (as returned by
+        address_to_fedex_dict) to the shipper or recipient object of a
+        request. This allows rating addresses which are not saved.
+        """
+        set_fedex_address_from_dict(address, fedex_object)
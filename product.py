@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    product.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.cache import Cache
+
+__all__ = ['Template', 'Product']
+__metaclass__ = PoolMeta
+
+
+class Template:
+    "Product Template"
+    __name__ = 'product.template'
+
+    fedex_harmonized_code = fields.Char(
+        'Harmonized Code', help='Customs code of the product, used for '
+        'international FedEx shipments'
+    )
+    fedex_country_of_origin = fields.Many2One(
+        'country.country', 'Country of Origin',
+        help='Country the product is made in, the country of the warehouse '
+        'is declared to the customs when not set'
+    )
+
+    @classmethod
+    def write(cls, *args):
+        super(Template, cls).write(*args)
+        Pool().get('product.product')._fedex_weight_cache.clear()
+
+    @classmethod
+    def delete(cls, templates):
+        super(Template, cls).delete(templates)
+        Pool().get('product.product')._fedex_weight_cache.clear()
+
+
+class Product:
+    "Product"
+    __name__ = 'product.product'
+
+    _fedex_weight_cache = Cache('product.product.fedex_weight', context=False)
+
+    @classmethod
+    def get_fedex_weights(cls, product_ids):
+        """
+        Returns a dictionary mapping the given product ids to the weight of
+        one unit of the product in pounds. Weights are cached, so rating a
+        cart does not read the products again.
+        """
+        Uom = Pool().get('product.uom')
+
+        weights = {}
+        missing = []
+        for product_id in set(product_ids):
+            weight = cls._fedex_weight_cache.get(product_id)
+            if weight is None:
+                missing.append(product_id)
+            else:
+                weights[product_id] = weight
+
+        if missing:
+            uom_pound, = Uom.search([('symbol', '=', 'lb')])
+            for product in cls.browse(missing):
+                template = product.template
+                weight = 0.0
+                if template.weight and template.weight_uom:
+                    weight = Uom.compute_qty(
+                        template.weight_uom, template.weight, uom_pound
+                    )
+                cls._fedex_weight_cache.set(product.id, weight)
+                weights[product.id] = weight
+
+        return weights
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+    rate_cache.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import math
+import logging
+from datetime import datetime, timedelta
+from functools import partial
+from collections import defaultdict
+
+from sql import Literal, Null
+from sql.aggregate import Count
+
+from trytond.model import ModelSQL, fields
+from trytond.cache import Cache
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+import metrics
+
+__all__ = ['FedexRateCache']
+
+logger = logging.getLogger(__name__)
+
+# Days of quotes the popular lanes are found in
+PREWARM_DAYS = 14
+# Number of lanes pre-warmed at most
+PREWARM_LANES = 300
+
+
+class FedexRateCache(ModelSQL):
+    """
+    FedEx Rate Cache
+
+    Rates returned by FedEx for a lane (origin, destination, weight and
+    FedEx methods), reused until they expire. Each process also keeps the
+    rates it looked up in memory, so that read only transactions (which
+    cannot write here) still benefit from the rates they fetched.
+    """
+    __name__ = 'fedex.rate.cache'
+
+    key = fields.Char('Key', required=True, select=True, readonly=True)
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    service_type = fields.Char('Service Type', readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    currency = fields.Char('Currency', readonly=True)
+    expire = fields.DateTime(
+        'Expire', required=True, select=True, readonly=True
+    )
+
+    _memory_cache = Cache('fedex.rate.cache', context=False)
+
+    @classmethod
+    def get_rates(cls, key):
+        """
+        Returns the rates cached for the key as a list of
+        (service_type, amount, currency_code) or None if there are none.
+        """
+        now = datetime.utcnow()
+
+        cached = cls._memory_cache.get(key)
+        if cached is not None:
+            expire, rates = cached
+            if expire > now:
+                metrics.increment('rate_cache.hit')
+                return rates
+
+        records = cls.search([
+            ('key', '=', key),
+            ('expire', '>', now),
+        ])
+        if not records:
+            metrics.increment('rate_cache.miss')
+            return None
+
+        rates = [
+            (record.service_type, record.amount, record.currency)
+            for record in records
+        ]
+        cls._memory_cache.set(
+            key, (min(record.expire for record in records), rates)
+        )
+        metrics.increment('rate_cache.hit')
+        return rates
+
+    @classmethod
+    def set_rates(cls, key, carrier, rates, ttl, persist=True):
+        """
+        Cache the rates for the key for ttl seconds.
+
+        :param rates: list of (service_type, amount, currency_code)
+        :param persist: If False the rates are only kept in the memory of
+            this process. Use it from read only transactions.
+        """
+        expire = datetime.utcnow() + timedelta(seconds=ttl)
+
+        cls._memory_cache.set(key, (expire, rates))
+        if not persist:
+            return
+
+        cls.delete(cls.search([('key', '=', key)]))
+        cls.create([{
+            'key': key,
+            'carrier': carrier.id,
+            'service_type': service_type,
+            'amount': amount,
+            'currency': currency_code,
+            'expire': expire,
+        } for service_type, amount, currency_code in rates])
+
+    @classmethod
+    def get_cached_keys(cls, keys):
+        """
+        Returns the set of the keys having rates which did not expire
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        now = datetime.utcnow()
+        keys = list(set(keys))
+        cached = set()
+        for i in xrange(0, len(keys), cursor.IN_MAX):
+            cursor.execute(*table.select(
+                table.key,
+                where=table.key.in_(keys[i:i + cursor.IN_MAX])
+                & (table.expire > now),
+            ))
+            cached.update(key for key, in cursor.fetchall())
+        return cached
+
+    @classmethod
+    def get_fedex_popular_lanes(cls, since, limit=PREWARM_LANES):
+        """
+        Returns the domestic lanes the most sales were quoted on since the
+        date, for the carriers caching rates. Shipments are not counted, as
+        they are rated without the rate cache.
+
+        :return: list of (key, count, carrier, lane), the most quoted lane
+            first, where lane is a dictionary of the arguments of
+            get_fedex_rates with the weight rounded up to the pound
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Carrier = pool.get('carrier')
+        Location = pool.get('stock.location')
+        Address = pool.get('party.address')
+        Method = pool.get('fedex.shipment.method')
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().cursor
+        sale = Sale.__table__()
+
+        columns = [
+            sale.carrier, sale.warehouse, sale.shipment_address,
+            sale.fedex_drop_off_type, sale.fedex_packaging_type,
+            sale.fedex_rate_service, sale.currency, sale.fedex_rate_weight,
+        ]
+        cursor.execute(*sale.select(
+            *(columns + [Count(Literal(1))]),
+            where=(sale.fedex_rate_date >= since)
+            & (sale.fedex_rate_weight > 0)
+            & (sale.fedex_rate_service != Null),
+            group_by=columns
+        ))
+        rows = cursor.fetchall()
+
+        def ids(*columns):
+            return list(set(
+                row[column] for row in rows for column in columns
+                if row[column] is not None
+            ))
+
+        carriers = dict(
+            (carrier.id, carrier) for carrier in Carrier.browse(ids(0))
+            if carrier.carrier_cost_method == 'fedex'
+            and carrier.fedex_rate_cache_ttl
+        )
+        warehouses = dict(
+            (warehouse.id, warehouse.address.id)
+            for warehouse in Location.browse(ids(1)) if warehouse.address
+        )
+        addresses = Address.addresses_to_fedex_dicts(Address.browse(
+            list(set(warehouses.values()) | set(ids(2)))
+        ))
+        methods = dict(
+            (method.id, method.value)
+            for method in Method.browse(ids(3, 4, 5))
+        )
+        currencies = dict(
+            (currency.id, currency.code)
+            for currency in Currency.browse(ids(6))
+        )
+
+        lanes = {}
+        for (carrier_id, warehouse_id, address_id, drop_off_type,
+                packaging_type, service_type, currency_id, weight,
+                count) in rows:
+            if carrier_id not in carriers or warehouse_id not in warehouses:
+                continue
+            if None in (
+                    address_id, drop_off_type, packaging_type, currency_id):
+                continue
+            shipper = addresses[warehouses[warehouse_id]]
+            recipient = addresses[address_id]
+            if shipper['country_code'] != recipient['country_code']:
+                # Only domestic rates are cached
+                continue
+            carrier = carriers[carrier_id]
+            lane = {
+                'shipper': shipper,
+                'recipient': recipient,
+                # The pound FedEx bills
+                'weight': float(math.ceil(weight)),
+                'currency_code': currencies[currency_id],
+                'drop_off_type': methods[drop_off_type],
+                'packaging_type': methods[packaging_type],
+                'service_type': methods[service_type],
+            }
+            key = carrier.get_fedex_rate_cache_key(**lane)
+            if key in lanes:
+                lanes[key][1] += count
+            else:
+                lanes[key] = [key, count, carrier, lane]
+
+        lanes = sorted(
+            lanes.values(), key=lambda values: values[1], reverse=True
+        )
+        return [tuple(values) for values in lanes[:limit]]
+
+    @classmethod
+    def prewarm_fedex_rates(cls, days=PREWARM_DAYS, limit=PREWARM_LANES):
+        """
+        Fetches the rates of the lanes most quoted in the last days which
+        are not cached, so that the first quotes of the day on these lanes
+        do not wait for FedEx. Run by a cron before business hours, the
+        rates are kept for the rate cache TTL of the carrier.
+
+        The lanes of a carrier are rated concurrently, through the rate
+        limiter of its accounts. A lane which cannot be rated within
+        fedex_rate_max_wait is left to the quotes.
+
+        :return: dictionary with the number of lanes, lanes warmed and
+            errors, and the expected hit rates of the rate cache before and
+            after, in percent of the quotes made on the lanes
+        """
+        lanes = cls.get_fedex_popular_lanes(
+            datetime.utcnow() - timedelta(days=days), limit
+        )
+        cached = cls.get_cached_keys([key for key, _, _, _ in lanes])
+
+        to_warm = defaultdict(list)
+        for key, _, carrier, lane in lanes:
+            if key not in cached:
+                to_warm[carrier].append((key, lane))
+
+        warmed = set()
+        errors = 0
+        for carrier, carrier_lanes in to_warm.iteritems():
+            transport = carrier.get_fedex_transport()
+
+            def rate(item):
+                key, lane = item
+                return carrier.parse_fedex_rates(transport.send(
+                    partial(carrier.get_fedex_rate_request, **lane),
+                    'prewarm-%s' % key[:8]
+                ))
+
+            for (key, lane), (rates, exc_info) in zip(
+                    carrier_lanes, transport.map(rate, carrier_lanes)):
+                if exc_info is not None:
+                    errors += 1
+                    metrics.increment('rate_cache.prewarm.errors')
+                    logger.warning(
+                        'FedEx rates of lane %s could not be pre-warmed', key,
+                        exc_info=exc_info
+                    )
+                    continue
+                metrics.increment('rate.performed')
+                cls.set_rates(key, carrier, rates, carrier.fedex_rate_cache_ttl)
+                warmed.add(key)
+        metrics.increment('rate_cache.prewarmed', len(warmed))
+
+        quotes = sum(count for _, count, _, _ in lanes)
+
+        def hit_rate(keys):
+            if not quotes:
+                return 0.0
+            return 100.0 * sum(
+                count for key, count, _, _ in lanes if key in keys
+            ) / quotes
+
+        report = {
+            'lanes': len(lanes),
+            'warmed': len(warmed),
+            'errors': errors,
+            'hit_rate_before': hit_rate(cached),
+            'hit_rate_after': hit_rate(cached | warmed),
+        }
+        logger.info(
+            'FedEx rate cache pre-warmed for %(warmed)s of %(lanes)s lanes '
+            '(%(errors)s errors), expected hit rate %(hit_rate_before).1f%% '
+            '-> %(hit_rate_after).1f%%', report
+        )
+        return report
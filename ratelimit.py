@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+    ratelimit.py
+
+    Token bucket limiting the requests sent to FedEx per account. The state
+    of a bucket is kept in a small file locked with flock, so that all the
+    trytond processes of a host share the same bucket.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import hashlib
+import tempfile
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from trytond.config import config
+
+__all__ = ['TokenBucket']
+
+# Used when the platform does not support flock, the bucket is then only
+# shared by the threads of the process.
+_local_lock = Lock()
+_local_state = {}
+
+
+def get_directory():
+    """
+    Returns the directory the bucket files are kept in. All the processes
+    sharing FedEx accounts must use the same directory.
+    """
+    return config.get('fedex', 'ratelimit_path') or tempfile.gettempdir()
+
+
+class TokenBucket(object):
+    """
+    A bucket holding up to `capacity` tokens refilled at `rate` tokens per
+    second. Every request to FedEx takes one token; when the bucket is
+    empty the request waits for the next token instead of failing.
+    """
+
+    def __init__(self, key, rate, capacity, directory=None):
+        self.key = key
+        self.rate = float(rate)
+        self.capacity = float(max(capacity, 1))
+        self.path = os.path.join(
+            directory or get_directory(),
+            'fedex-%s.bucket' % hashlib.sha1(key).hexdigest()
+        )
+
+    def _refill(self, level, stamp, now):
+        return min(self.capacity, level + (now - stamp) * self.rate)
+
+    def _update(self, tokens):
+        """
+        Takes `tokens` from the bucket if it holds enough of them.
+
+        :return: a tuple (seconds to wait before the tokens are available,
+            0 if they were taken, tokens left in the bucket)
+        """
+        def take(state):
+            now = time.time()
+            if state is None:
+                level = self.capacity
+            else:
+                level = self._refill(state[0], state[1], now)
+            if level >= tokens:
+                return 0, level - tokens, now
+            return (tokens - level) / self.rate, level, now
+
+        if fcntl is None:
+            with _local_lock:
+                wait, level, now = take(_local_state.get(self.path))
+                _local_state[self.path] = (level, now)
+            return wait, level
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.read(fd, 64).split()
+            state = len(data) == 2 and map(float, data) or None
+            wait, level, now = take(state)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, '%r %r' % (level, now))
+        finally:
+            os.close(fd)
+        return wait, level
+
+    def acquire(self, timeout=0, tokens=1):
+        """
+        Takes a token, waiting for at most `timeout` seconds for it.
+
+        :return: True if the token was taken, False on timeout
+        """
+        deadline = time.time() + timeout
+        while True:
+            wait, _ = self._update(tokens)
+            if not wait:
+                return True
+            if time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def utilization(self):
+        """
+        Returns the share of the bucket in use, between 0 (idle) and 1
+        (requests are being queued).
+        """
+        _, level = self._update(0)
+        return 1 - level / self.capacity
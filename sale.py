@@ -5,19 +5,54 @@
     :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import logging
+from functools import partial
+from collections import defaultdict
+from datetime import datetime
 from decimal import Decimal
 
 from trytond.model import fields, ModelView
+from trytond.exceptions import UserError
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval
 from trytond.transaction import Transaction
 
-from fedex import RateService
-from fedex.exceptions import RequestError
+import metrics
+from carrier import fedex_fingerprint, format_fedex_problems
+from commodities import CommodityBuilder
+from fedexlib import fedex
+from speculation import speculative_rates, SPECULATION_WAIT
 
 __all__ = ['Configuration', 'Sale']
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger(__name__)
+
+# FedEx services from the fastest to the slowest, to rank rates by speed.
+# The services not listed come last.
+SERVICE_SPEED = (
+    'FIRST_OVERNIGHT', 'PRIORITY_OVERNIGHT', 'STANDARD_OVERNIGHT',
+    'INTERNATIONAL_FIRST', 'INTERNATIONAL_PRIORITY', 'FEDEX_2_DAY_AM',
+    'FEDEX_2_DAY', 'FEDEX_EXPRESS_SAVER', 'INTERNATIONAL_ECONOMY',
+    'FEDEX_GROUND', 'GROUND_HOME_DELIVERY', 'INTERNATIONAL_GROUND',
+    'SMART_POST',
+)
+
+
+# Fields the rating fingerprint of a sale is computed from, sent to the
+# on_change methods which rate the sale in the background
+SPECULATION_DEPENDS = [
+    'state', 'carrier', 'currency', 'warehouse', 'shipment_address',
+    'fedex_drop_off_type', 'fedex_packaging_type', 'fedex_service_type',
+    'weight_uom', 'package_weight', 'lines', 'fedex_rate_fingerprint',
+]
+
+
+def get_service_speed(service_type):
+    if service_type in SERVICE_SPEED:
+        return SERVICE_SPEED.index(service_type)
+    return len(SERVICE_SPEED)
+
 
 class Configuration:
     'Sale Configuration'
@@ -35,6 +70,11 @@ class Configuration:
         'fedex.shipment.method', 'Default Service Type',
         domain=[('method_type', '=', 'service')],
     )
+    fedex_speculative_quotes = fields.Boolean(
+        'Rate FedEx in Background', help='Ask FedEx for the rate of a draft '
+        'sale while it is being edited, so that quoting it does not wait '
+        'for FedEx.'
+    )
 
 
 class Sale:
@@ -73,6 +113,25 @@ class Sale:
         depends=['is_fedex_shipping', 'state']
     )
 
+    # Rate quoted by FedEx, kept so that the shipment does not need to ask
+    # again while the rated inputs (see fedex_rate_fingerprint) are unchanged
+    fedex_rate_service = fields.Many2One(
+        'fedex.shipment.method', 'Quoted Service', readonly=True,
+        domain=[('method_type', '=', 'service')],
+    )
+    fedex_rate_amount = fields.Numeric(
+        'Quoted Amount', digits=(16, 2), readonly=True
+    )
+    fedex_rate_currency = fields.Many2One(
+        'currency.currency', 'Quoted Currency', readonly=True
+    )
+    fedex_rate_fingerprint = fields.Char('Quote Fingerprint', readonly=True)
+    fedex_rate_date = fields.DateTime('Quoted On', readonly=True, select=True)
+    fedex_rate_weight = fields.Float(
+        'Quoted Weight', digits=(16, 2), readonly=True,
+        help='Weight in pounds the quote was made for'
+    )
+
     def get_is_fedex_shipping(self, name):
         return self.carrier and \
             self.carrier.carrier_cost_method == 'fedex' or False
@@ -84,14 +143,21 @@ class Sale:
             'warehouse_address_required': 'Warehouse address is required.',
             'fedex_settings_missing': 'FedEx settings on this sale are missing',
             'fedex_rates_error':
-                "Error while getting rates from Fedex: \n\n%s"
+                "Error while getting rates from Fedex: \n\n%s",
+            'fedex_weight_missing': 'The weight of the sale is zero.',
+            'fedex_invalid':
+                "The following sales cannot be rated by FedEx: \n\n%s",
         })
         self._buttons.update({
             'update_fedex_shipment_cost': {
                 'invisible': Eval('state') != 'quotation'
-            }
+            },
+            'choose_fedex_origin': {
+                'invisible': ~Eval('state').in_(['draft', 'quotation']),
+            },
         })
 
+    @fields.depends(*SPECULATION_DEPENDS)
     def on_change_carrier(self):
         """
         Show/Hide UPS Tab in view on change of carrier
@@ -101,8 +167,24 @@ class Sale:
         res['is_fedex_shipping'] = self.carrier and \
             self.carrier.carrier_cost_method == 'fedex'
 
+        self.speculate_fedex_rate()
         return res
 
+    @classmethod
+    def copy(cls, sales, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.update({
+            'fedex_rate_service': None,
+            'fedex_rate_amount': None,
+            'fedex_rate_currency': None,
+            'fedex_rate_fingerprint': None,
+            'fedex_rate_date': None,
+            'fedex_rate_weight': None,
+        })
+        return super(Sale, cls).copy(sales, default=default)
+
     @staticmethod
     def default_fedex_drop_off_type():
         Config = Pool().get('sale.configuration')
@@ -138,18 +220,104 @@ class Sale:
         context['sale'] = self.id
         return context
 
+    @fields.depends(*SPECULATION_DEPENDS)
     def on_change_lines(self):
         """Pass a flag in context which indicates the get_sale_price method
         of FedEx carrier not to calculate cost on each line change
         """
         with Transaction().set_context({'ignore_carrier_computation': True}):
-            return super(Sale, self).on_change_lines()
+            res = super(Sale, self).on_change_lines()
+        self.speculate_fedex_rate()
+        return res
+
+    def speculate_fedex_rate(self):
+        """
+        Asks FedEx in the background for the rate of the draft sale as it is
+        being edited, if enabled on the sale configuration. The rate is
+        kept by the process for the rating fingerprint of the sale, where
+        get_fedex_shipping_cost finds it when the sale is quoted unchanged.
+
+        Only domestic sales are rated in the background: their rate does
+        not depend on the customs details.
+        """
+        Config = Pool().get('sale.configuration')
+
+        if self.state != 'draft' or not self.carrier or \
+                self.carrier.carrier_cost_method != 'fedex':
+            return
+        if not Config(1).fedex_speculative_quotes:
+            return
+        ship_from_address = self._get_ship_from_address()
+        if not all([
+            self.fedex_drop_off_type, self.fedex_packaging_type,
+            self.fedex_service_type, self.currency, self.shipment_address,
+            ship_from_address,
+        ]):
+            return
+        if ship_from_address.country != self.shipment_address.country:
+            return
+        weight = self._get_fedex_package_weight()
+        if not weight:
+            return
+
+        fingerprint = self.get_fedex_rating_fingerprint()
+        # Not set on a sale being created
+        if fingerprint == getattr(self, 'fedex_rate_fingerprint', None):
+            # Quoted already for these inputs
+            return
+        database_name = Transaction().cursor.database_name
+        carrier = self.carrier
+        transport = carrier.get_fedex_transport()
+        build_request = partial(
+            carrier.get_fedex_rate_request,
+            shipper=ship_from_address.address_to_fedex_dict(),
+            recipient=self.shipment_address.address_to_fedex_dict(),
+            weight=weight, currency_code=self.currency.code,
+            drop_off_type=self.fedex_drop_off_type.value,
+            packaging_type=self.fedex_packaging_type.value,
+            service_type=self.fedex_service_type.value,
+        )
+
+        def rate():
+            response = transport.send(
+                build_request, 'quote-%s' % fingerprint[:8]
+            )
+            return carrier.parse_fedex_rates(response)[0]
+
+        # Only the rate of the last change of a saved sale is kept. The id
+        # of a sale being created is not unique (None or negative in every
+        # client) so its rates are left to expire rather than replacing the
+        # rates of the other new sales.
+        if self.id is not None and self.id >= 0:
+            owner = (database_name, self.id)
+        else:
+            owner = None
+        speculative_rates.submit(
+            (database_name, fingerprint), rate, owner=owner,
+            group=(database_name, carrier.id),
+        )
 
     def apply_fedex_shipping(self):
         "Add a shipping line to sale for fedex"
         Currency = Pool().get('currency.currency')
+        ShippingCost = Pool().get('fedex.shipping.cost')
 
         if self.is_fedex_shipping:
+            # The fingerprint leaves the sale currency out, so the shipping
+            # line is only kept if it still matches the rate in the currency
+            # the sale has now. Otherwise the kept rate is converted again.
+            if self.is_fedex_rate_current() and any(
+                line.product == self.carrier.carrier_product and
+                line.unit_price == Currency.compute(
+                    self.fedex_rate_currency, self.fedex_rate_amount,
+                    self.currency
+                )
+                for line in self.lines if line.type == 'line'
+            ):
+                # Nothing that affects the price changed since the shipping
+                # line was added.
+                metrics.increment('rate.skipped')
+                return
             with Transaction().set_context(self._get_carrier_context()):
                 shipment_cost, currency_id = self.carrier.get_sale_price()
                 if not shipment_cost:
@@ -164,9 +332,12 @@ class Sale:
                     self.carrier.party.name, self.fedex_packaging_type.name
                 )
             )
+            ShippingCost.record_fedex_quotes([(self, shipment_cost)])
 
     @classmethod
     def quote(cls, sales):
+        # A sale must not be quoted without its shipping cost
+        cls.check_fedex_problems(sales)
         res = super(Sale, cls).quote(sales)
         cls.update_fedex_shipment_cost(sales)
         return res
@@ -174,16 +345,250 @@ class Sale:
     @classmethod
     @ModelView.button
     def update_fedex_shipment_cost(cls, sales):
+        problems = cls.get_fedex_problems(sales)
+        if problems and len(problems) == len(sales):
+            cls.check_fedex_problems(sales)
         for sale in sales:
+            if sale.id in problems:
+                # FedEx would refuse it, do not keep the others waiting
+                metrics.increment('validation.skipped')
+                continue
             sale.apply_fedex_shipping()
 
+    @classmethod
+    def get_fedex_problems(cls, sales):
+        """
+        Checks, without sending anything, that FedEx can rate the sales
+        shipped by FedEx. The sales, their addresses and carriers are read
+        together, so checking a large batch only takes a few queries.
+
+        :return: dictionary mapping the id of each sale with problems to
+            the list of its problems
+        """
+        Address = Pool().get('party.address')
+
+        sales = cls.browse([
+            sale.id for sale in sales if sale.is_fedex_shipping
+        ])
+
+        addresses = set()
+        for sale in sales:
+            addresses.add(sale.shipment_address)
+            addresses.add(sale._get_ship_from_address())
+        addresses.discard(None)
+        # The phone numbers are only needed for the labels
+        address_problems = Address.get_fedex_address_problems(
+            list(addresses), phone=False
+        )
+        # The valid records are sent next, read their addresses together
+        Address.addresses_to_fedex_dicts(list(addresses))
+
+        carrier_problems = {}
+        problems = {}
+        for sale in sales:
+            messages = []
+            if sale.carrier not in carrier_problems:
+                carrier_problems[sale.carrier] = \
+                    sale.carrier.get_fedex_problems()
+            messages.extend(carrier_problems[sale.carrier])
+            if not all([
+                sale.fedex_drop_off_type, sale.fedex_packaging_type,
+                sale.fedex_service_type
+            ]):
+                messages.append(cls.raise_user_error(
+                    'fedex_settings_missing', raise_exception=False
+                ))
+            ship_from_address = sale._get_ship_from_address()
+            if ship_from_address is None:
+                messages.append(cls.raise_user_error(
+                    'warehouse_address_required', raise_exception=False
+                ))
+            for address in (ship_from_address, sale.shipment_address):
+                if address is not None and address.id in address_problems:
+                    messages.extend(
+                        '%s: %s' % (address.rec_name, message)
+                        for message in address_problems[address.id]
+                    )
+            if not sale.package_weight:
+                messages.append(cls.raise_user_error(
+                    'fedex_weight_missing', raise_exception=False
+                ))
+            if messages:
+                problems[sale.id] = messages
+        return problems
+
+    @classmethod
+    def check_fedex_problems(cls, sales):
+        """
+        Raises an error listing the problems of the sales which FedEx
+        cannot rate
+        """
+        problems = cls.get_fedex_problems(sales)
+        if problems:
+            cls.raise_user_error('fedex_invalid', error_args=(
+                format_fedex_problems(sales, problems),
+            ))
+
+    @classmethod
+    def get_fedex_origin_rates(cls, sales, warehouses=None, rank='cheapest'):
+        """
+        Rates the sales shipped from each warehouse, for all the services
+        FedEx offers on the lanes. The rates of all the sales and
+        warehouses are asked for at the same time and the rate cache of the
+        carrier is used, so it takes about as long as a single quote.
+
+        :param warehouses: warehouses the sales can be shipped from, all the
+            warehouses with an address by default
+        :param rank: 'cheapest' or 'fastest'
+        :return: dictionary mapping the id of each sale to a list of
+            (warehouse id, service type, amount, currency code), the best
+            first, with the amounts in the currency of the sale
+        """
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Address = pool.get('party.address')
+        Currency = pool.get('currency.currency')
+        Method = pool.get('fedex.shipment.method')
+
+        cls.check_fedex_problems(sales)
+        sales = cls.browse([
+            sale.id for sale in sales if sale.is_fedex_shipping
+        ])
+
+        if warehouses is None:
+            warehouses = Location.search([
+                ('type', '=', 'warehouse'),
+                ('address', '!=', None),
+            ])
+        warehouses = [
+            warehouse for warehouse in warehouses if warehouse.address
+        ]
+        address_problems = Address.get_fedex_address_problems([
+            warehouse.address for warehouse in warehouses
+        ], phone=False)
+        warehouses = [
+            warehouse for warehouse in warehouses
+            if warehouse.address.id not in address_problems
+        ]
+        addresses = Address.addresses_to_fedex_dicts(
+            [warehouse.address for warehouse in warehouses]
+            + [sale.shipment_address for sale in sales]
+        )
+
+        # Send all the requests before waiting for any
+        futures = []
+        for sale in sales:
+            weight = sale._get_fedex_package_weight()
+            for warehouse in warehouses:
+                futures.append((sale, warehouse, sale.carrier.async_get_rates(
+                    addresses[warehouse.address.id],
+                    addresses[sale.shipment_address.id], weight,
+                    sale.currency.code, sale.fedex_drop_off_type.value,
+                    sale.fedex_packaging_type.value,
+                )))
+
+        services = set(
+            method.value for method in Method.search([
+                ('method_type', '=', 'service'),
+            ])
+        )
+        currencies = {}
+        results = dict((sale.id, []) for sale in sales)
+        for sale, warehouse, future in futures:
+            try:
+                rates = future.result()
+            except UserError, exc:
+                # The other warehouses may still ship the sale
+                metrics.increment('rate.origin.errors')
+                logger.warning(
+                    'FedEx could not rate sale %s from warehouse %s: %s',
+                    sale.id, warehouse.id, exc.message
+                )
+                continue
+            for service_type, amount, currency_code in rates:
+                if service_type not in services:
+                    continue
+                if currency_code != sale.currency.code:
+                    if currency_code not in currencies:
+                        currencies[currency_code], = Currency.search([
+                            ('code', '=', currency_code),
+                        ])
+                    amount = Currency.compute(
+                        currencies[currency_code], amount, sale.currency
+                    )
+                results[sale.id].append((
+                    warehouse.id, service_type, amount, sale.currency.code
+                ))
+
+        def key(rate):
+            _, service_type, amount, _ = rate
+            speed = get_service_speed(service_type)
+            if rank == 'fastest':
+                return speed, amount
+            return amount, speed
+
+        for options in results.itervalues():
+            options.sort(key=key)
+        return results
+
+    @classmethod
+    @ModelView.button
+    def choose_fedex_origin(cls, sales, rank='cheapest'):
+        """
+        Ships each sale from the warehouse and with the service of its best
+        rate (see get_fedex_origin_rates) and updates its shipping line
+        with that rate.
+        """
+        Method = Pool().get('fedex.shipment.method')
+        ShippingCost = Pool().get('fedex.shipping.cost')
+
+        results = cls.get_fedex_origin_rates(sales, rank=rank)
+        methods = dict(
+            (method.value, method) for method in Method.search([
+                ('method_type', '=', 'service'),
+            ])
+        )
+
+        chosen = {}
+        to_write = defaultdict(list)
+        for sale_id, options in results.iteritems():
+            if not options:
+                continue
+            warehouse_id, service_type, amount, _ = options[0]
+            chosen[sale_id] = amount
+            to_write[(warehouse_id, methods[service_type].id)].append(
+                cls(sale_id)
+            )
+        if not to_write:
+            return
+        args = []
+        for (warehouse_id, method_id), records in to_write.iteritems():
+            args.extend((records, {
+                'warehouse': warehouse_id,
+                'fedex_service_type': method_id,
+            }))
+        cls.write(*args)
+
+        sales = cls.browse(chosen.keys())
+        for sale in sales:
+            # The rate is the one of the new inputs, no need to ask again
+            sale.set_fedex_rate(chosen[sale.id], sale.currency)
+            sale.add_shipping_line(
+                chosen[sale.id],
+                "%s - %s" % (
+                    sale.carrier.party.name, sale.fedex_packaging_type.name
+                )
+            )
+        ShippingCost.record_fedex_quotes([
+            (sale, chosen[sale.id]) for sale in sales
+        ])
+
     def get_fedex_shipping_cost(self):
         """Returns the calculated shipping cost as sent by fedex
         :returns: The shipping cost in USD
         """
         Currency = Pool().get('currency.currency')
-
-        fedex_credentials = self.carrier.get_fedex_credentials()
+        RateCache = Pool().get('fedex.rate.cache')
 
         if not all([
             self.fedex_drop_off_type, self.fedex_packaging_type,
@@ -191,7 +596,81 @@ class Sale:
         ]):
             self.raise_user_error('fedex_settings_missing')
 
-        rate_request = RateService(fedex_credentials)
+        if self.is_fedex_rate_current():
+            metrics.increment('rate.skipped')
+            return self.fedex_rate_amount, self.fedex_rate_currency.id
+
+        ship_from_address = self._get_ship_from_address()
+        # From location is the warehouse location. So it must be filled.
+        if ship_from_address is None:
+            self.raise_user_error('warehouse_address_required')
+
+        # The rate may have been asked for while the sale was edited
+        rate = speculative_rates.get((
+            Transaction().cursor.database_name,
+            self.get_fedex_rating_fingerprint(),
+        ), SPECULATION_WAIT)
+        if rate is not None:
+            metrics.increment('rate.speculative.hit')
+            _, amount, currency_code = rate
+            currency, = Currency.search([('code', '=', currency_code)])
+            self.set_fedex_rate(amount, currency)
+            return amount, currency.id
+
+        # Domestic rates only depend on the lane and the weight, so a rate
+        # cached for another sale on the same lane can be used.
+        cache_key = None
+        if self.carrier.fedex_rate_cache_ttl and \
+                not self.is_international_shipping:
+            cache_key = self.carrier.get_fedex_rate_cache_key(
+                ship_from_address.address_to_fedex_dict(),
+                self.shipment_address.address_to_fedex_dict(),
+                self._get_fedex_package_weight(), self.currency.code,
+                self.fedex_drop_off_type.value,
+                self.fedex_packaging_type.value,
+                self.fedex_service_type.value,
+            )
+            rates = RateCache.get_rates(cache_key)
+            if rates:
+                _, amount, currency_code = rates[0]
+                currency, = Currency.search([('code', '=', currency_code)])
+                self.set_fedex_rate(amount, currency)
+                return amount, currency.id
+
+        try:
+            response = self.carrier.send_fedex_request(
+                self.get_fedex_rate_request, int(self.id)
+            )
+        except fedex.RequestError, exc:
+            self.raise_user_error(
+                'fedex_rates_error', error_args=(exc.message, )
+            )
+        metrics.increment('rate.performed')
+
+        currency, = Currency.search([
+            ('code', '=', str(
+                response.RateReplyDetails[0].RatedShipmentDetails[0].
+                ShipmentRateDetail.TotalNetCharge.Currency
+            ))
+        ])
+        amount = Decimal(str(
+            response.RateReplyDetails[0].RatedShipmentDetails[0].
+            ShipmentRateDetail.TotalNetCharge.Amount)
+        )
+
+        if cache_key:
+            RateCache.set_rates(cache_key, self.carrier, [(
+                self.fedex_service_type.value, amount, currency.code
+            )], self.carrier.fedex_rate_cache_ttl)
+
+        self.set_fedex_rate(amount, currency)
+        return amount, currency.id
+
+    def get_fedex_rate_request(self, fedex_credentials):
+        """
+        Returns the request rating the sale with the given credentials
+        """
+        rate_request = fedex.RateService(fedex_credentials)
         requested_shipment = rate_request.RequestedShipment
 
         requested_shipment.DropoffType = self.fedex_drop_off_type.value
@@ -204,10 +683,6 @@ class Sale:
             fedex_credentials.AccountNumber
 
         ship_from_address = self._get_ship_from_address()
-        # From location is the warehouse location. So it must be filled.
-        if ship_from_address is None:
-            self.raise_user_error('warehouse_address_required')
-
         ship_from_address.set_fedex_address(requested_shipment.Shipper)
         self.shipment_address.set_fedex_address(requested_shipment.Recipient)
 
@@ -240,24 +715,75 @@ class Sale:
 
         self.get_fedex_items_details(rate_request)
 
-        try:
-            response = rate_request.send_request(int(self.id))
-        except RequestError, exc:
-            self.raise_user_error(
-                'fedex_rates_error', error_args=(exc.message, )
-            )
+        return rate_request
 
-        currency, = Currency.search([
-            ('code', '=', str(
-                response.RateReplyDetails[0].RatedShipmentDetails[0].
-                ShipmentRateDetail.TotalNetCharge.Currency
-            ))
-        ])
+    def set_fedex_rate(self, amount, currency):
+        """
+        Keep the rate FedEx returned for the current inputs of the sale
+        """
+        self.__class__.write([self], {
+            'fedex_rate_service': self.fedex_service_type.id,
+            'fedex_rate_amount': amount,
+            'fedex_rate_currency': currency.id,
+            'fedex_rate_fingerprint': self.get_fedex_rating_fingerprint(),
+            'fedex_rate_date': datetime.utcnow(),
+            'fedex_rate_weight': round(self._get_fedex_package_weight(), 2),
+        })
 
-        return Decimal(str(
-            response.RateReplyDetails[0].RatedShipmentDetails[0].
-            ShipmentRateDetail.TotalNetCharge.Amount)
-        ), currency.id
+    def is_fedex_rate_current(self):
+        """
+        Returns True if the last FedEx rate of the sale was computed from the
+        inputs the sale has now, so that it can be used without asking FedEx
+        again. Rating can be forced with `fedex_force_rating` in the context.
+        """
+        if Transaction().context.get('fedex_force_rating'):
+            return False
+        if not self.fedex_rate_fingerprint or self.fedex_rate_amount is None:
+            return False
+        if not all([
+            self.fedex_drop_off_type, self.fedex_packaging_type,
+            self.fedex_service_type, self.shipment_address,
+            self._get_ship_from_address(),
+        ]):
+            return False
+        return self.fedex_rate_fingerprint == \
+            self.get_fedex_rating_fingerprint()
+
+    def get_fedex_rating_fingerprint(self):
+        """
+        Returns the fingerprint of the inputs the FedEx rate of this sale
+        is computed from. It is comparable with the fingerprint of the
+        shipments created from the sale.
+
+        The currency is left out: the rate is kept with the currency FedEx
+        returned it in and converted where it is used, so a shipment costed
+        in another currency than the sale still reuses the quote.
+        """
+        ship_from_address = self._get_ship_from_address()
+
+        contents = defaultdict(float)
+        for line in self.lines:
+            if line.type != 'line' or not line.product or \
+                    line.product.type == 'service':
+                continue
+            contents[line.product.id] += line.quantity
+
+        return fedex_fingerprint((
+            self.carrier.id,
+            self.fedex_drop_off_type.value,
+            self.fedex_packaging_type.value,
+            self.fedex_service_type.value,
+            ship_from_address and sorted(
+                ship_from_address.address_to_fedex_dict().items()
+            ),
+            sorted(self.shipment_address.address_to_fedex_dict().items()),
+            # A sale is always rated as a single package
+            [round(self._get_fedex_package_weight(), 2)],
+            sorted(
+                (product, round(quantity, 4))
+                for product, quantity in contents.items()
+            ),
+        ))
 
     def get_fedex_customs_details(self, fedex_request):
         """
@@ -270,36 +796,28 @@ class Sale:
         )
         customs_detail.DocumentContent = 'DOCUMENTS_ONLY'
 
-        # Encoding Items for customs
-        commodities = []
-        customs_value = 0
+        weight_uom, = ProductUom.search([('symbol', '=', 'lb')])
+        currency_code = self.company.currency.code
+
+        # Encoding Items for customs, repeated products are declared once
+        builder = CommodityBuilder()
         for line in self.lines:
-            if line.product.type == 'service':
+            if not line.product or line.product.type == 'service':
                 continue
-
-            weight_uom, = ProductUom.search([('symbol', '=', 'lb')])
-
-            commodity = fedex_request.get_element_from_type('Commodity')
-            commodity.NumberOfPieces = len(self.lines)
-            commodity.Name = line.product.name
-            commodity.Description = line.description
-            commodity.CountryOfManufacture = \
-                self.warehouse.address.country.code
-            commodity.Weight.Units = 'LB'
-            commodity.Weight.Value = line.get_weight(weight_uom)
-            commodity.Quantity = int(line.product.quantity)
-            commodity.QuantityUnits = 'EA'
-            commodity.UnitPrice.Amount = int(line.unit_price)
-            commodity.UnitPrice.Currency = self.company.currency.code
-            commodity.CustomsValue.Currency = self.company.currency.code
-            commodity.CustomsValue.Amount = int(
-                Decimal(str(line.quantity)) * line.unit_price
+            template = line.product.template
+            builder.add(
+                line.product.id, line.product.name, line.description,
+                template.fedex_harmonized_code,
+                (template.fedex_country_of_origin or
+                    self.warehouse.address.country).code,
+                line.quantity, line.unit_price, line.get_weight(weight_uom),
             )
-            commodities.append(commodity)
-            customs_value += Decimal(str(line.quantity)) * line.unit_price
+        commodities = builder.get_fedex_commodities(
+            fedex_request, currency_code
+        )
 
-        customs_detail.CustomsValue.Currency = self.company.currency.code
-        customs_detail.CustomsValue.Amount = int(customs_value)
+        customs_detail.CustomsValue.Currency = currency_code
+        customs_detail.CustomsValue.Amount = builder.customs_value
 
         fedex_request.RequestedShipment.CustomsClearanceDetail = customs_detail
         fedex_request.RequestedShipment.CustomsClearanceDetail.Commodities = \
@@ -315,17 +833,12 @@ class Sale:
         '''
         Computes the details of the shipment items and passes to fedex request
         '''
-        ProductUom = Pool().get('product.uom')
-
         item = fedex_request.get_element_from_type(
             'RequestedPackageLineItem'
         )
-        weight_uom, = ProductUom.search([('symbol', '=', 'lb')])
         item.SequenceNumber = 1
         item.Weight.Units = 'LB'
-        item.Weight.Value = ProductUom.compute_qty(
-            self.weight_uom, self.package_weight, weight_uom
-        )
+        item.Weight.Value = self._get_fedex_package_weight()
 
         # From sale you cannot define packages per shipment, so single
         # package per shipment.
@@ -334,6 +847,18 @@ class Sale:
 
         fedex_request.RequestedShipment.RequestedPackageLineItems = [item]
 
+    def _get_fedex_package_weight(self):
+        """
+        Returns the weight of the single package a sale is rated as, in
+        pounds.
+        """
+        ProductUom = Pool().get('product.uom')
+
+        weight_uom, = ProductUom.search([('symbol', '=', 'lb')])
+        return ProductUom.compute_qty(
+            self.weight_uom, self.package_weight or 0, weight_uom
+        )
+
     def create_shipment(self, shipment_type):
         Shipment = Pool().get('stock.shipment.out')
 
@@ -345,5 +870,16 @@ class Sale:
                 'fedex_drop_off_type': self.fedex_drop_off_type.id,
                 'fedex_packaging_type': self.fedex_packaging_type.id,
                 'fedex_service_type': self.fedex_service_type.id,
+                # Carry the quote along, the shipment reuses it as long as
+                # packages and addresses match what was rated.
+                'fedex_rate_service': (
+                    self.fedex_rate_service and self.fedex_rate_service.id
+                ),
+                'fedex_rate_amount': self.fedex_rate_amount,
+                'fedex_rate_currency': (
+                    self.fedex_rate_currency and self.fedex_rate_currency.id
+                ),
+                'fedex_rate_fingerprint': self.fedex_rate_fingerprint,
+                'fedex_rate_date': self.fedex_rate_date,
             })
         return shipments
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+    shipping_cost.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from decimal import Decimal
+from datetime import datetime
+
+from sql import Literal
+from sql.aggregate import Count, Sum
+
+from trytond import backend
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+__all__ = ['FedexShippingCost']
+
+# Columns the report can group the costs by
+REPORT_GROUPS = ('lane', 'service_type', 'carrier')
+
+
+def get_fedex_lane(shipper, recipient):
+    """
+    Returns the lane of a shipment as text, from the parts of the address
+    dictionaries (see address_to_fedex_dict) FedEx prices on
+    """
+    return '%s %s > %s %s' % (
+        shipper['country_code'], shipper['postal_code'] or '',
+        recipient['country_code'], recipient['postal_code'] or '',
+    )
+
+
+class FedexShippingCost(ModelSQL, ModelView):
+    """
+    FedEx Shipping Cost
+
+    What a sale charged the customer for shipping by FedEx next to what
+    FedEx billed for its shipments. A record is kept by sale and updated
+    when the sale is quoted and when the labels of its shipments are made
+    or voided, so that the costs can be compared without joining the sale
+    lines and the shipments.
+    """
+    __name__ = 'fedex.shipping.cost'
+    _rec_name = 'lane'
+
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, select=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, select=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    service_type = fields.Char('Service Type', select=True, readonly=True)
+    lane = fields.Char('Lane', required=True, select=True, readonly=True)
+    origin_country = fields.Char('Origin Country', readonly=True)
+    destination_country = fields.Char('Destination Country', readonly=True)
+    quote_date = fields.Date(
+        'Quote Date', required=True, select=True, readonly=True
+    )
+    quoted_weight = fields.Float(
+        'Quoted Weight', digits=(16, 2), readonly=True,
+        help='Weight in pounds the sale was quoted for'
+    )
+    quoted_amount = fields.Numeric(
+        'Quoted Amount', digits=(16, 2), readonly=True,
+        help='Shipping charged on the sale'
+    )
+    label_date = fields.DateTime('Label Date', readonly=True)
+    shipment_count = fields.Integer('Shipments Labeled', readonly=True)
+    billed_weight = fields.Float(
+        'Billed Weight', digits=(16, 2), readonly=True,
+        help='Weight in pounds of the packages labeled'
+    )
+    billed_amount = fields.Numeric(
+        'Billed Amount', digits=(16, 2), readonly=True,
+        help='Cost of the labels in the currency of the sale'
+    )
+    currency = fields.Many2One(
+        'currency.currency', 'Currency', required=True, readonly=True
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(FedexShippingCost, cls).__setup__()
+        cls._order.insert(0, ('quote_date', 'DESC'))
+        cls.__rpc__.update({
+            'get_fedex_cost_report': RPC(),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(FedexShippingCost, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        # Costs of a lane over a period
+        table.index_action(['lane', 'quote_date'], 'add')
+
+    @classmethod
+    def record_fedex_quotes(cls, quotes):
+        """
+        Keeps the shipping charged on the sales when they are quoted.
+
+        :param quotes: list of (sale, amount in the currency of the sale)
+        """
+        Address = Pool().get('party.address')
+
+        sales = [sale for sale, _ in quotes]
+        records = dict(
+            (record.sale.id, record)
+            for record in cls.search([('sale', 'in', [s.id for s in sales])])
+        )
+        ship_from_addresses = [sale._get_ship_from_address() for sale in sales]
+        addresses = Address.addresses_to_fedex_dicts(
+            [address for address in ship_from_addresses if address]
+            + [sale.shipment_address for sale in sales]
+        )
+
+        today = datetime.utcnow().date()
+        to_create, to_write = [], []
+        for (sale, amount), ship_from_address in zip(
+                quotes, ship_from_addresses):
+            if ship_from_address is None:
+                continue
+            shipper = addresses[ship_from_address.id]
+            recipient = addresses[sale.shipment_address.id]
+            values = {
+                'carrier': sale.carrier.id,
+                'service_type': sale.fedex_service_type.value,
+                'lane': get_fedex_lane(shipper, recipient),
+                'origin_country': shipper['country_code'],
+                'destination_country': recipient['country_code'],
+                'quote_date': today,
+                'quoted_weight': round(sale._get_fedex_package_weight(), 2),
+                'quoted_amount': amount,
+                'currency': sale.currency.id,
+            }
+            if sale.id in records:
+                to_write.extend(([records[sale.id]], values))
+            else:
+                values['sale'] = sale.id
+                to_create.append(values)
+        if to_write:
+            cls.write(*to_write)
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def record_fedex_labels(cls, shipments):
+        """
+        Updates the cost billed for the sales of the shipments when their
+        labels are made or voided. Only the records of these sales are
+        computed again.
+        """
+        Currency = Pool().get('currency.currency')
+
+        sale_ids = set()
+        for shipment in shipments:
+            for move in shipment.outgoing_moves:
+                origin = move.origin
+                if origin and origin.__name__ == 'sale.line':
+                    sale_ids.add(origin.sale.id)
+        if not sale_ids:
+            return
+        records = cls.search([('sale', 'in', list(sale_ids))])
+
+        now = datetime.utcnow()
+        to_write = []
+        for record in records:
+            sale = record.sale
+            count, weight, amount = 0, 0.0, Decimal('0')
+            for shipment in sale.shipments:
+                if not shipment.tracking_number or \
+                        shipment.state == 'cancel':
+                    continue
+                count += 1
+                weight += sum(shipment._get_fedex_weights())
+                if shipment.cost and shipment.cost_currency:
+                    amount += Currency.compute(
+                        shipment.cost_currency, shipment.cost, sale.currency
+                    )
+            to_write.extend(([record], {
+                'label_date': now if count else None,
+                'shipment_count': count,
+                'billed_weight': round(weight, 2),
+                'billed_amount': amount,
+            }))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def get_fedex_cost_report(
+        cls, date_from, date_to, group_by='lane', lane=None, carrier=None
+    ):
+        """
+        Compares what was charged and billed for the sales quoted between
+        the two dates, with one query on the shipping costs.
+
+        :param group_by: one of REPORT_GROUPS
+        :param lane: only report on this lane
+        :param carrier: only report on the carrier with this id
+        :return: list of dictionaries with the group, currency (id), sales,
+            labeled (sales with labels), quoted_weight, billed_weight,
+            quoted_amount, billed_amount and margin, the largest billed
+            amount first
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        assert group_by in REPORT_GROUPS
+        column = getattr(table, group_by)
+        where = (table.quote_date >= date_from) & (table.quote_date <= date_to)
+        if lane is not None:
+            where &= table.lane == lane
+        if carrier is not None:
+            where &= table.carrier == carrier
+
+        cursor.execute(*table.select(
+            column, table.currency, Count(Literal(1)),
+            Count(table.label_date), Sum(table.quoted_weight),
+            Sum(table.billed_weight), Sum(table.quoted_amount),
+            Sum(table.billed_amount),
+            where=where,
+            group_by=[column, table.currency],
+        ))
+        report = []
+        for (group, currency, sales, labeled, quoted_weight, billed_weight,
+                quoted_amount, billed_amount) in cursor.fetchall():
+            # SQLite returns the sums of numerics as float
+            quoted_amount = Decimal(str(quoted_amount or 0))
+            billed_amount = Decimal(str(billed_amount or 0))
+            report.append({
+                'group': group,
+                'currency': currency,
+                'sales': sales,
+                'labeled': labeled,
+                'quoted_weight': quoted_weight or 0.0,
+                'billed_weight': billed_weight or 0.0,
+                'quoted_amount': quoted_amount,
+                'billed_amount': billed_amount,
+                'margin': quoted_amount - billed_amount,
+            })
+        report.sort(key=lambda row: row['billed_amount'], reverse=True)
+        return report
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+    speculation.py
+
+    Rates asked for in the background while a sale is being edited, so that
+    the quote usually finds its rate ready. The rates are fetched by threads
+    without a transaction, so they are kept in the memory of the process,
+    keyed by the database and the rating fingerprint of the sale.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from threading import Lock
+from collections import OrderedDict, defaultdict
+from multiprocessing import TimeoutError
+
+import metrics
+from transport import get_pool
+
+__all__ = ['SpeculativeRates', 'speculative_rates']
+
+# Seconds a rate fetched in the background is used for a quote
+SPECULATION_TTL = 600
+# Rates kept by a process at most, the oldest are dropped first
+SPECULATION_SIZE = 1000
+# Seconds a quote waits for the rate of its sale still being fetched, rather
+# than asking FedEx again
+SPECULATION_WAIT = 30
+# Rates of a carrier being fetched at the same time at most, so that editing
+# sales does not take the requests of the carrier from the quotes
+SPECULATION_MAX_PENDING = 4
+
+
+class SpeculativeRates(object):
+    """
+    The rates being fetched or fetched in the background, by key.
+
+    :param size: number of rates kept at most
+    :param ttl: seconds a rate is used after it was asked for
+    :param max_pending: number of rates of a group (eg: a carrier) being
+        fetched at the same time at most
+    """
+
+    def __init__(
+        self, size=SPECULATION_SIZE, ttl=SPECULATION_TTL,
+        max_pending=SPECULATION_MAX_PENDING
+    ):
+        self.size = size
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        # The key of the last value submitted by each owner
+        self._owners = OrderedDict()
+        # The values of each group still being fetched
+        self._pending = defaultdict(list)
+
+    def submit(self, key, function, owner=None, group=None):
+        """
+        Calls function in the pool of threads sending requests and keeps its
+        return value for key, unless a value for key is already being
+        fetched or still fresh. The function must not use the ORM.
+
+        :param owner: what the value is for (eg: a sale being edited), the
+            value submitted before for the same owner is dropped as it will
+            not be used
+        :param group: the value is not submitted while max_pending values
+            of the group are being fetched
+        :return: True if the function was submitted
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return False
+            if group is not None:
+                pending = [
+                    result for result in self._pending[group]
+                    if not result.ready()
+                ]
+                self._pending[group] = pending
+                capped = len(pending) >= self.max_pending
+            else:
+                capped = False
+            if not capped:
+                if owner is not None:
+                    previous = self._owners.pop(owner, None)
+                    if previous is not None and previous != key:
+                        self._entries.pop(previous, None)
+                    self._owners[owner] = key
+                    while len(self._owners) > self.size:
+                        self._owners.popitem(last=False)
+                self._entries.pop(key, None)
+                while len(self._entries) >= self.size:
+                    self._entries.popitem(last=False)
+                async_result = get_pool().apply_async(function)
+                self._entries[key] = (now + self.ttl, async_result)
+                if group is not None:
+                    pending.append(async_result)
+        if capped:
+            metrics.increment('rate.speculative.capped')
+            return False
+        metrics.increment('rate.speculative.sent')
+        return True
+
+    def get(self, key, timeout=0):
+        """
+        Returns the value fetched for key, or None if there is none, it
+        expired or it failed. A value still being fetched is waited for
+        timeout seconds at most.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expire, async_result = entry
+        try:
+            value = async_result.get(timeout)
+        except TimeoutError:
+            return None
+        except Exception:
+            # The quote sends its own request and reports the error
+            metrics.increment('rate.speculative.errors')
+            self.discard(key)
+            return None
+        if expire <= time.time():
+            self.discard(key)
+            return None
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+            self._pending.clear()
+
+
+speculative_rates = SpeculativeRates()
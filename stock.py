@@ -5,23 +5,39 @@
     :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+from collections import defaultdict
+from datetime import datetime
 from decimal import Decimal
+from functools import partial
 import base64
 
-from trytond.model import ModelView, fields
+from sql.conditionals import Case
+from sql.functions import CurrentTimestamp
+
+from trytond.model import ModelView, Workflow, fields
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Eval
+from trytond.pyson import Eval, Bool
 from trytond.rpc import RPC
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
 
-from fedex import RateService, ProcessShipmentRequest
-from fedex.exceptions import RequestError
-
+import metrics
+from carrier import (
+    fedex_fingerprint, format_fedex_problems, clear_fedex_cache
+)
+from commodities import CommodityBuilder
+from fedexlib import fedex
+from transport import FedexFuture, gather_futures
 
 __all__ = [
     'ShipmentOut', 'GenerateFedexLabelMessage', 'GenerateShippingLabel',
+    'VoidFedexLabelsStart', 'VoidFedexLabelsResult', 'VoidFedexLabels',
 ]
 __metaclass__ = PoolMeta
 
+# Services whose shipments are identified by a Ground tracking number
+GROUND_SERVICES = ('FEDEX_GROUND', 'GROUND_HOME_DELIVERY')
+
 
 class ShipmentOut:
     "Shipment Out"
@@ -59,6 +75,67 @@ class ShipmentOut:
         depends=['is_fedex_shipping', 'state']
     )
 
+    # Last FedEx rate for this shipment, carried over from the sale quote
+    # when the shipment is created.
+    fedex_rate_service = fields.Many2One(
+        'fedex.shipment.method', 'Quoted Service', readonly=True,
+        domain=[('method_type', '=', 'service')],
+    )
+    fedex_rate_amount = fields.Numeric(
+        'Quoted Amount', digits=(16, 2), readonly=True
+    )
+    fedex_rate_currency = fields.Many2One(
+        'currency.currency', 'Quoted Currency', readonly=True
+    )
+    fedex_rate_fingerprint = fields.Char('Quote Fingerprint', readonly=True)
+    fedex_rate_date = fields.DateTime('Quoted On', readonly=True, select=True)
+    fedex_rate_weight = fields.Float(
+        'Quoted Weight', digits=(16, 2), readonly=True,
+        help='Weight in pounds the quote was made for'
+    )
+    fedex_account_number = fields.Char(
+        'FedEx Account', readonly=True, select=True,
+        help='Account the labels of the shipment were generated with'
+    )
+    fedex_delivered = fields.Boolean(
+        'Delivered by FedEx', readonly=True, select=True,
+        help='All the packages of the shipment were delivered'
+    )
+    fedex_delivery_date = fields.DateTime('FedEx Delivery Date', readonly=True)
+    fedex_open_shipment = fields.Boolean(
+        'Label Packages When Packed',
+        states={
+            'readonly': Bool(Eval('fedex_master_tracking_number')),
+        },
+        depends=['fedex_master_tracking_number'],
+        help='The packages are labeled as they are packed, with the Label '
+        'New Packages button, and the shipment is completed with FedEx when '
+        'it is packed.'
+    )
+    fedex_package_count = fields.Integer(
+        'Expected Packages',
+        states={
+            'required': Bool(Eval('fedex_open_shipment')),
+            'invisible': ~Eval('fedex_open_shipment'),
+            'readonly': Bool(Eval('fedex_master_tracking_number')),
+        },
+        depends=['fedex_open_shipment', 'fedex_master_tracking_number'],
+        help='Number of packages of the shipment, announced to FedEx with '
+        'the first label'
+    )
+    fedex_master_tracking_number = fields.Char(
+        'Master Tracking Number', readonly=True
+    )
+    fedex_label_date = fields.DateTime(
+        'FedEx Label Date', readonly=True,
+        help='When the labels of the shipment were saved, the shipment is '
+        'closed with the first close made after'
+    )
+    fedex_close = fields.Many2One(
+        'fedex.close', 'FedEx Close', readonly=True, select=True,
+        help='End of day close the shipment was handed over with'
+    )
+
     def get_is_fedex_shipping(self, name):
         """
         Check if shipping is from fedex
@@ -66,6 +143,35 @@ class ShipmentOut:
         return self.carrier and \
             self.carrier.carrier_cost_method == 'fedex' or False
 
+    @classmethod
+    def copy(cls, shipments, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.update({
+            'fedex_rate_service': None,
+            'fedex_rate_amount': None,
+            'fedex_rate_currency': None,
+            'fedex_rate_fingerprint': None,
+            'fedex_rate_date': None,
+            'fedex_rate_weight': None,
+            'fedex_account_number': None,
+            'fedex_delivered': False,
+            'fedex_delivery_date': None,
+            'fedex_master_tracking_number': None,
+            'fedex_label_date': None,
+            'fedex_close': None,
+        })
+        return super(ShipmentOut, cls).copy(shipments, default=default)
+
+    @staticmethod
+    def default_fedex_delivered():
+        return False
+
+    @staticmethod
+    def default_fedex_open_shipment():
+        return False
+
     @staticmethod
     def default_fedex_drop_off_type():
         Config = Pool().get('sale.configuration')
@@ -103,11 +209,32 @@ class ShipmentOut:
                 'shipment is in Packed or Done states only',
             'wrong_carrier': 'Carrier for selected shipment is not FedEx',
             'fedex_shipping_cost_error':
-                'Error while getting shipping cost from Fedex: \n\n%s'
+                'Error while getting shipping cost from Fedex: \n\n%s',
+            'fedex_packages_missing': 'The shipment has no packages.',
+            'fedex_package_weight_missing':
+                'The weight of package "%s" is zero.',
+            'fedex_invalid': 'Labels cannot be generated for the following '
+                'shipments: \n\n%s',
+            'fedex_address_undeliverable':
+                'FedEx cannot deliver to "%s" (%s).',
+            'fedex_package_count': 'The shipment "%s" has %s packages but '
+                '%s packages were announced to FedEx.',
+            'fedex_no_labels': 'The shipment has no FedEx label.',
+            'fedex_tracking_number_unknown':
+                'The tracking number is not known.',
+            'fedex_voided': 'Labels voided.',
+        })
+        cls._buttons.update({
+            'label_fedex_new_packages': {
+                'invisible': ~Eval('fedex_open_shipment')
+                | Eval('state').in_(['packed', 'done', 'cancel']),
+            },
         })
         cls.__rpc__.update({
             'make_fedex_labels': RPC(readonly=False, instantiate=0),
             'get_fedex_shipping_cost': RPC(readonly=False, instantiate=0),
+            'void_fedex_labels': RPC(readonly=False, instantiate=0),
+            'void_fedex_tracking_numbers': RPC(readonly=False),
         })
 
     def on_change_carrier(self):
@@ -136,15 +263,50 @@ class ShipmentOut:
         """
         Currency = Pool().get('currency.currency')
 
-        fedex_credentials = self.carrier.get_fedex_credentials()
-
         if not all([
             self.fedex_drop_off_type, self.fedex_packaging_type,
             self.fedex_service_type
         ]):
             self.raise_user_error('fedex_settings_missing')
 
-        rate_request = RateService(fedex_credentials)
+        # From location is the warehouse location. So it must be filled.
+        if not self.warehouse.address:
+            self.raise_user_error('warehouse_address_required')
+
+        # Reuse the last rate (usually the one quoted on the sale) unless
+        # the packages or addresses changed since it was rated.
+        if self.is_fedex_rate_current():
+            metrics.increment('rate.skipped')
+            return self.fedex_rate_amount, self.fedex_rate_currency.id
+
+        try:
+            response = self.carrier.send_fedex_request(
+                self.get_fedex_rate_request, int(self.id)
+            )
+        except fedex.RequestError, exc:
+            self.raise_user_error(
+                'fedex_shipping_cost_error', error_args=(exc.message, )
+            )
+        metrics.increment('rate.performed')
+
+        currency, = Currency.search([
+            ('code', '=', str(
+                response.RateReplyDetails[0].RatedShipmentDetails[0].
+                ShipmentRateDetail.TotalNetCharge.Currency
+            ))
+        ])
+        amount = Decimal(str(
+            response.RateReplyDetails[0].RatedShipmentDetails[0].ShipmentRateDetail.TotalNetCharge.Amount  # noqa
+        ))
+
+        self.set_fedex_rate(amount, currency)
+        return amount, currency.id
+
+    def get_fedex_rate_request(self, fedex_credentials):
+        """
+        Returns the request rating the shipment with the given credentials
+        """
+        rate_request = fedex.RateService(fedex_credentials)
         requested_shipment = rate_request.RequestedShipment
 
         requested_shipment.DropoffType = self.fedex_drop_off_type.value
@@ -155,9 +317,6 @@ class ShipmentOut:
         # Shipper and Recipient
         requested_shipment.Shipper.AccountNumber = \
             fedex_credentials.AccountNumber
-        # From location is the warehouse location. So it must be filled.
-        if not self.warehouse.address:
-            self.raise_user_error('warehouse_address_required')
         self.warehouse.address.set_fedex_address(requested_shipment.Shipper)
         self.delivery_address.set_fedex_address(requested_shipment.Recipient)
 
@@ -184,23 +343,104 @@ class ShipmentOut:
 
         self.get_fedex_items_details(rate_request)
 
-        try:
-            response = rate_request.send_request(int(self.id))
-        except RequestError, exc:
-            self.raise_user_error(
-                'fedex_shipping_cost_error', error_args=(exc.message, )
+        return rate_request
+
+    def set_fedex_rate(self, amount, currency):
+        """
+        Keep the rate FedEx returned for the current packages and addresses
+        of the shipment
+        """
+        self.__class__.write([self], {
+            'fedex_rate_service': self.fedex_service_type.id,
+            'fedex_rate_amount': amount,
+            'fedex_rate_currency': currency.id,
+            'fedex_rate_fingerprint': self.get_fedex_rating_fingerprint(),
+            'fedex_rate_date': datetime.utcnow(),
+            'fedex_rate_weight': round(sum(self._get_fedex_weights()), 2),
+        })
+
+    def is_fedex_rate_current(self):
+        """
+        Returns True if the last FedEx rate of the shipment was computed from
+        the packages and addresses the shipment has now. Rating can be forced
+        with `fedex_force_rating` in the context.
+        """
+        if Transaction().context.get('fedex_force_rating'):
+            return False
+        if not self.fedex_rate_fingerprint or self.fedex_rate_amount is None:
+            return False
+        return self.fedex_rate_fingerprint == \
+            self.get_fedex_rating_fingerprint()
+
+    def get_fedex_items_details(self, fedex_request):
+        '''
+        Computes the details of the packages of the shipment and passes to
+        fedex request
+        '''
+        items = []
+        for sequence, weight in enumerate(self._get_fedex_weights(), 1):
+            item = fedex_request.get_element_from_type(
+                'RequestedPackageLineItem'
             )
+            item.SequenceNumber = sequence
+            item.Weight.Units = 'LB'
+            item.Weight.Value = weight
+            item.GroupPackageCount = 1
+            items.append(item)
 
-        currency, = Currency.search([
-            ('code', '=', str(
-                response.RateReplyDetails[0].RatedShipmentDetails[0].
-                ShipmentRateDetail.TotalNetCharge.Currency
-            ))
-        ])
+        fedex_request.RequestedShipment.PackageCount = len(items)
+        fedex_request.RequestedShipment.RequestedPackageLineItems = items
 
-        return Decimal(str(
-            response.RateReplyDetails[0].RatedShipmentDetails[0].ShipmentRateDetail.TotalNetCharge.Amount  # noqa
-        )), currency.id
+    def _get_fedex_weights(self):
+        """
+        Returns the weights in pounds of the packages of the shipment, or
+        the weight of the shipment if it has no package yet
+        """
+        Uom = Pool().get('product.uom')
+
+        uom_pound, = Uom.search([('symbol', '=', 'lb')])
+
+        if self.packages:
+            return [
+                Uom.compute_qty(
+                    package.weight_uom, package.weight or 0, uom_pound
+                ) for package in self.packages
+            ]
+        return [
+            Uom.compute_qty(self.weight_uom, self.weight or 0, uom_pound)
+        ]
+
+    def get_fedex_rating_fingerprint(self):
+        """
+        Returns the fingerprint of the inputs the FedEx rate of this
+        shipment is computed from. A shipment with a single package matching
+        the sale weight has the same fingerprint as the sale quote. The
+        currency is left out as for the sale (see
+        Sale.get_fedex_rating_fingerprint).
+        """
+        weights = self._get_fedex_weights()
+
+        contents = defaultdict(float)
+        for move in self.outgoing_moves:
+            if move.product.type == 'service':
+                continue
+            contents[move.product.id] += move.quantity
+
+        return fedex_fingerprint((
+            self.carrier.id,
+            self.fedex_drop_off_type.value,
+            self.fedex_packaging_type.value,
+            self.fedex_service_type.value,
+            self.warehouse.address and sorted(
+                self.warehouse.address.address_to_fedex_dict().items()
+            ),
+            sorted(self.delivery_address.address_to_fedex_dict().items()),
+            [round(weight, 2) for weight in weights],
+            sorted(
+                (product, round(quantity, 4))
+                for product, quantity in contents.items()
+            ),
+        ))
 
     def get_fedex_customs_details(self, fedex_request):
         """
@@ -215,34 +455,29 @@ class ShipmentOut:
 
         weight_uom, = ProductUom.search([('symbol', '=', 'lb')])
 
-        # Encoding Items for customs
-        commodities = []
-        customs_value = 0
+        currency_code = self.company.currency.code
+
+        # Encoding Items for customs, repeated products are declared once
+        builder = CommodityBuilder()
         for move in self.outgoing_moves:
             if move.product.type == 'service':
                 continue
-            commodity = fedex_request.get_element_from_type('Commodity')
-            commodity.NumberOfPieces = len(self.outgoing_moves)
-            commodity.Name = move.product.name
-            commodity.Description = move.product.description or \
-                move.product.name
-            commodity.CountryOfManufacture = \
-                self.warehouse.address.country.code
-            commodity.Weight.Units = 'LB'
-            commodity.Weight.Value = int(move.get_weight(weight_uom))
-            commodity.Quantity = int(move.quantity)
-            commodity.QuantityUnits = 'EA'
-            commodity.UnitPrice.Amount = int(move.unit_price)
-            commodity.UnitPrice.Currency = self.company.currency.code
-            commodity.CustomsValue.Currency = self.company.currency.code
-            commodity.CustomsValue.Amount = int(
-                Decimal(str(move.quantity)) * move.unit_price
+            template = move.product.template
+            builder.add(
+                move.product.id, move.product.name,
+                move.product.description or move.product.name,
+                template.fedex_harmonized_code,
+                (template.fedex_country_of_origin or
+                    self.warehouse.address.country).code,
+                move.quantity, move.unit_price, move.get_weight(weight_uom),
+                piece=move.package.id if move.package else None,
             )
-            commodities.append(commodity)
-            customs_value += Decimal(str(move.quantity)) * move.unit_price
+        commodities = builder.get_fedex_commodities(
+            fedex_request, currency_code
+        )
 
-        customs_detail.CustomsValue.Currency = self.company.currency.code
-        customs_detail.CustomsValue.Amount = int(customs_value)
+        customs_detail.CustomsValue.Currency = currency_code
+        customs_detail.CustomsValue.Amount = builder.customs_value
 
         # Commercial Invoice
         customs_detail.CommercialInvoice.TermsOfSale = 'FOB'
@@ -254,50 +489,168 @@ class ShipmentOut:
         fedex_request.RequestedShipment.CustomsClearanceDetail.Commodities = \
             commodities
 
-    def make_fedex_labels(self):
+    @classmethod
+    def get_fedex_problems(cls, shipments):
         """
-        Make labels for the given shipment
-
-        :return: Tracking number as string
+        Checks that labels can be generated for the shipments. The
+        shipments, their packages, addresses and carriers are read
+        together, so checking a whole wave only takes a few queries.
+        Nothing is sent to FedEx except the delivery addresses to validate
+        when the carrier validates addresses (see validate_fedex_addresses).
+
+        :return: dictionary mapping the id of each shipment with problems
+            to the list of its problems
         """
-        Currency = Pool().get('currency.currency')
-        Attachment = Pool().get('ir.attachment')
-        Package = Pool().get('stock.package')
-        Uom = Pool().get('product.uom')
+        Address = Pool().get('party.address')
+
+        shipments = cls.browse([shipment.id for shipment in shipments])
+
+        addresses = set()
+        for shipment in shipments:
+            addresses.add(shipment.delivery_address)
+            addresses.add(shipment.warehouse.address)
+        addresses.discard(None)
+        address_problems = Address.get_fedex_address_problems(list(addresses))
+        # The valid records are sent next, read their addresses together
+        Address.addresses_to_fedex_dicts(list(addresses))
+
+        carrier_problems = {}
+        problems = {}
+        for shipment in shipments:
+            messages = shipment._get_fedex_problems(
+                carrier_problems, address_problems
+            )
+            if messages:
+                problems[shipment.id] = messages
 
-        if self.state not in ('packed', 'done'):
-            self.raise_user_error('invalid_state')
+        for shipment_id, messages in cls.validate_fedex_addresses([
+                s for s in shipments if s.id not in problems]).iteritems():
+            problems[shipment_id] = messages
+        return problems
 
-        if not self.carrier.carrier_cost_method == 'fedex':
-            self.raise_user_error('wrong_carrier')
+    def _get_fedex_problems(self, carrier_problems, address_problems):
+        """
+        Returns the problems of the shipment for get_fedex_problems
+
+        :param carrier_problems: dictionary of the problems of the carriers
+            checked already, updated with the carrier of the shipment
+        :param address_problems: the problems of the addresses of the
+            shipments (see get_fedex_address_problems)
+        """
+        def problem(error, *args):
+            return self.raise_user_error(
+                error, error_args=args, raise_exception=False
+            )
 
+        messages = []
+        # Open shipments are labeled package by package while packing
+        if self.state not in ('packed', 'done') and \
+                not self.fedex_open_shipment:
+            messages.append(problem('invalid_state'))
+        if not self.carrier or self.carrier.carrier_cost_method != 'fedex':
+            return messages + [problem('wrong_carrier')]
         if self.tracking_number:
-            self.raise_user_error('tracking_number_already_present')
+            messages.append(problem('tracking_number_already_present'))
+        if self.carrier not in carrier_problems:
+            carrier_problems[self.carrier] = self.carrier.get_fedex_problems()
+        messages.extend(carrier_problems[self.carrier])
+        if not all([
+            self.fedex_drop_off_type, self.fedex_packaging_type,
+            self.fedex_service_type
+        ]):
+            messages.append(problem('fedex_settings_missing'))
+        if not self.warehouse.address:
+            messages.append(problem('warehouse_address_required'))
+        for address in (self.warehouse.address, self.delivery_address):
+            if address is not None and address.id in address_problems:
+                messages.extend(
+                    '%s: %s' % (address.rec_name, message)
+                    for message in address_problems[address.id]
+                )
+        messages.extend(self._get_fedex_package_problems())
+        return messages
+
+    def _get_fedex_package_problems(self):
+        """
+        Returns the problems of the packages of the shipment
+        """
+        messages = []
+        if not self.packages:
+            messages.append(self.raise_user_error(
+                'fedex_packages_missing', raise_exception=False
+            ))
+        for package in self.packages:
+            if not package.weight:
+                messages.append(self.raise_user_error(
+                    'fedex_package_weight_missing',
+                    error_args=(package.rec_name,), raise_exception=False
+                ))
+        return messages
+
+    @classmethod
+    def validate_fedex_addresses(cls, shipments):
+        """
+        Validates the delivery addresses of the shipments with FedEx, the
+        addresses of a carrier being validated together.
+
+        :return: dictionary mapping the id of each shipment FedEx cannot
+            deliver to the list of its problems
+        """
+        Address = Pool().get('party.address')
+        Validation = Pool().get('fedex.address.validation')
+
+        by_carrier = defaultdict(list)
+        for shipment in shipments:
+            if shipment.carrier.fedex_address_validation_ttl:
+                by_carrier[shipment.carrier].append(shipment)
+
+        problems = {}
+        for carrier, carrier_shipments in by_carrier.iteritems():
+            addresses = Address.addresses_to_fedex_dicts([
+                s.delivery_address for s in carrier_shipments
+            ])
+            results = Validation.validate_fedex_addresses(carrier, [
+                addresses[s.delivery_address.id] for s in carrier_shipments
+            ])
+            for shipment, (valid, message) in zip(
+                    carrier_shipments, results):
+                if not valid:
+                    metrics.increment('address_validation.rejected')
+                    problems[shipment.id] = [cls.raise_user_error(
+                        'fedex_address_undeliverable', error_args=(
+                            shipment.delivery_address.rec_name, message
+                        ), raise_exception=False
+                    )]
+        return problems
 
-        fedex_credentials = self.carrier.get_fedex_credentials()
+    @classmethod
+    def check_fedex_problems(cls, shipments):
+        """
+        Raises an error listing the problems of the shipments for which
+        labels cannot be generated
+        """
+        problems = cls.get_fedex_problems(shipments)
+        if problems:
+            cls.raise_user_error('fedex_invalid', error_args=(
+                format_fedex_problems(shipments, problems),
+            ))
 
-        ship_request = ProcessShipmentRequest(fedex_credentials)
+    def get_fedex_shipment_request(self, fedex_credentials):
+        """
+        Returns a ProcessShipmentRequest for the shipment, without any
+        package
+        """
+        ship_request = fedex.ProcessShipmentRequest(fedex_credentials)
         requested_shipment = ship_request.RequestedShipment
 
         requested_shipment.DropoffType = self.fedex_drop_off_type.value
         requested_shipment.ServiceType = self.fedex_service_type.value
         requested_shipment.PackagingType = self.fedex_packaging_type.value
 
-        uom_pound, = Uom.search([('symbol', '=', 'lb')])
-
-        if len(self.packages) > 1:
-            requested_shipment.TotalWeight.Units = 'LB'
-            requested_shipment.TotalWeight.Value = Uom.compute_qty(
-                self.weight_uom, self.weight, uom_pound
-            )
-
         # Shipper & Recipient
         requested_shipment.Shipper.AccountNumber = \
             fedex_credentials.AccountNumber
 
-        if not self.warehouse.address:
-            self.raise_user_error('warehouse_address_required')
-
         self.warehouse.address.set_fedex_address(requested_shipment.Shipper)
         self.delivery_address.set_fedex_address(requested_shipment.Recipient)
 
@@ -324,71 +677,741 @@ class ShipmentOut:
 
         requested_shipment.RateRequestTypes = ['ACCOUNT']
 
-        master_tracking_number = None
+        return ship_request
 
-        for index, package in enumerate(self.packages, start=1):
-            item = ship_request.get_element_from_type(
-                'RequestedPackageLineItem'
-            )
-            item.SequenceNumber = index
+    def get_fedex_package_request(
+        self, fedex_credentials, package, sequence, package_count,
+        weight=None
+    ):
+        """
+        Returns a ProcessShipmentRequest for a package of the shipment
 
-            # TODO: some country needs item.ItemDescription
+        :param sequence: position of the package in the shipment, from 1
+        :param package_count: number of packages of the shipment
+        :param weight: weight of the package in pounds, computed when not
+            given
+        """
+        Uom = Pool().get('product.uom')
 
-            item.Weight.Units = 'LB'
-            item.Weight.Value = Uom.compute_qty(
+        if weight is None:
+            uom_pound, = Uom.search([('symbol', '=', 'lb')])
+            weight = Uom.compute_qty(
                 package.weight_uom, package.weight, uom_pound
             )
 
-            ship_request.RequestedShipment.RequestedPackageLineItems = [item]
-            ship_request.RequestedShipment.PackageCount = len(self.packages)
+        ship_request = self.get_fedex_shipment_request(fedex_credentials)
+
+        item = ship_request.get_element_from_type('RequestedPackageLineItem')
+        item.SequenceNumber = sequence
+
+        # TODO: some country needs item.ItemDescription
+
+        item.Weight.Units = 'LB'
+        item.Weight.Value = weight
 
-            if master_tracking_number is not None:
-                tracking_id = ship_request.get_element_from_type(
-                    'TrackingId'
+        ship_request.RequestedShipment.RequestedPackageLineItems = [item]
+        ship_request.RequestedShipment.PackageCount = package_count
+        return ship_request
+
+    def get_fedex_package_requests(self, fedex_credentials, packages=None):
+        """
+        Returns a ProcessShipmentRequest for each of the packages, in their
+        order, to be sent as one multiple-package shipment
+
+        :param packages: packages of the shipment, all of them by default
+        """
+        if packages is None:
+            packages = self.packages
+        weights = dict(zip(self.packages, self._get_fedex_weights()))
+        requests = [
+            self.get_fedex_package_request(
+                fedex_credentials, package, index, len(packages),
+                weights[package]
+            ) for index, package in enumerate(packages, start=1)
+        ]
+        if len(packages) > 1:
+            total_weight = sum(weights[package] for package in packages)
+            for ship_request in requests:
+                requested_shipment = ship_request.RequestedShipment
+                requested_shipment.TotalWeight.Units = 'LB'
+                requested_shipment.TotalWeight.Value = total_weight
+        return requests
+
+    def get_fedex_package_groups(self):
+        """
+        Splits the packages of the shipment in groups of about the same
+        size, of fedex_max_packages of the carrier at most. Each group is
+        sent to FedEx as a multiple-package shipment with its own master
+        package.
+
+        :return: list of lists of packages
+        """
+        packages = list(self.packages)
+        limit = self.carrier.fedex_max_packages or len(packages) or 1
+        count = (len(packages) + limit - 1) // limit or 1
+        size = (len(packages) + count - 1) // count or 1
+        return [
+            packages[i:i + size] for i in xrange(0, len(packages), size)
+        ]
+
+    def make_fedex_labels(self):
+        """
+        Make labels for the given shipment
+
+        :return: Tracking number as string
+        """
+        self.check_fedex_problems([self])
+        return self.async_make_labels([self])[self.id].result()
+
+    @classmethod
+    def async_make_labels(cls, shipments):
+        """
+        Generates the labels of a wave of shipments, keeping the requests
+        of all the shipments in flight at the same time. The first package
+        of each shipment is sent at once, the other packages, which need
+        the master tracking number of the first one, are sent together as
+        soon as it is known. Shipments with more packages than FedEx takes
+        in a shipment are split (see get_fedex_package_groups) and the
+        groups are sent concurrently.
+
+        The shipments for which get_fedex_problems finds problems are
+        skipped, without sending anything to FedEx.
+
+        :return: a dictionary mapping the id of each shipment sent with a
+            FedexFuture whose result is its master tracking number
+        """
+        problems = cls.get_fedex_problems(shipments)
+        futures = {}
+        for shipment in shipments:
+            if shipment.id in problems:
+                metrics.increment('validation.skipped')
+                continue
+            if shipment.fedex_open_shipment:
+                # Most packages are labeled already, finish the others
+                futures[shipment.id] = FedexFuture(
+                    value=shipment.confirm_fedex_shipment()
                 )
-                tracking_id.TrackingNumber = master_tracking_number
-                ship_request.RequestedShipment.MasterTrackingId = tracking_id
+                continue
 
-            try:
-                response = ship_request.send_request(str(self.id))
-            except RequestError, error:
-                self.raise_user_error('error_label', error_args=(error,))
+            # All the packages of a shipment are sent with the account the
+            # shipment was started with.
+            fedex_credentials = shipment.carrier.get_fedex_credentials()
+            groups = shipment.get_fedex_package_groups()
+            group_futures = []
+            for packages in groups:
+                requests = shipment.get_fedex_package_requests(
+                    fedex_credentials, packages
+                )
+                group_futures.append(shipment.carrier.async_send_fedex_request(
+                    lambda credentials, request=requests[0]: request,
+                    str(shipment.id), fedex_credentials,
+                    callback=partial(
+                        shipment._send_fedex_child_packages,
+                        fedex_credentials, requests
+                    ),
+                    errback=shipment._check_fedex_label_error,
+                ))
+            futures[shipment.id] = gather_futures(
+                group_futures, callback=partial(
+                    shipment.save_fedex_labels, fedex_credentials, groups
+                ), discard=lambda group_responses:
+                    cls._remove_fedex_label_images(sum(group_responses, []))
+            )
+        return futures
+
+    def _check_fedex_label_error(self, exc):
+        if isinstance(exc, fedex.RequestError):
+            self.raise_user_error('error_label', error_args=(exc,))
+
+    @staticmethod
+    def _get_fedex_tracking_number(response):
+        lean_reply = getattr(response, 'lean_reply', None)
+        if lean_reply is not None and lean_reply.tracking_numbers:
+            return lean_reply.tracking_numbers[0]
+        package_details = response.CompletedShipmentDetail.CompletedPackageDetails  # noqa
+        return package_details[0].TrackingIds[0].TrackingNumber
+
+    @staticmethod
+    def _get_fedex_shipment_charge(response):
+        """
+        Returns the net charge of the shipment as a tuple (amount,
+        currency code) or None if the response does not rate the shipment
+        """
+        lean_reply = getattr(response, 'lean_reply', None)
+        if lean_reply is not None:
+            if lean_reply.amount is None:
+                return None
+            return lean_reply.amount, lean_reply.currency
+        rating = getattr(
+            response.CompletedShipmentDetail, 'ShipmentRating', None
+        )
+        if not rating:
+            return None
+        net_charge = rating.ShipmentRateDetails[0].TotalNetCharge
+        return str(net_charge.Amount), str(net_charge.Currency)
+
+    @staticmethod
+    def _get_fedex_label_images(response):
+        """
+        Yields the label images of the response one at a time. Images read
+        by the lean parser are loaded from their file only when needed.
+        """
+        lean_reply = getattr(response, 'lean_reply', None)
+        if lean_reply is not None:
+            for index in xrange(len(lean_reply.images)):
+                yield lean_reply.read_image(index)
+            return
+        package_details = response.CompletedShipmentDetail.CompletedPackageDetails  # noqa
+        for image in package_details[0].Label.Parts:
+            yield base64.decodestring(image.Image)
+
+    @staticmethod
+    def _remove_fedex_label_images(responses):
+        """
+        Removes the files of the label images the lean parser wrote for
+        the responses, those of the images saved are removed already
+        """
+        for response in responses:
+            lean_reply = getattr(response, 'lean_reply', None)
+            if lean_reply is not None:
+                lean_reply.remove_images()
+
+    def _send_fedex_child_packages(
+        self, fedex_credentials, requests, master_response
+    ):
+        """
+        Sends the packages following the first one once its response is
+        received.
+
+        :return: the responses in the order of the requests
+        """
+        master_tracking_number = self._get_fedex_tracking_number(
+            master_response
+        )
+
+        futures = []
+        for ship_request in requests[1:]:
+            tracking_id = ship_request.get_element_from_type('TrackingId')
+            tracking_id.TrackingNumber = master_tracking_number
+            ship_request.RequestedShipment.MasterTrackingId = tracking_id
+            futures.append(self.carrier.async_send_fedex_request(
+                lambda credentials, request=ship_request: request,
+                str(self.id), fedex_credentials,
+                errback=self._check_fedex_label_error,
+            ))
+
+        try:
+            responses = gather_futures(
+                futures, discard=self._remove_fedex_label_images
+            ).result()
+        except Exception:
+            # The labels of the shipment are not saved
+            self._remove_fedex_label_images([master_response])
+            raise
+        return [master_response] + responses
+
+    def save_fedex_labels(self, fedex_credentials, groups, group_responses):
+        """
+        Saves the tracking numbers, labels and cost returned by FedEx
+
+        :param groups: the lists of packages sent as a multiple-package
+            shipment (see get_fedex_package_groups)
+        :param group_responses: the responses of FedEx for each group, in
+            the order of the packages, the first one being the master
+        :return: the master tracking number of the first group, which is
+            the tracking number of the shipment
+        """
+        ShippingCost = Pool().get('fedex.shipping.cost')
 
-            package_details = response.CompletedShipmentDetail.CompletedPackageDetails  # noqa
-            tracking_number = package_details[0].TrackingIds[0].TrackingNumber
+        master_tracking_numbers = []
+        try:
+            for packages, responses in zip(groups, group_responses):
+                master_tracking_number = self._get_fedex_tracking_number(
+                    responses[0]
+                )
+                self.save_fedex_package_labels(
+                    zip(packages, responses), master_tracking_number
+                )
+                master_tracking_numbers.append(master_tracking_number)
+        finally:
+            self._remove_fedex_label_images(sum(group_responses, []))
+        self.__class__.write([self], dict(
+            self._get_fedex_cost_values(group_responses),
+            tracking_number=master_tracking_numbers[0],
+            fedex_account_number=fedex_credentials.AccountNumber,
+            fedex_label_date=datetime.utcnow(),
+        ))
+        ShippingCost.record_fedex_labels([self])
+        return master_tracking_numbers[0]
+
+    def _get_fedex_cost_values(self, group_responses):
+        """
+        Returns the values of the cost of the shipment given by the
+        responses of each multiple-package shipment, or no value if they
+        do not rate the shipment
+        """
+        Currency = Pool().get('currency.currency')
 
-            if self.packages.index(package) == 0:
-                master_tracking_number = tracking_number
+        amount, currency_code = Decimal('0'), None
+        for responses in group_responses:
+            # Packages sent concurrently may be processed in any order by
+            # FedEx, the rating of the shipment comes with the last one.
+            charge = None
+            for response in responses:
+                charge = self._get_fedex_shipment_charge(response) or charge
+            if charge is not None:
+                amount += Decimal(charge[0])
+                currency_code = charge[1]
+        if currency_code is None:
+            return {}
+        currency, = Currency.search([('code', '=', currency_code)])
+        return {
+            'cost': amount,
+            'cost_currency': currency,
+        }
 
-            Package.write([package], {
-                'tracking_number': tracking_number,
-            })
+    def save_fedex_package_labels(
+        self, package_responses, master_tracking_number
+    ):
+        """
+        Saves the tracking numbers and labels of packages of the shipment.
+        The packages are saved together, with a query by IN_MAX packages
+        for their tracking numbers and a single creation of their labels
+        and tracking records.
 
-            for id, image in enumerate(package_details[0].Label.Parts):
-                Attachment.create([{
-                    'name': "%s_%s_Fedex.png" % (tracking_number, id),
+        :param package_responses: list of (package, response of FedEx)
+        """
+        Attachment = Pool().get('ir.attachment')
+        Package = Pool().get('stock.package')
+        Tracking = Pool().get('fedex.package.tracking')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        package_table = Package.__table__()
+
+        tracked_packages = [
+            (package, self._get_fedex_tracking_number(response))
+            for package, response in package_responses
+        ]
+        for i in xrange(0, len(tracked_packages), cursor.IN_MAX):
+            sub_packages = tracked_packages[i:i + cursor.IN_MAX]
+            cursor.execute(*package_table.update([
+                package_table.tracking_number,
+                package_table.write_uid, package_table.write_date,
+            ], [
+                Case(*[
+                    (package_table.id == package.id, tracking_number)
+                    for package, tracking_number in sub_packages
+                ]),
+                transaction.user, CurrentTimestamp(),
+            ], where=package_table.id.in_(
+                [package.id for package, _ in sub_packages]
+            )))
+        clear_fedex_cache(
+            Package.__name__, [package.id for package, _ in tracked_packages]
+        )
+
+        # The images of the packages sent together are held in memory until
+        # their labels are created
+        attachments = []
+        for (package, response), (_, tracking_number) in zip(
+                package_responses, tracked_packages):
+            for index, image in enumerate(
+                    self._get_fedex_label_images(response)):
+                attachments.append({
+                    'name': "%s_%s_Fedex.png" % (tracking_number, index),
                     'type': 'data',
-                    'data': buffer(base64.decodestring(image.Image)),
+                    'data': buffer(image),
                     'resource': '%s,%s' % (self.__name__, self.id)
-                }])
+                })
+        if attachments:
+            Attachment.create(attachments)
+
+        Tracking.create([{
+            'package': package.id,
+            'shipment': self.id,
+            'carrier': self.carrier.id,
+            'tracking_number': tracking_number,
+            'master': tracking_number == master_tracking_number,
+            'master_tracking_number': master_tracking_number,
+        } for package, tracking_number in tracked_packages])
+
+    def label_fedex_packages(self, packages):
+        """
+        Labels packages of an open shipment (see fedex_open_shipment) as
+        they are packed. The first package labeled becomes the master
+        package of the shipment, the others are sent with its tracking
+        number, concurrently when there are several.
+
+        :param packages: packages of the shipment, those labeled already
+            are ignored
+        :return: the master tracking number
+        """
+        ShippingCost = Pool().get('fedex.shipping.cost')
+
+        self.check_fedex_problems([self])
+
+        labeled = [p for p in self.packages if p.tracking_number]
+        packages = [p for p in packages if not p.tracking_number]
+        if not packages:
+            return self.fedex_master_tracking_number
+        if len(labeled) + len(packages) > self.fedex_package_count:
+            self.raise_user_error('fedex_package_count', error_args=(
+                self.rec_name, len(labeled) + len(packages),
+                self.fedex_package_count,
+            ))
 
-        currency, = Currency.search([
-            ('code', '=', str(
-                response.CompletedShipmentDetail.ShipmentRating.
-                ShipmentRateDetails[0].TotalNetCharge.Currency
+        sequences = dict(
+            (package, sequence)
+            for sequence, package in enumerate(packages, len(labeled) + 1)
+        )
+        weights = dict(zip(self.packages, self._get_fedex_weights()))
+        responses = []
+        master_tracking_number = self.fedex_master_tracking_number
+        if master_tracking_number:
+            fedex_credentials = self.carrier.get_fedex_credentials(
+                self.fedex_account_number
+            )
+        else:
+            # All the packages are sent with the account of the master
+            fedex_credentials = self.carrier.get_fedex_credentials()
+            master = packages.pop(0)
+            request = self.get_fedex_package_request(
+                fedex_credentials, master, sequences[master],
+                self.fedex_package_count, weights[master]
+            )
+            master_response = self.carrier.async_send_fedex_request(
+                lambda credentials: request, str(self.id), fedex_credentials,
+                errback=self._check_fedex_label_error,
+            ).result()
+            responses.append(master_response)
+            try:
+                master_tracking_number = self._get_fedex_tracking_number(
+                    master_response
+                )
+                self.__class__.write([self], {
+                    'fedex_master_tracking_number': master_tracking_number,
+                    'fedex_account_number': fedex_credentials.AccountNumber,
+                })
+                self.save_fedex_package_labels(
+                    [(master, master_response)], master_tracking_number
+                )
+            finally:
+                self._remove_fedex_label_images([master_response])
+
+        futures = []
+        for package in packages:
+            ship_request = self.get_fedex_package_request(
+                fedex_credentials, package, sequences[package],
+                self.fedex_package_count, weights[package]
+            )
+            tracking_id = ship_request.get_element_from_type('TrackingId')
+            tracking_id.TrackingNumber = master_tracking_number
+            ship_request.RequestedShipment.MasterTrackingId = tracking_id
+            futures.append(self.carrier.async_send_fedex_request(
+                lambda credentials, request=ship_request: request,
+                str(self.id), fedex_credentials,
+                errback=self._check_fedex_label_error,
             ))
-        ])
+        package_responses = zip(packages, gather_futures(
+            futures, discard=self._remove_fedex_label_images
+        ).result())
+        try:
+            self.save_fedex_package_labels(
+                package_responses, master_tracking_number
+            )
+        finally:
+            self._remove_fedex_label_images(
+                [response for _, response in package_responses]
+            )
+        responses.extend(response for _, response in package_responses)
+
+        cost_values = self._get_fedex_cost_values([responses])
+        if cost_values:
+            self.__class__.write([self], cost_values)
+            ShippingCost.record_fedex_labels([self])
+        return master_tracking_number
+
+    def confirm_fedex_shipment(self):
+        """
+        Completes an open shipment once it is packed: the packages not
+        labeled yet are labeled and the master tracking number becomes the
+        tracking number of the shipment.
+
+        :return: the master tracking number
+        """
+        ShippingCost = Pool().get('fedex.shipping.cost')
+
+        if len(self.packages) != self.fedex_package_count:
+            self.raise_user_error('fedex_package_count', error_args=(
+                self.rec_name, len(self.packages), self.fedex_package_count,
+            ))
+        master_tracking_number = self.label_fedex_packages(self.packages)
         self.__class__.write([self], {
-            'cost': Decimal(str(
-                response.CompletedShipmentDetail.ShipmentRating.
-                ShipmentRateDetails[0].TotalNetCharge.Amount
-            )),
-            'cost_currency': currency,
             'tracking_number': master_tracking_number,
+            'fedex_label_date': datetime.utcnow(),
         })
-
+        # The costs of shipments without tracking number are not counted
+        ShippingCost.record_fedex_labels([self])
         return master_tracking_number
 
+    @classmethod
+    @ModelView.button
+    def label_fedex_new_packages(cls, shipments):
+        """
+        Labels the packages of the open shipments which are not labeled
+        yet. FedEx bills the labels, so they are only asked for explicitly
+        and never when a package is created, which may be rolled back.
+        """
+        for shipment in shipments:
+            if shipment.is_fedex_shipping and shipment.fedex_open_shipment:
+                shipment.label_fedex_packages(shipment.packages)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('packed')
+    def pack(cls, shipments):
+        super(ShipmentOut, cls).pack(shipments)
+        for shipment in shipments:
+            if shipment.is_fedex_shipping and shipment.fedex_open_shipment:
+                shipment.confirm_fedex_shipment()
+
+    @staticmethod
+    def get_fedex_delete_request(
+        fedex_credentials, tracking_number, service_type
+    ):
+        """
+        Returns the request voiding the labels of the shipment whose master
+        tracking number is given. It does not use the ORM.
+        """
+        delete_request = fedex.DeleteShipmentRequest(fedex_credentials)
+        delete_request.TrackingId.TrackingNumber = tracking_number
+        delete_request.TrackingId.TrackingIdType = \
+            'GROUND' if service_type in GROUND_SERVICES else 'EXPRESS'
+        delete_request.DeletionControl = 'DELETE_ALL_PACKAGES'
+        return delete_request
+
+    @classmethod
+    def void_fedex_labels(cls, shipments):
+        """
+        Voids the FedEx labels of the shipments. The requests of all the
+        shipments are sent concurrently, with the accounts the labels were
+        generated with. The shipments voided are then cleared of their
+        labels together (see clear_fedex_labels).
+
+        A shipment split in several masters (see get_fedex_package_groups)
+        is voided master by master: when some masters cannot be voided,
+        the packages of the others are cleared (see clear_fedex_masters)
+        so that voiding the shipment again only voids the masters left.
+
+        :return: dictionary mapping the id of each shipment to None when
+            its labels were voided or to the error which prevented it
+        """
+        Tracking = Pool().get('fedex.package.tracking')
+
+        masters = defaultdict(list)
+        for tracking_number in Tracking.search([
+                ('shipment', 'in', [s.id for s in shipments]),
+                ('master', '=', True),
+                ]):
+            masters[tracking_number.shipment.id].append(
+                tracking_number.tracking_number
+            )
+
+        results = {}
+        futures = []
+        for shipment in shipments:
+            tracking_numbers = masters[shipment.id] or filter(
+                None, [shipment.tracking_number]
+            )
+            if not shipment.is_fedex_shipping or not tracking_numbers:
+                results[shipment.id] = cls.raise_user_error(
+                    'fedex_no_labels', raise_exception=False
+                )
+                continue
+            fedex_credentials = shipment.carrier.get_fedex_credentials(
+                shipment.fedex_account_number
+            )
+            for tracking_number in tracking_numbers:
+                futures.append((
+                    shipment, tracking_number,
+                    shipment.carrier.async_send_fedex_request(
+                        partial(
+                            cls.get_fedex_delete_request,
+                            tracking_number=tracking_number,
+                            service_type=shipment.fedex_service_type.value,
+                        ), str(shipment.id), fedex_credentials,
+                    )
+                ))
+
+        voided_masters = defaultdict(list)
+        for shipment, tracking_number, future in futures:
+            try:
+                future.result()
+            except Exception, exc:
+                # Errors of FedEx, throttling or network errors
+                metrics.increment('void.errors')
+                results.setdefault(
+                    shipment.id, getattr(exc, 'message', None) or '%s' % exc
+                )
+            else:
+                voided_masters[shipment].append(tracking_number)
+
+        voided = [s for s in shipments if s.id not in results]
+        cls.clear_fedex_labels(voided)
+        cls.clear_fedex_masters([
+            (shipment, voided_numbers)
+            for shipment, voided_numbers in voided_masters.iteritems()
+            if shipment.id in results
+        ])
+        metrics.increment('void.performed', len(voided))
+        results.update((s.id, None) for s in voided)
+        return results
+
+    @classmethod
+    def void_fedex_tracking_numbers(cls, tracking_numbers):
+        """
+        Voids the labels of the shipments of the tracking numbers (see
+        void_fedex_labels). All the labels of a shipment are voided.
+
+        :return: dictionary mapping each tracking number to None when the
+            labels of its shipment were voided or to the error
+        """
+        Tracking = Pool().get('fedex.package.tracking')
+
+        resolved = Tracking.resolve_tracking_numbers(tracking_numbers)
+        shipments = cls.browse(list(set(
+            values['shipment'] for values in resolved.itervalues()
+        )))
+        results = cls.void_fedex_labels(shipments)
+
+        unknown = cls.raise_user_error(
+            'fedex_tracking_number_unknown', raise_exception=False
+        )
+        return dict(
+            (tracking_number, results[resolved[tracking_number]['shipment']]
+                if tracking_number in resolved else unknown)
+            for tracking_number in tracking_numbers
+        )
+
+    @classmethod
+    def clear_fedex_labels(cls, shipments):
+        """
+        Removes the tracking numbers, cost, close and delivery of voided
+        shipments and archives their labels, renaming them with a VOID_
+        prefix
+        """
+        Attachment = Pool().get('ir.attachment')
+        Package = Pool().get('stock.package')
+        Tracking = Pool().get('fedex.package.tracking')
+        ShippingCost = Pool().get('fedex.shipping.cost')
+
+        if not shipments:
+            return
+        shipment_ids = [s.id for s in shipments]
+
+        cls.write(shipments, {
+            'tracking_number': None,
+            'fedex_master_tracking_number': None,
+            'fedex_account_number': None,
+            'cost': Decimal('0'),
+            # Labeled again, the shipment is closed and tracked again
+            'fedex_label_date': None,
+            'fedex_close': None,
+            'fedex_delivered': False,
+            'fedex_delivery_date': None,
+        })
+        ShippingCost.record_fedex_labels(shipments)
+        packages = [
+            package for shipment in shipments
+            for package in shipment.packages if package.tracking_number
+        ]
+        if packages:
+            Package.write(packages, {'tracking_number': None})
+        Tracking.delete(Tracking.search([
+            ('shipment', 'in', shipment_ids),
+        ]))
+
+        attachments = Attachment.search([
+            ('resource', 'in', [
+                '%s,%s' % (cls.__name__, shipment_id)
+                for shipment_id in shipment_ids
+            ]),
+            ('name', 'like', '%_Fedex.png'),
+            ('name', 'not like', 'VOID_%'),
+        ])
+        args = []
+        for attachment in attachments:
+            args.extend(([attachment], {'name': 'VOID_' + attachment.name}))
+        if args:
+            Attachment.write(*args)
+
+    @classmethod
+    def clear_fedex_masters(cls, shipment_masters):
+        """
+        Removes the tracking numbers of the packages sent with the voided
+        masters of shipments whose other masters are still labeled, and
+        archives their labels. The shipment keeps the tracking number of a
+        master left.
+
+        :param shipment_masters: list of (shipment, master tracking numbers
+            voided)
+        """
+        Attachment = Pool().get('ir.attachment')
+        Package = Pool().get('stock.package')
+        Tracking = Pool().get('fedex.package.tracking')
+
+        if not shipment_masters:
+            return
+        tracking_numbers = [
+            tracking_number for _, masters in shipment_masters
+            for tracking_number in masters
+        ]
+        trackings = Tracking.search([
+            ('shipment', 'in', [s.id for s, _ in shipment_masters]),
+            ['OR',
+                ('master_tracking_number', 'in', tracking_numbers),
+                ('tracking_number', 'in', tracking_numbers)],
+        ])
+        Package.write(
+            [tracking.package for tracking in trackings],
+            {'tracking_number': None}
+        )
+        attachments = Attachment.search([
+            ('resource', 'in', [
+                '%s,%s' % (cls.__name__, shipment.id)
+                for shipment, _ in shipment_masters
+            ]),
+            ('name', 'like', '%_Fedex.png'),
+            ('name', 'not like', 'VOID_%'),
+        ])
+        # Labels are named after the tracking number of their package
+        package_numbers = set(t.tracking_number for t in trackings)
+        args = []
+        for attachment in attachments:
+            if attachment.name.rsplit('_', 2)[0] in package_numbers:
+                args.extend(
+                    ([attachment], {'name': 'VOID_' + attachment.name})
+                )
+        if args:
+            Attachment.write(*args)
+        Tracking.delete(trackings)
+
+        masters_left = dict(
+            (tracking.shipment.id, tracking.tracking_number)
+            for tracking in Tracking.search([
+                ('shipment', 'in', [s.id for s, _ in shipment_masters]),
+                ('master', '=', True),
+            ], order=[('id', 'DESC')])
+        )
+        to_write = []
+        for shipment, masters in shipment_masters:
+            if shipment.tracking_number in masters:
+                to_write.extend(([shipment], {
+                    'tracking_number': masters_left.get(shipment.id),
+                }))
+        if to_write:
+            cls.write(*to_write)
+
 
 class GenerateFedexLabelMessage(ModelView):
     'Generate Fedex Labels Message'
@@ -407,3 +1430,54 @@ class GenerateShippingLabel:
         if self.start.carrier.carrier_cost_method == 'fedex':
             return 'generate'
         return state
+
+
+class VoidFedexLabelsStart(ModelView):
+    'Void FedEx Labels'
+    __name__ = 'fedex.void.labels.start'
+
+
+class VoidFedexLabelsResult(ModelView):
+    'Void FedEx Labels'
+    __name__ = 'fedex.void.labels.result'
+
+    results = fields.Text('Results', readonly=True)
+
+
+class VoidFedexLabels(Wizard):
+    'Void FedEx Labels'
+    __name__ = 'fedex.void.labels'
+
+    start = StateView(
+        'fedex.void.labels.start',
+        'shipping_fedex.void_fedex_labels_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Void', 'void', 'tryton-ok', default=True),
+        ]
+    )
+    void = StateTransition()
+    result = StateView(
+        'fedex.void.labels.result',
+        'shipping_fedex.void_fedex_labels_result_view_form', [
+            Button('Close', 'end', 'tryton-close'),
+        ]
+    )
+
+    def transition_void(self):
+        Shipment = Pool().get('stock.shipment.out')
+
+        shipments = Shipment.browse(Transaction().context['active_ids'])
+        results = Shipment.void_fedex_labels(shipments)
+        voided = Shipment.raise_user_error(
+            'fedex_voided', raise_exception=False
+        )
+        self.result.results = '\n'.join(
+            '%s: %s' % (shipment.rec_name, results[shipment.id] or voided)
+            for shipment in shipments
+        )
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'results': self.result.results,
+        }
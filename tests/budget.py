@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/budget.py
+
+    Budgets of SQL statements and time of the paths talking to FedEx, so
+    that a change reading records one at a time (eg: a search by line or a
+    write by package) fails the tests instead of slowing down large orders.
+
+    A path is measured at each of SIZES lines or packages against the
+    stand-in. Between two sizes, the statements it runs may grow by
+    queries_per_unit for each line or package added, plus QUERIES_SLACK
+    for the caches of Tryton found empty, and it must take less than
+    seconds at every size.
+
+    :copyright: (C) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from collections import namedtuple
+
+from trytond.transaction import Transaction
+
+Budget = namedtuple('Budget', ['queries_per_unit', 'seconds'])
+
+# Number of lines or packages the paths are measured with, with both
+# products of the dataset at every size
+SIZES = (2, 5, 20)
+# Statements run between two sizes beyond the budget, when the caches of
+# Tryton (eg: of the triggers) were emptied. It is less than a statement by
+# line or package between the two largest sizes.
+QUERIES_SLACK = 5
+
+BUDGETS = {
+    # by sale line
+    'sale.quote': Budget(queries_per_unit=0, seconds=3.0),
+    # by package
+    'shipment.get_fedex_shipping_cost': Budget(
+        queries_per_unit=0, seconds=3.0
+    ),
+    # by package: the creation of its label (10 statements run by
+    # ir.attachment for each record) and of its tracking record
+    'shipment.make_fedex_labels': Budget(queries_per_unit=11, seconds=6.0),
+}
+
+
+class Measure(object):
+    """
+    Counts the SQL statements run with the cursor of the transaction and
+    the time spent in a with block
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.cursor = Transaction().cursor
+        execute = self.cursor.execute
+
+        def counted(*args, **kwargs):
+            self.queries += 1
+            return execute(*args, **kwargs)
+
+        self.cursor.execute = counted
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.time() - self.start
+        del self.cursor.execute
+
+
+def check_budget(name, measures):
+    """
+    Fails if the measures of the path exceed its budget
+
+    :param measures: list of (size, Measure) by increasing size
+    """
+    budget = BUDGETS[name]
+    report = ', '.join(
+        '%s: %s queries in %.3fs' % (size, measure.queries, measure.elapsed)
+        for size, measure in measures
+    )
+    for (smaller, first), (larger, last) in zip(measures, measures[1:]):
+        extra = last.queries - first.queries - \
+            budget.queries_per_unit * (larger - smaller)
+        assert extra <= QUERIES_SLACK, \
+            '%s runs %s queries more than %s by unit from %s to %s (%s)' % (
+                name, extra, budget.queries_per_unit, smaller, larger,
+                report
+            )
+    slowest = max(measure.elapsed for _, measure in measures)
+    assert slowest <= budget.seconds, \
+        '%s takes %.3fs, %.1fs allowed (%s)' % (
+            name, slowest, budget.seconds, report
+        )
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/fedex_standin.py
+
+    Stands in for the FedEx web services, so that the requests of the
+    module can be tested without reaching FedEx.
+
+    :copyright: (C) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import base64
+from datetime import datetime
+from decimal import Decimal
+
+
+class Element(object):
+    """
+    A FedEx object, creating the elements it contains when they are first
+    used like the objects of suds do.
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = Element()
+        setattr(self, name, value)
+        return value
+
+
+class StandinRequest(object):
+    "Base class of the requests of the stand-in"
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+    def get_element_from_type(self, type_name):
+        return Element()
+
+
+class TrackRequest(StandinRequest):
+    """
+    Stands for fedex.TrackRequest. Packages are in transit unless their
+    tracking number is in `statuses`.
+    """
+    # tracking number: (status code, description)
+    statuses = {}
+    # tracking numbers of each request sent
+    sent = []
+
+    def __init__(self, credentials, wsdl=None):
+        super(TrackRequest, self).__init__(credentials)
+        self.SelectionDetails = []
+
+    def send_request(self, transaction_id=None):
+        tracking_numbers = [
+            selection.PackageIdentifier.Value
+            for selection in self.SelectionDetails
+        ]
+        self.sent.append(tracking_numbers)
+
+        details = []
+        for tracking_number in tracking_numbers:
+            code, description = self.statuses.get(
+                tracking_number, ('IT', 'In transit')
+            )
+            detail = Element()
+            detail.TrackingNumber = tracking_number
+            detail.Notification.Severity = 'SUCCESS'
+            detail.StatusDetail.Code = code
+            detail.StatusDetail.Description = description
+            detail.ActualDeliveryTimestamp = \
+                datetime.utcnow() if code == 'DL' else None
+            detail.Events = []
+            details.append(detail)
+
+        completed = Element()
+        completed.TrackDetails = details
+        reply = Element()
+        reply.CompletedTrackDetails = [completed]
+        return reply
+
+
+class RateService(StandinRequest):
+    """
+    Stands for fedex.RateService. Every service asked for costs 12.34 in
+    the preferred currency, FEDEX_GROUND and FEDEX_2_DAY are returned when
+    no service is asked for.
+    """
+    # service types of each request sent
+    sent = []
+
+    def __init__(self, credentials):
+        super(RateService, self).__init__(credentials)
+        self.RequestedShipment = Element()
+
+    def send_request(self, transaction_id=None):
+        requested_shipment = self.RequestedShipment
+        service_type = vars(requested_shipment).get('ServiceType')
+        self.sent.append(service_type)
+
+        details = []
+        for rated_service in (
+                [service_type] if service_type
+                else ['FEDEX_GROUND', 'FEDEX_2_DAY']):
+            rated = Element()
+            rated.ShipmentRateDetail.TotalNetCharge.Amount = Decimal('12.34')
+            rated.ShipmentRateDetail.TotalNetCharge.Currency = \
+                requested_shipment.PreferredCurrency
+            detail = Element()
+            detail.ServiceType = rated_service
+            detail.RatedShipmentDetails = [rated]
+            details.append(detail)
+
+        reply = Element()
+        reply.HighestSeverity = 'SUCCESS'
+        reply.RateReplyDetails = details
+        return reply
+
+
+class ProcessShipmentRequest(StandinRequest):
+    """
+    Stands for fedex.ProcessShipmentRequest. Packages get tracking numbers
+    in the order they are sent and the shipment is rated with its last
+    package.
+    """
+    # (sequence number, master tracking number) of each package sent
+    sent = []
+
+    def __init__(self, credentials):
+        super(ProcessShipmentRequest, self).__init__(credentials)
+        self.RequestedShipment = Element()
+
+    def send_request(self, transaction_id=None):
+        shipment = self.RequestedShipment
+        item, = shipment.RequestedPackageLineItems
+        master = shipment.__dict__.get('MasterTrackingId')
+        self.sent.append((
+            item.SequenceNumber, master and master.TrackingNumber
+        ))
+
+        tracking_id = Element()
+        tracking_id.TrackingNumber = '7940000%05d' % len(self.sent)
+        part = Element()
+        part.Image = base64.encodestring('label')
+        package = Element()
+        package.TrackingIds = [tracking_id]
+        package.Label.Parts = [part]
+
+        reply = Element()
+        reply.lean_reply = None
+        reply.HighestSeverity = 'SUCCESS'
+        reply.CompletedShipmentDetail.CompletedPackageDetails = [package]
+        if item.SequenceNumber == shipment.PackageCount:
+            rate = Element()
+            rate.TotalNetCharge.Amount = Decimal('25.17')
+            rate.TotalNetCharge.Currency = 'USD'
+            reply.CompletedShipmentDetail.ShipmentRating.\
+                ShipmentRateDetails = [rate]
+        else:
+            reply.CompletedShipmentDetail.ShipmentRating = None
+        return reply
+
+
+class AddressValidationService(StandinRequest):
+    """
+    Stands for fedex.AddressValidationService. Addresses are confirmed
+    unless their first street line is in `undeliverable`.
+    """
+    undeliverable = set()
+    # number of addresses of each request sent
+    sent = []
+
+    def __init__(self, credentials):
+        super(AddressValidationService, self).__init__(credentials)
+        self.AddressToValidate = []
+        self.AddressValidationOptions = Element()
+
+    def send_request(self, transaction_id=None):
+        self.sent.append(len(self.AddressToValidate))
+
+        results = []
+        for item in self.AddressToValidate:
+            detail = Element()
+            detail.Score = 100
+            if item.Address.StreetLines[0] in self.undeliverable:
+                detail.Changes = ['INSUFFICIENT_DATA']
+                detail.DeliveryPointValidation = 'UNCONFIRMED'
+            else:
+                detail.Changes = ['NO_CHANGES']
+                detail.DeliveryPointValidation = 'CONFIRMED'
+            result = Element()
+            result.AddressId = item.AddressId
+            result.ProposedAddressDetails = [detail]
+            results.append(result)
+
+        reply = Element()
+        reply.HighestSeverity = 'SUCCESS'
+        reply.AddressResults = results
+        return reply
+
+
+class DeleteShipmentRequest(StandinRequest):
+    """
+    Stands for fedex.DeleteShipmentRequest. Shipments are deleted unless
+    their tracking number is in `shipped`.
+    """
+    shipped = set()
+    # tracking numbers of each shipment deleted
+    deleted = []
+
+    def __init__(self, credentials):
+        super(DeleteShipmentRequest, self).__init__(credentials)
+        self.TrackingId = Element()
+
+    def send_request(self, transaction_id=None):
+        tracking_number = self.TrackingId.TrackingNumber
+        if tracking_number in self.shipped:
+            raise Exception('Shipment %s is already shipped' % tracking_number)
+        self.deleted.append(tracking_number)
+        reply = Element()
+        reply.HighestSeverity = 'SUCCESS'
+        return reply
+
+
+class GroundCloseRequest(StandinRequest):
+    """
+    Stands for fedex.GroundCloseRequest. The manifest lists the time the
+    shipments were closed up to.
+    """
+    # account numbers of each close sent
+    closed = []
+
+    def __init__(self, credentials, wsdl=None):
+        super(GroundCloseRequest, self).__init__(credentials)
+        self.TimeUpToWhichShipmentsAreToBeClosed = None
+
+    def send_request(self, transaction_id=None):
+        self.closed.append(self.credentials.AccountNumber)
+        reply = Element()
+        reply.HighestSeverity = 'SUCCESS'
+        reply.Manifest.FileName = 'Manifest_%s.txt' % (
+            self.credentials.AccountNumber
+        )
+        reply.Manifest.File = base64.encodestring(
+            'Closed up to %s' % self.TimeUpToWhichShipmentsAreToBeClosed
+        )
+        return reply
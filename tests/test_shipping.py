@@ -7,6 +7,7 @@
 """
 from decimal import Decimal
 
+import pytest
 from trytond.transaction import Transaction
 from trytond.config import config
 config.set('database', 'path', '/tmp')
@@ -229,3 +230,1989 @@ class TestShipping:
         assert shipment.tracking_number is not None
         assert Attachment.search([], count=True) == 2
         assert shipment.cost > Decimal('0')
+
+    def test_fedex_rate_reused(self, dataset, transaction):
+        """The quoted rate is reused until the rated inputs change.
+        """
+        from trytond.modules.shipping_fedex import metrics
+
+        Sale = self.POOL.get('sale.sale')
+
+        data = dataset()
+
+        sale, = Sale.create([{
+            'party': data.customer.id,
+            'invoice_address': data.customer.addresses[0].id,
+            'shipment_address': data.customer.addresses[0].id,
+            'company': data.company.id,
+            'currency': data.currency_usd.id,
+            'carrier': data.fedex_carrier.id,
+            'payment_term': data.payment_term.id,
+            'fedex_drop_off_type':
+                data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+            'fedex_packaging_type':
+                data.get_fedex_packaging_type('FEDEX_BOX'),
+            'fedex_service_type': data.get_fedex_service_type('FEDEX_2_DAY'),
+            'lines': [('create', [{
+                'type': 'line',
+                'quantity': 1,
+                'product': data.product1.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire',
+                'unit': data.uom_unit.id,
+            }])]
+        }])
+
+        Sale.quote([sale])
+
+        assert sale.fedex_rate_amount > Decimal('0')
+        assert sale.fedex_rate_fingerprint == \
+            sale.get_fedex_rating_fingerprint()
+
+        performed = metrics.get('rate.performed')
+        skipped = metrics.get('rate.skipped')
+
+        # Nothing changed, FedEx is not asked again
+        Sale.update_fedex_shipment_cost([sale])
+
+        assert metrics.get('rate.performed') == performed
+        assert metrics.get('rate.skipped') == skipped + 1
+        assert len(sale.lines) == 2
+
+        Sale.confirm([sale])
+        Sale.process([sale])
+
+        # The shipment uses the quote as long as it matches what was rated
+        shipment, = sale.shipments
+        assert shipment.fedex_rate_fingerprint == sale.fedex_rate_fingerprint
+        assert shipment.get_fedex_shipping_cost() == (
+            sale.fedex_rate_amount, sale.fedex_rate_currency.id
+        )
+        assert metrics.get('rate.performed') == performed
+
+    def test_fedex_rate_carried_to_shipment(
+        self, dataset, transaction, monkeypatch
+    ):
+        """The shipment reuses the quote of its sale, in any cost currency.
+        """
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from fedex_standin import RateService
+
+        Sale = self.POOL.get('sale.sale')
+        Shipment = self.POOL.get('stock.shipment.out')
+        Currency = self.POOL.get('currency.currency')
+
+        monkeypatch.setattr(fedex, 'RateService', RateService)
+        monkeypatch.setattr(RateService, 'sent', [])
+
+        data = dataset()
+
+        sale, = Sale.create([{
+            'party': data.customer.id,
+            'invoice_address': data.customer.addresses[0].id,
+            'shipment_address': data.customer.addresses[0].id,
+            'company': data.company.id,
+            'currency': data.currency_usd.id,
+            'carrier': data.fedex_carrier.id,
+            'payment_term': data.payment_term.id,
+            'fedex_drop_off_type':
+                data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+            'fedex_packaging_type':
+                data.get_fedex_packaging_type('FEDEX_BOX'),
+            'fedex_service_type': data.get_fedex_service_type('FEDEX_2_DAY'),
+            'lines': [('create', [{
+                'type': 'line',
+                'quantity': 1,
+                'product': data.product1.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire',
+                'unit': data.uom_unit.id,
+            }])]
+        }])
+        with Transaction().set_context(fedex_force_rating=True):
+            amount, currency_id = sale.get_fedex_shipping_cost()
+
+        assert sale.fedex_rate_service.value == 'FEDEX_2_DAY'
+        assert sale.fedex_rate_amount == amount
+        assert sale.fedex_rate_currency.id == currency_id
+        assert sale.fedex_rate_date is not None
+        assert sale.fedex_rate_weight == \
+            round(sale._get_fedex_package_weight(), 2)
+
+        Sale.quote([sale])
+        Sale.confirm([sale])
+        Sale.process([sale])
+        shipment, = sale.shipments
+        assert shipment.fedex_rate_fingerprint == sale.fedex_rate_fingerprint
+        sent = len(RateService.sent)
+
+        # The shipment is costed in another currency than the sale
+        euro, = Currency.create([{
+            'name': 'Euro',
+            'code': 'EUR',
+            'symbol': 'EUR',
+        }])
+        Shipment.write([shipment], {'cost_currency': euro.id})
+        shipment = Shipment(shipment.id)
+
+        assert shipment.get_fedex_rating_fingerprint() == \
+            sale.fedex_rate_fingerprint
+        assert shipment.get_fedex_shipping_cost() == (amount, currency_id)
+        assert len(RateService.sent) == sent
+
+    def test_fedex_rate_sale_currency(self, dataset, transaction, monkeypatch):
+        """The shipping line follows the currency of the sale without rating.
+        """
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from fedex_standin import RateService
+
+        Sale = self.POOL.get('sale.sale')
+        Currency = self.POOL.get('currency.currency')
+
+        monkeypatch.setattr(fedex, 'RateService', RateService)
+        monkeypatch.setattr(RateService, 'sent', [])
+
+        data = dataset()
+
+        euro, = Currency.create([{
+            'name': 'Euro',
+            'code': 'EUR',
+            'symbol': 'EUR',
+            'rates': [('create', [{'rate': Decimal('0.5')}])],
+        }])
+        Currency.write([data.currency_usd], {
+            'rates': [('create', [{'rate': Decimal('1')}])],
+        })
+
+        sale, = Sale.create([{
+            'party': data.customer.id,
+            'invoice_address': data.customer.addresses[0].id,
+            'shipment_address': data.customer.addresses[0].id,
+            'company': data.company.id,
+            'currency': data.currency_usd.id,
+            'carrier': data.fedex_carrier.id,
+            'payment_term': data.payment_term.id,
+            'fedex_drop_off_type':
+                data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+            'fedex_packaging_type':
+                data.get_fedex_packaging_type('FEDEX_BOX'),
+            'fedex_service_type': data.get_fedex_service_type('FEDEX_2_DAY'),
+            'lines': [('create', [{
+                'type': 'line',
+                'quantity': 1,
+                'product': data.product1.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire',
+                'unit': data.uom_unit.id,
+            }])]
+        }])
+        sale.apply_fedex_shipping()
+        sale = Sale(sale.id)
+        sent = len(RateService.sent)
+
+        shipping_line, = [
+            line for line in sale.lines if line.shipment_cost
+        ]
+        assert shipping_line.unit_price == Decimal('12.34')
+
+        Sale.write([sale], {'currency': euro.id})
+        sale = Sale(sale.id)
+        assert sale.is_fedex_rate_current()
+
+        sale.apply_fedex_shipping()
+        sale = Sale(sale.id)
+
+        # The kept rate is converted again, FedEx is not asked
+        shipping_line, = [
+            line for line in sale.lines if line.shipment_cost
+        ]
+        assert shipping_line.unit_price == Decimal('6.17')
+        assert len(RateService.sent) == sent
+
+    def test_fedex_rate_estimates(self, dataset, transaction):
+        """Rates can be estimated for a cart without writing any record.
+        """
+        Sale = self.POOL.get('sale.sale')
+        Carrier = self.POOL.get('carrier')
+        RateCache = self.POOL.get('fedex.rate.cache')
+
+        data = dataset()
+
+        address = {
+            'city': 'Miami',
+            'state_code': 'US-FL',
+            'postal_code': '33137',
+            'country_code': 'US',
+        }
+        lines = [(data.product1.id, 2), (data.product2.id, 1)]
+
+        estimates = data.fedex_carrier.get_fedex_rate_estimates(
+            address, lines, 'FEDEX_2_DAY'
+        )
+
+        estimate, = estimates
+        assert estimate['service_type'] == 'FEDEX_2_DAY'
+        assert estimate['amount'] > Decimal('0')
+        assert estimate['currency'] == 'USD'
+
+        # Rating all the services returns the cheapest first
+        estimates = data.fedex_carrier.get_fedex_rate_estimates(
+            address, lines
+        )
+        assert len(estimates) > 1
+        assert estimates == sorted(
+            estimates, key=lambda estimate: estimate['amount']
+        )
+
+        # Nothing was written, not even the rate cache
+        assert Sale.search([], count=True) == 0
+        assert RateCache.search([], count=True) == 0
+
+        # The estimate is served from the cache of this process next time
+        cached = Carrier(data.fedex_carrier.id).get_fedex_rate_estimates(
+            address, lines, 'FEDEX_2_DAY'
+        )
+        assert cached == [estimate]
+
+    def test_fedex_origin_rates(self, dataset, transaction, monkeypatch):
+        """A sale is shipped from the warehouse with the cheapest rate.
+        """
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from fedex_standin import RateService
+
+        Sale = self.POOL.get('sale.sale')
+        Location = self.POOL.get('stock.location')
+
+        monkeypatch.setattr(fedex, 'RateService', RateService)
+        monkeypatch.setattr(RateService, 'sent', [])
+
+        data = dataset()
+        warehouse, = Location.search([('type', '=', 'warehouse')])
+
+        # A second warehouse, close to the customer
+        input_, output, storage = Location.create([{
+            'name': name,
+            'type': 'storage',
+        } for name in ('East Input', 'East Output', 'East Storage')])
+        east, = Location.create([{
+            'name': 'East Warehouse',
+            'type': 'warehouse',
+            'address': data.customer.addresses[0].id,
+            'input_location': input_.id,
+            'output_location': output.id,
+            'storage_location': storage.id,
+        }])
+        warehouses = Location.search([('type', '=', 'warehouse')])
+        assert east in warehouses
+
+        sale, = Sale.create([{
+            'party': data.customer.id,
+            'invoice_address': data.customer.addresses[0].id,
+            'shipment_address': data.customer.addresses[0].id,
+            'company': data.company.id,
+            'currency': data.currency_usd.id,
+            'carrier': data.fedex_carrier.id,
+            'payment_term': data.payment_term.id,
+            'warehouse': warehouse.id,
+            'fedex_drop_off_type':
+                data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+            'fedex_packaging_type':
+                data.get_fedex_packaging_type('FEDEX_BOX'),
+            'fedex_service_type': data.get_fedex_service_type('FEDEX_2_DAY'),
+            'lines': [('create', [{
+                'type': 'line',
+                'quantity': 1,
+                'product': data.product1.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire',
+                'unit': data.uom_unit.id,
+            }])]
+        }])
+
+        options = Sale.get_fedex_origin_rates([sale])[sale.id]
+        assert set(option[0] for option in options) == \
+            set(warehouse.id for warehouse in warehouses)
+        assert options == sorted(options, key=lambda option: option[2])
+        assert all(option[3] == 'USD' for option in options)
+
+        Sale.choose_fedex_origin([sale])
+        sale = Sale(sale.id)
+        warehouse_id, service_type, amount, _ = options[0]
+        assert sale.warehouse.id == warehouse_id
+        assert sale.fedex_service_type.value == service_type
+        assert sale.fedex_rate_amount == amount
+        assert sale.is_fedex_rate_current()
+        assert len(sale.lines) == 2
+
+    def test_fedex_rate_prewarm(self, dataset, transaction, monkeypatch):
+        """The lanes quoted most are rated before the quotes of the day.
+        """
+        from datetime import datetime
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from fedex_standin import RateService
+
+        Sale = self.POOL.get('sale.sale')
+        RateCache = self.POOL.get('fedex.rate.cache')
+
+        monkeypatch.setattr(fedex, 'RateService', RateService)
+        monkeypatch.setattr(RateService, 'sent', [])
+
+        data = dataset()
+
+        sales = Sale.create([{
+            'party': data.customer.id,
+            'invoice_address': data.customer.addresses[0].id,
+            'shipment_address': data.customer.addresses[0].id,
+            'company': data.company.id,
+            'currency': data.currency_usd.id,
+            'carrier': data.fedex_carrier.id,
+            'payment_term': data.payment_term.id,
+            'fedex_drop_off_type':
+                data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+            'fedex_packaging_type':
+                data.get_fedex_packaging_type('FEDEX_BOX'),
+            'fedex_service_type': data.get_fedex_service_type('FEDEX_2_DAY'),
+            'lines': [('create', [{
+                'type': 'line',
+                'quantity': 1,
+                'product': data.product1.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire',
+                'unit': data.uom_unit.id,
+            }])]
+        } for _ in xrange(2)])
+        # Both sales were quoted earlier on the same lane
+        Sale.write(sales, {
+            'fedex_rate_service': data.get_fedex_service_type('FEDEX_2_DAY'),
+            'fedex_rate_amount': Decimal('10'),
+            'fedex_rate_currency': data.currency_usd.id,
+            'fedex_rate_date': datetime.utcnow(),
+            'fedex_rate_weight': round(sales[0]._get_fedex_package_weight(), 2),
+        })
+
+        report = RateCache.prewarm_fedex_rates()
+        assert report == {
+            'lanes': 1,
+            'warmed': 1,
+            'errors': 0,
+            'hit_rate_before': 0.0,
+            'hit_rate_after': 100.0,
+        }
+        assert RateService.sent == ['FEDEX_2_DAY']
+
+        # The next quote on the lane is served by the cache
+        amount, _ = Sale(sales[0].id).get_fedex_shipping_cost()
+        assert amount == Decimal('12.34')
+        assert len(RateService.sent) == 1
+
+        # Lanes cached already are not rated again
+        report = RateCache.prewarm_fedex_rates()
+        assert (report['warmed'], report['hit_rate_before']) == (0, 100.0)
+        assert len(RateService.sent) == 1
+
+    def test_fedex_speculative_quote(
+        self, dataset, transaction, monkeypatch
+    ):
+        """A draft sale is rated while it is edited and quoted from it.
+        """
+        from trytond.modules.shipping_fedex import metrics
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from trytond.modules.shipping_fedex.speculation import \
+            speculative_rates
+        from fedex_standin import RateService
+
+        Sale = self.POOL.get('sale.sale')
+        SaleConfiguration = self.POOL.get('sale.configuration')
+
+        monkeypatch.setattr(fedex, 'RateService', RateService)
+        monkeypatch.setattr(RateService, 'sent', [])
+        speculative_rates.clear()
+
+        data = dataset()
+
+        sale, = Sale.create([{
+            'party': data.customer.id,
+            'invoice_address': data.customer.addresses[0].id,
+            'shipment_address': data.customer.addresses[0].id,
+            'company': data.company.id,
+            'currency': data.currency_usd.id,
+            'carrier': data.fedex_carrier.id,
+            'payment_term': data.payment_term.id,
+            'fedex_drop_off_type':
+                data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+            'fedex_packaging_type':
+                data.get_fedex_packaging_type('FEDEX_BOX'),
+            'fedex_service_type': data.get_fedex_service_type('FEDEX_2_DAY'),
+            'lines': [('create', [{
+                'type': 'line',
+                'quantity': 1,
+                'product': data.product1.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire',
+                'unit': data.uom_unit.id,
+            }])]
+        }])
+
+        # Nothing is asked for until enabled
+        sale.on_change_lines()
+        assert RateService.sent == []
+
+        SaleConfiguration.write([SaleConfiguration(1)], {
+            'fedex_speculative_quotes': True,
+        })
+        sent = metrics.get('rate.speculative.sent')
+        sale.on_change_lines()
+        sale.on_change_carrier()
+        # The same inputs are rated once
+        assert metrics.get('rate.speculative.sent') == sent + 1
+
+        hit = metrics.get('rate.speculative.hit')
+        performed = metrics.get('rate.performed')
+        Sale.quote([sale])
+
+        assert metrics.get('rate.speculative.hit') == hit + 1
+        assert metrics.get('rate.performed') == performed
+        assert RateService.sent == ['FEDEX_2_DAY']
+        assert sale.fedex_rate_amount == Decimal('12.34')
+        assert len(sale.lines) == 2
+
+    def test_fedex_speculative_new_sale(
+        self, dataset, transaction, monkeypatch
+    ):
+        """A sale being created is rated without replacing other new sales.
+        """
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from trytond.modules.shipping_fedex.speculation import \
+            speculative_rates
+        from fedex_standin import RateService
+
+        Sale = self.POOL.get('sale.sale')
+        SaleLine = self.POOL.get('sale.line')
+        SaleConfiguration = self.POOL.get('sale.configuration')
+        Location = self.POOL.get('stock.location')
+        Uom = self.POOL.get('product.uom')
+
+        monkeypatch.setattr(fedex, 'RateService', RateService)
+        monkeypatch.setattr(RateService, 'sent', [])
+        speculative_rates.clear()
+
+        data = dataset()
+        SaleConfiguration.write([SaleConfiguration(1)], {
+            'fedex_speculative_quotes': True,
+        })
+        warehouse, = Location.search([('type', '=', 'warehouse')])
+        uom_pound, = Uom.search([('symbol', '=', 'lb')])
+        database_name = transaction.cursor.database_name
+
+        fingerprints = []
+        for quantity in (1, 2):
+            # What the client sends for a sale never saved
+            sale = Sale()
+            sale.state = 'draft'
+            sale.party = data.customer
+            sale.shipment_address = data.customer.addresses[0]
+            sale.currency = data.currency_usd
+            sale.carrier = data.fedex_carrier
+            sale.warehouse = warehouse
+            sale.fedex_drop_off_type = \
+                data.get_fedex_drop_off_type('REGULAR_PICKUP')
+            sale.fedex_packaging_type = \
+                data.get_fedex_packaging_type('FEDEX_BOX')
+            sale.fedex_service_type = \
+                data.get_fedex_service_type('FEDEX_2_DAY')
+            sale.weight_uom = uom_pound
+            sale.package_weight = .7 * quantity
+            sale.lines = [SaleLine(
+                type='line', product=data.product1, quantity=quantity,
+                unit=data.uom_unit, unit_price=Decimal('119.00'),
+                amount=Decimal('119.00') * quantity, description='KindleFire',
+                taxes=[],
+            )]
+            sale.on_change_lines()
+            fingerprints.append(sale.get_fedex_rating_fingerprint())
+
+        # Both are kept, the second did not replace the first
+        for fingerprint in fingerprints:
+            rate = speculative_rates.get((database_name, fingerprint), 5)
+            assert rate is not None
+        assert len(RateService.sent) == 2
+
+    def test_fedex_speculative_rates(self):
+        """Only the last rate of a sale is kept, a few by carrier at once.
+        """
+        import threading
+        from trytond.modules.shipping_fedex.speculation import \
+            SpeculativeRates
+
+        rates = SpeculativeRates(max_pending=1)
+        release = threading.Event()
+
+        def slow_rate():
+            release.wait(5)
+            return 'slow'
+
+        assert rates.submit('a', slow_rate, owner='sale1', group='carrier')
+        # The carrier has as many rates being fetched as allowed
+        assert not rates.submit(
+            'b', lambda: 'b', owner='sale2', group='carrier'
+        )
+        release.set()
+        assert rates.get('a', 5) == 'slow'
+
+        # The new rate of a sale replaces the previous one
+        assert rates.submit('c', lambda: 'c', owner='sale1', group='carrier')
+        assert rates.get('c', 5) == 'c'
+        assert rates.get('a') is None
+
+    def test_fedex_tracking_update(self, dataset, transaction, monkeypatch):
+        """The status of undelivered packages is asked to FedEx in batches.
+        """
+        from trytond.modules.shipping_fedex import tracking
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from fedex_standin import TrackRequest, RateService
+
+        Sale = self.POOL.get('sale.sale')
+        Package = self.POOL.get('stock.package')
+        Tracking = self.POOL.get('fedex.package.tracking')
+        ModelData = self.POOL.get('ir.model.data')
+
+        monkeypatch.setattr(fedex, 'RateService', RateService)
+        monkeypatch.setattr(RateService, 'sent', [])
+        monkeypatch.setattr(fedex, 'TrackRequest', TrackRequest)
+        monkeypatch.setattr(tracking, 'TRACK_BATCH_SIZE', 1)
+        monkeypatch.setattr(TrackRequest, 'sent', [])
+        monkeypatch.setattr(TrackRequest, 'statuses', {
+            '794000000001': ('DL', 'Delivered'),
+        })
+
+        data = dataset()
+
+        sale, = Sale.create([{
+            'party': data.customer.id,
+            'invoice_address': data.customer.addresses[0].id,
+            'shipment_address': data.customer.addresses[0].id,
+            'company': data.company.id,
+            'currency': data.currency_usd.id,
+            'carrier': data.fedex_carrier.id,
+            'payment_term': data.payment_term.id,
+            'lines': [('create', [{
+                'type': 'line',
+                'quantity': 1,
+                'product': data.product1.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire',
+                'unit': data.uom_unit.id,
+            }, {
+                'type': 'line',
+                'quantity': 2,
+                'product': data.product2.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire HD',
+                'unit': data.uom_unit.id,
+            }])]
+        }])
+        Sale.quote([sale])
+        Sale.confirm([sale])
+        Sale.process([sale])
+
+        shipment, = sale.shipments
+
+        type_id = ModelData.get_id("shipping", "shipment_package_type")
+        package1, package2 = Package.create([{
+            'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+            'type': type_id,
+            'tracking_number': '794000000001',
+            'moves': [('add', [shipment.outgoing_moves[0]])],
+        }, {
+            'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+            'type': type_id,
+            'tracking_number': '794000000002',
+            'moves': [('add', [shipment.outgoing_moves[1]])],
+        }])
+        Tracking.create([{
+            'package': package.id,
+            'shipment': shipment.id,
+            'carrier': data.fedex_carrier.id,
+            'tracking_number': package.tracking_number,
+        } for package in (package1, package2)])
+
+        Tracking.update_fedex_tracking()
+
+        # One request per batch
+        assert sorted(TrackRequest.sent) == [
+            ['794000000001'], ['794000000002']
+        ]
+        delivered, = Tracking.search([('delivered', '=', True)])
+        assert delivered.package == package1
+        assert delivered.delivery_date is not None
+        in_transit, = Tracking.search([('delivered', '=', False)])
+        assert in_transit.status_code == 'IT'
+        assert in_transit.last_checked is not None
+
+        # Delivered packages are not asked again
+        TrackRequest.sent[:] = []
+        Tracking.update_fedex_tracking()
+        assert TrackRequest.sent == [['794000000002']]
+
+    def test_resolve_tracking_numbers(self, dataset, transaction):
+        """Tracking numbers are resolved to their shipment and package.
+        """
+        Shipment = self.POOL.get('stock.shipment.out')
+        Location = self.POOL.get('stock.location')
+        Package = self.POOL.get('stock.package')
+        Tracking = self.POOL.get('fedex.package.tracking')
+        ModelData = self.POOL.get('ir.model.data')
+
+        data = dataset()
+
+        warehouse, = Location.search([('type', '=', 'warehouse')])
+        shipment, = Shipment.create([{
+            'customer': data.customer.id,
+            'delivery_address': data.customer.addresses[0].id,
+            'warehouse': warehouse.id,
+            'company': data.company.id,
+            'carrier': data.fedex_carrier.id,
+            'cost_currency': data.currency_usd.id,
+        }])
+        type_id = ModelData.get_id("shipping", "shipment_package_type")
+        package1, package2 = Package.create([{
+            'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+            'type': type_id,
+        }, {
+            'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+            'type': type_id,
+        }])
+        Tracking.create([{
+            'tracking_number': '794000000001',
+            'shipment': shipment.id,
+            'package': package1.id,
+            'carrier': data.fedex_carrier.id,
+            'master': True,
+        }, {
+            'tracking_number': '794000000002',
+            'shipment': shipment.id,
+            'package': package2.id,
+            'carrier': data.fedex_carrier.id,
+        }])
+
+        result = Tracking.resolve_tracking_numbers([
+            '794000000001', '794000000002', '794000000009',
+        ])
+
+        assert result == {
+            '794000000001': {
+                'shipment': shipment.id,
+                'package': package1.id,
+                'master': True,
+            },
+            '794000000002': {
+                'shipment': shipment.id,
+                'package': package2.id,
+                'master': False,
+            },
+        }
+
+    def test_ingest_fedex_tracking_events(self, dataset, transaction):
+        """Pushed tracking events are stored once and deliver shipments.
+        """
+        Shipment = self.POOL.get('stock.shipment.out')
+        Location = self.POOL.get('stock.location')
+        Package = self.POOL.get('stock.package')
+        Tracking = self.POOL.get('fedex.package.tracking')
+        Event = self.POOL.get('fedex.tracking.event')
+        ModelData = self.POOL.get('ir.model.data')
+
+        data = dataset()
+
+        warehouse, = Location.search([('type', '=', 'warehouse')])
+        shipment, = Shipment.create([{
+            'customer': data.customer.id,
+            'delivery_address': data.customer.addresses[0].id,
+            'warehouse': warehouse.id,
+            'company': data.company.id,
+            'carrier': data.fedex_carrier.id,
+            'cost_currency': data.currency_usd.id,
+        }])
+        type_id = ModelData.get_id("shipping", "shipment_package_type")
+        packages = Package.create([{
+            'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+            'type': type_id,
+        }, {
+            'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+            'type': type_id,
+        }])
+        for package, tracking_number in zip(
+                packages, ['794000000001', '794000000002']):
+            Tracking.create([{
+                'tracking_number': tracking_number,
+                'shipment': shipment.id,
+                'package': package.id,
+                'carrier': data.fedex_carrier.id,
+            }])
+
+        events = [{
+            'tracking_number': '794000000001',
+            'code': 'PU',
+            'description': 'Picked up',
+            'timestamp': '2015-06-01T09:00:00-04:00',
+        }, {
+            'tracking_number': '794000000001',
+            'code': 'DL',
+            'description': 'Delivered',
+            'timestamp': '2015-06-02T10:00:00-04:00',
+        }, {
+            'tracking_number': '794000000009',
+            'code': 'PU',
+            'timestamp': '2015-06-01T09:00:00Z',
+        }]
+        assert Event.ingest_fedex_tracking_events(events) == 3
+        # The same events pushed again are ignored
+        assert Event.ingest_fedex_tracking_events(events) == 0
+        assert Event.search([], count=True) == 3
+
+        tracking1, = Tracking.search([
+            ('tracking_number', '=', '794000000001')
+        ])
+        assert tracking1.delivered
+        assert tracking1.status_code == 'DL'
+        assert str(tracking1.delivery_date) == '2015-06-02 14:00:00'
+
+        # One package is still on its way
+        assert not Shipment(shipment.id).fedex_delivered
+
+        Event.ingest_fedex_tracking_events([{
+            'tracking_number': '794000000002',
+            'code': 'DL',
+            'timestamp': '2015-06-03T10:00:00Z',
+        }])
+        shipment = Shipment(shipment.id)
+        assert shipment.fedex_delivered
+        assert str(shipment.fedex_delivery_date) == '2015-06-03 10:00:00'
+
+    def test_fedex_async_rates(self, dataset, transaction):
+        """Several lanes are rated at the same time.
+        """
+        Sale = self.POOL.get('sale.sale')
+        Location = self.POOL.get('stock.location')
+
+        data = dataset()
+
+        warehouse = Location(Sale.default_warehouse())
+        shipper = warehouse.address.address_to_fedex_dict()
+        recipient = data.customer.addresses[0].address_to_fedex_dict()
+
+        futures = [
+            data.fedex_carrier.async_get_rates(
+                shipper, recipient, weight, 'USD', 'REGULAR_PICKUP',
+                'YOUR_PACKAGING', 'FEDEX_GROUND', persist=False
+            ) for weight in (1, 10, 50)
+        ]
+        results = [future.result() for future in futures]
+
+        for rates in results:
+            (service_type, amount, currency_code), = rates
+            assert service_type == 'FEDEX_GROUND'
+            assert amount > Decimal('0')
+        assert results[0][0][1] < results[2][0][1]
+
+        # The sync API returns the same rates
+        assert data.fedex_carrier.get_fedex_rates(
+            shipper, recipient, 10, 'USD', 'REGULAR_PICKUP',
+            'YOUR_PACKAGING', 'FEDEX_GROUND', persist=False
+        ) == results[1]
+
+    def test_fedex_bulk_validation(self, dataset, transaction, monkeypatch):
+        """Sales FedEx would refuse are found and skipped before rating.
+        """
+        from trytond.exceptions import UserError
+        from trytond.modules.shipping_fedex import metrics
+
+        Sale = self.POOL.get('sale.sale')
+        Party = self.POOL.get('party.party')
+        Address = self.POOL.get('party.address')
+
+        data = dataset()
+
+        # No state and no postal code
+        bad_address, = Address.create([{
+            'party': data.customer.id,
+            'name': 'John Doe',
+            'street': '250 NE 25th St',
+            'city': 'Miami',
+            'country': data.customer.addresses[0].country.id,
+        }])
+
+        def create_sale(address, lines=True):
+            sale, = Sale.create([{
+                'party': data.customer.id,
+                'invoice_address': data.customer.addresses[0].id,
+                'shipment_address': address.id,
+                'company': data.company.id,
+                'currency': data.currency_usd.id,
+                'carrier': data.fedex_carrier.id,
+                'payment_term': data.payment_term.id,
+                'fedex_drop_off_type':
+                    data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+                'fedex_packaging_type':
+                    data.get_fedex_packaging_type('FEDEX_BOX'),
+                'fedex_service_type':
+                    data.get_fedex_service_type('FEDEX_2_DAY'),
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 1,
+                    'product': data.product1.id,
+                    'unit_price': Decimal('119.00'),
+                    'description': 'KindleFire',
+                    'unit': data.uom_unit.id,
+                }] if lines else [])]
+            }])
+            return sale
+
+        good_sale = create_sale(data.customer.addresses[0])
+        bad_sale = create_sale(bad_address)
+        empty_sale = create_sale(data.customer.addresses[0], lines=False)
+
+        problems = Sale.get_fedex_problems([good_sale, bad_sale, empty_sale])
+        assert good_sale.id not in problems
+        assert len(problems[bad_sale.id]) == 2
+        assert len(problems[empty_sale.id]) == 1
+
+        # The phone number is only needed for labels
+        no_phone, = Party.create([{'name': 'No Phone'}])
+        address, = Address.copy([data.customer.addresses[0]], {
+            'party': no_phone.id,
+        })
+        assert Address.get_fedex_address_problems([address], phone=False) \
+            == {}
+        assert len(Address.get_fedex_address_problems([address])[
+            address.id]) == 1
+
+        rated = []
+        monkeypatch.setattr(
+            Sale, 'apply_fedex_shipping', lambda sale: rated.append(sale.id)
+        )
+        skipped = metrics.get('validation.skipped')
+        Sale.update_fedex_shipment_cost([good_sale, bad_sale, empty_sale])
+        assert rated == [good_sale.id]
+        assert metrics.get('validation.skipped') == skipped + 2
+
+        # Nothing left to rate, the problems are reported
+        try:
+            Sale.update_fedex_shipment_cost([bad_sale])
+        except UserError, exc:
+            assert 'state' in exc.message
+        else:
+            assert False, 'The invalid sale was rated'
+        assert rated == [good_sale.id]
+
+    def test_fedex_address_cache(self, dataset, transaction):
+        """Addresses are serialized once and again when modified.
+        """
+        Address = self.POOL.get('party.address')
+        ContactMechanism = self.POOL.get('party.contact_mechanism')
+        Subdivision = self.POOL.get('country.subdivision')
+
+        data = dataset()
+
+        with Transaction().set_context(company=data.company.id):
+            address = data.customer.addresses[0]
+            dicts = Address.addresses_to_fedex_dicts([address, address])
+            assert dicts.keys() == [address.id]
+            assert dicts[address.id]['state_code'] == 'US-FL'
+            assert dicts[address.id]['company_name'] == 'ABC Corp.'
+
+            # Callers can not alter the cached address
+            dicts[address.id]['streetlines'].append('Suite 1')
+            assert address.address_to_fedex_dict()['streetlines'] == [
+                '250 NE 25th St'
+            ]
+
+            Address.write([address], {'street': '251 NE 25th St'})
+            assert Address(address.id).address_to_fedex_dict()[
+                'streetlines'] == ['251 NE 25th St']
+
+            ContactMechanism.write(
+                list(data.customer.contact_mechanisms),
+                {'value': '(305) 555-0100'}
+            )
+            assert Address(address.id).address_to_fedex_dict()['phone'] == \
+                '3055550100'
+
+            Subdivision.write([address.subdivision], {'code': 'US-FX'})
+            assert Address(address.id).address_to_fedex_dict()[
+                'state_code'] == 'US-FX'
+
+    def test_fedex_address_validation(
+        self, dataset, transaction, monkeypatch
+    ):
+        """Addresses are validated in batches and the results reused.
+        """
+        from trytond.modules.shipping_fedex import address_validation
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from fedex_standin import AddressValidationService
+
+        Validation = self.POOL.get('fedex.address.validation')
+
+        monkeypatch.setattr(
+            fedex, 'AddressValidationService', AddressValidationService
+        )
+        monkeypatch.setattr(address_validation, 'VALIDATION_BATCH_SIZE', 2)
+        monkeypatch.setattr(AddressValidationService, 'sent', [])
+        monkeypatch.setattr(
+            AddressValidationService, 'undeliverable', set(['1 Nowhere Rd'])
+        )
+
+        data = dataset()
+        data.fedex_carrier.fedex_address_validation_ttl = 3600
+        data.fedex_carrier.save()
+
+        def address(street, city='Miami'):
+            return {
+                'streetlines': [street],
+                'city': city,
+                'state_code': 'US-FL',
+                'postal_code': '33137',
+                'country_code': 'US',
+            }
+
+        addresses = [
+            address('250 NE 25th St'),
+            address('1 Nowhere Rd'),
+            address('260 NE 25th St'),
+            # The same address as the first one, typed differently
+            address('250 ne 25th st.', city='MIAMI'),
+        ]
+        results = Validation.validate_fedex_addresses(
+            data.fedex_carrier, addresses
+        )
+        assert [valid for valid, _ in results] == [True, False, True, True]
+        assert results[1][1] == 'INSUFFICIENT_DATA'
+        # 3 distinct addresses sent in batches of 2
+        assert sorted(AddressValidationService.sent) == [1, 2]
+
+        # Known addresses are not sent again
+        assert Validation.validate_fedex_addresses(
+            data.fedex_carrier, addresses[:2]
+        ) == results[:2]
+        assert len(AddressValidationService.sent) == 2
+
+    def test_fedex_open_shipment(self, dataset, transaction, monkeypatch):
+        """Packages of an open shipment are labeled as they are packed.
+        """
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from fedex_standin import ProcessShipmentRequest
+
+        Sale = self.POOL.get('sale.sale')
+        Shipment = self.POOL.get('stock.shipment.out')
+        Attachment = self.POOL.get('ir.attachment')
+        Package = self.POOL.get('stock.package')
+        ModelData = self.POOL.get('ir.model.data')
+
+        monkeypatch.setattr(
+            fedex, 'ProcessShipmentRequest', ProcessShipmentRequest
+        )
+        monkeypatch.setattr(ProcessShipmentRequest, 'sent', [])
+        # The sale is not rated
+        monkeypatch.setattr(Sale, 'apply_fedex_shipping', lambda sale: None)
+
+        data = dataset()
+
+        sale, = Sale.create([{
+            'party': data.customer.id,
+            'invoice_address': data.customer.addresses[0].id,
+            'shipment_address': data.customer.addresses[0].id,
+            'company': data.company.id,
+            'currency': data.currency_usd.id,
+            'carrier': data.fedex_carrier.id,
+            'payment_term': data.payment_term.id,
+            'fedex_drop_off_type':
+                data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+            'fedex_packaging_type':
+                data.get_fedex_packaging_type('FEDEX_BOX'),
+            'fedex_service_type': data.get_fedex_service_type('FEDEX_2_DAY'),
+            'lines': [('create', [{
+                'type': 'line',
+                'quantity': 1,
+                'product': data.product1.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire',
+                'unit': data.uom_unit.id,
+            }, {
+                'type': 'line',
+                'quantity': 2,
+                'product': data.product2.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire HD',
+                'unit': data.uom_unit.id,
+            }])]
+        }])
+        Sale.quote([sale])
+        Sale.confirm([sale])
+        Sale.process([sale])
+
+        shipment, = sale.shipments
+        Shipment.write([shipment], {
+            'fedex_open_shipment': True,
+            'fedex_package_count': 2,
+        })
+        type_id = ModelData.get_id("shipping", "shipment_package_type")
+
+        with Transaction().set_context(company=data.company.id):
+            # The first package packed is the master package
+            package1, = Package.create([{
+                'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+                'type': type_id,
+                'moves': [('add', [shipment.outgoing_moves[0]])],
+            }])
+            # Nothing is billed until labels are asked for
+            assert ProcessShipmentRequest.sent == []
+            Shipment.label_fedex_new_packages([shipment])
+            shipment = Shipment(shipment.id)
+            package1 = Package(package1.id)
+            assert package1.tracking_number == '794000000001'
+            assert shipment.fedex_master_tracking_number == '794000000001'
+            assert not shipment.tracking_number
+            assert Attachment.search([], count=True) == 1
+
+            package2, = Package.create([{
+                'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+                'type': type_id,
+                'moves': [('add', [shipment.outgoing_moves[1]])],
+            }])
+            Shipment.label_fedex_new_packages([Shipment(shipment.id)])
+            # Labeled packages are not labeled again
+            Shipment.label_fedex_new_packages([Shipment(shipment.id)])
+            package2 = Package(package2.id)
+            assert package2.tracking_number == '794000000002'
+            assert ProcessShipmentRequest.sent == [
+                (1, None), (2, '794000000001'),
+            ]
+
+            # Packing completes the shipment without labeling again
+            Shipment.assign([shipment])
+            Shipment.pack([shipment])
+
+        shipment = Shipment(shipment.id)
+        assert shipment.tracking_number == '794000000001'
+        assert shipment.cost == Decimal('25.17')
+        assert len(ProcessShipmentRequest.sent) == 2
+        assert Attachment.search([], count=True) == 2
+
+    def test_fedex_labels_split(self, dataset, transaction, monkeypatch):
+        """Shipments with too many packages are sent as several masters.
+        """
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from fedex_standin import ProcessShipmentRequest, DeleteShipmentRequest
+
+        Sale = self.POOL.get('sale.sale')
+        Shipment = self.POOL.get('stock.shipment.out')
+        Package = self.POOL.get('stock.package')
+        Tracking = self.POOL.get('fedex.package.tracking')
+        ModelData = self.POOL.get('ir.model.data')
+
+        monkeypatch.setattr(
+            fedex, 'ProcessShipmentRequest', ProcessShipmentRequest
+        )
+        monkeypatch.setattr(
+            fedex, 'DeleteShipmentRequest', DeleteShipmentRequest
+        )
+        monkeypatch.setattr(ProcessShipmentRequest, 'sent', [])
+        monkeypatch.setattr(DeleteShipmentRequest, 'deleted', [])
+        monkeypatch.setattr(Sale, 'apply_fedex_shipping', lambda sale: None)
+
+        data = dataset()
+        data.fedex_carrier.fedex_max_packages = 1
+        data.fedex_carrier.save()
+
+        sale, = Sale.create([{
+            'party': data.customer.id,
+            'invoice_address': data.customer.addresses[0].id,
+            'shipment_address': data.customer.addresses[0].id,
+            'company': data.company.id,
+            'currency': data.currency_usd.id,
+            'carrier': data.fedex_carrier.id,
+            'payment_term': data.payment_term.id,
+            'fedex_drop_off_type':
+                data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+            'fedex_packaging_type':
+                data.get_fedex_packaging_type('FEDEX_BOX'),
+            'fedex_service_type': data.get_fedex_service_type('FEDEX_2_DAY'),
+            'lines': [('create', [{
+                'type': 'line',
+                'quantity': 1,
+                'product': data.product1.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire',
+                'unit': data.uom_unit.id,
+            }, {
+                'type': 'line',
+                'quantity': 2,
+                'product': data.product2.id,
+                'unit_price': Decimal('119.00'),
+                'description': 'KindleFire HD',
+                'unit': data.uom_unit.id,
+            }])]
+        }])
+        Sale.quote([sale])
+        Sale.confirm([sale])
+        Sale.process([sale])
+
+        shipment, = sale.shipments
+        type_id = ModelData.get_id("shipping", "shipment_package_type")
+        package1, package2 = Package.create([{
+            'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+            'type': type_id,
+            'moves': [('add', [shipment.outgoing_moves[0]])],
+        }, {
+            'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+            'type': type_id,
+            'moves': [('add', [shipment.outgoing_moves[1]])],
+        }])
+        Shipment.assign([shipment])
+        Shipment.pack([shipment])
+
+        shipment = Shipment(shipment.id)
+        assert shipment.get_fedex_package_groups() == [[package1], [package2]]
+
+        with Transaction().set_context(company=data.company.id):
+            tracking_number = shipment.make_fedex_labels()
+
+        # Each package is the master of its own shipment
+        assert sorted(ProcessShipmentRequest.sent) == [(1, None), (1, None)]
+        shipment = Shipment(shipment.id)
+        package1, package2 = shipment.packages
+        assert tracking_number == shipment.tracking_number == \
+            package1.tracking_number
+        assert package2.tracking_number not in (None, tracking_number)
+        assert Tracking.search([
+            ('shipment', '=', shipment.id),
+            ('master', '=', True),
+        ], count=True) == 2
+        # Both shipments are charged
+        assert shipment.cost == Decimal('50.34')
+
+        # The master which could be voided is cleared
+        number1, number2 = package1.tracking_number, package2.tracking_number
+        monkeypatch.setattr(DeleteShipmentRequest, 'shipped', set([number2]))
+        results = Shipment.void_fedex_labels([shipment])
+        assert 'already shipped' in results[shipment.id]
+        assert DeleteShipmentRequest.deleted == [number1]
+        shipment = Shipment(shipment.id)
+        package1, package2 = shipment.packages
+        assert package1.tracking_number is None
+        assert package2.tracking_number == shipment.tracking_number == number2
+        assert [t.tracking_number for t in Tracking.search([
+            ('shipment', '=', shipment.id),
+        ])] == [number2]
+
+        # Only the master left is voided again
+        monkeypatch.setattr(DeleteShipmentRequest, 'shipped', set())
+        assert Shipment.void_fedex_labels([shipment])[shipment.id] is None
+        assert DeleteShipmentRequest.deleted == [number1, number2]
+
+    def test_fedex_void_labels(self, dataset, transaction, monkeypatch):
+        """Labels of several shipments are voided together.
+        """
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from fedex_standin import ProcessShipmentRequest, DeleteShipmentRequest
+
+        Sale = self.POOL.get('sale.sale')
+        Shipment = self.POOL.get('stock.shipment.out')
+        Attachment = self.POOL.get('ir.attachment')
+        Package = self.POOL.get('stock.package')
+        Tracking = self.POOL.get('fedex.package.tracking')
+        ModelData = self.POOL.get('ir.model.data')
+
+        monkeypatch.setattr(
+            fedex, 'ProcessShipmentRequest', ProcessShipmentRequest
+        )
+        monkeypatch.setattr(
+            fedex, 'DeleteShipmentRequest', DeleteShipmentRequest
+        )
+        monkeypatch.setattr(ProcessShipmentRequest, 'sent', [])
+        monkeypatch.setattr(DeleteShipmentRequest, 'deleted', [])
+        monkeypatch.setattr(Sale, 'apply_fedex_shipping', lambda sale: None)
+
+        data = dataset()
+        type_id = ModelData.get_id("shipping", "shipment_package_type")
+
+        def create_shipment():
+            sale, = Sale.create([{
+                'party': data.customer.id,
+                'invoice_address': data.customer.addresses[0].id,
+                'shipment_address': data.customer.addresses[0].id,
+                'company': data.company.id,
+                'currency': data.currency_usd.id,
+                'carrier': data.fedex_carrier.id,
+                'payment_term': data.payment_term.id,
+                'fedex_drop_off_type':
+                    data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+                'fedex_packaging_type':
+                    data.get_fedex_packaging_type('FEDEX_BOX'),
+                'fedex_service_type':
+                    data.get_fedex_service_type('FEDEX_2_DAY'),
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 1,
+                    'product': data.product1.id,
+                    'unit_price': Decimal('119.00'),
+                    'description': 'KindleFire',
+                    'unit': data.uom_unit.id,
+                }])]
+            }])
+            Sale.quote([sale])
+            Sale.confirm([sale])
+            Sale.process([sale])
+            shipment, = sale.shipments
+            Package.create([{
+                'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+                'type': type_id,
+                'moves': [('add', [shipment.outgoing_moves[0]])],
+            }])
+            Shipment.assign([shipment])
+            Shipment.pack([shipment])
+            return Shipment(shipment.id)
+
+        shipment1 = create_shipment()
+        shipment2 = create_shipment()
+        with Transaction().set_context(company=data.company.id):
+            for future in Shipment.async_make_labels(
+                    [shipment1, shipment2]).values():
+                future.result()
+        shipment1, shipment2 = Shipment.browse([shipment1.id, shipment2.id])
+        monkeypatch.setattr(
+            DeleteShipmentRequest, 'shipped', set([shipment2.tracking_number])
+        )
+        tracking_number = shipment1.tracking_number
+        Shipment.write([shipment1], {'fedex_delivered': True})
+
+        results = Shipment.void_fedex_labels([shipment1, shipment2])
+        assert results[shipment1.id] is None
+        assert 'already shipped' in results[shipment2.id]
+        assert DeleteShipmentRequest.deleted == [tracking_number]
+
+        shipment1, shipment2 = Shipment.browse([shipment1.id, shipment2.id])
+        assert shipment1.tracking_number is None
+        assert shipment1.cost == Decimal('0')
+        assert not shipment1.fedex_delivered
+        assert shipment1.packages[0].tracking_number is None
+        assert shipment2.tracking_number is not None
+        assert Tracking.search([
+            ('shipment', '=', shipment1.id),
+        ], count=True) == 0
+        attachment, = Attachment.search([
+            ('resource', '=', '%s,%s' % (Shipment.__name__, shipment1.id)),
+        ])
+        assert attachment.name.startswith('VOID_')
+
+        # Voided shipments have no label left to void
+        results = Shipment.void_fedex_tracking_numbers([
+            shipment2.tracking_number, '000000000000',
+        ])
+        assert 'already shipped' in results[shipment2.tracking_number]
+        assert results['000000000000'] == Shipment.raise_user_error(
+            'fedex_tracking_number_unknown', raise_exception=False
+        )
+        assert Shipment.void_fedex_labels([shipment1])[shipment1.id] == \
+            Shipment.raise_user_error('fedex_no_labels', raise_exception=False)
+
+    def test_fedex_shipping_cost(self, dataset, transaction, monkeypatch):
+        """Quoted and billed costs are kept by sale as they are written.
+        """
+        from datetime import datetime
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from fedex_standin import RateService, ProcessShipmentRequest
+
+        Sale = self.POOL.get('sale.sale')
+        Shipment = self.POOL.get('stock.shipment.out')
+        Package = self.POOL.get('stock.package')
+        ShippingCost = self.POOL.get('fedex.shipping.cost')
+        ModelData = self.POOL.get('ir.model.data')
+
+        monkeypatch.setattr(fedex, 'RateService', RateService)
+        monkeypatch.setattr(
+            fedex, 'ProcessShipmentRequest', ProcessShipmentRequest
+        )
+        monkeypatch.setattr(RateService, 'sent', [])
+        monkeypatch.setattr(ProcessShipmentRequest, 'sent', [])
+
+        data = dataset()
+        type_id = ModelData.get_id("shipping", "shipment_package_type")
+
+        def create_sale():
+            sale, = Sale.create([{
+                'party': data.customer.id,
+                'invoice_address': data.customer.addresses[0].id,
+                'shipment_address': data.customer.addresses[0].id,
+                'company': data.company.id,
+                'currency': data.currency_usd.id,
+                'carrier': data.fedex_carrier.id,
+                'payment_term': data.payment_term.id,
+                'fedex_drop_off_type':
+                    data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+                'fedex_packaging_type':
+                    data.get_fedex_packaging_type('FEDEX_BOX'),
+                'fedex_service_type':
+                    data.get_fedex_service_type('FEDEX_2_DAY'),
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 1,
+                    'product': data.product1.id,
+                    'unit_price': Decimal('119.00'),
+                    'description': 'KindleFire',
+                    'unit': data.uom_unit.id,
+                }])]
+            }])
+            Sale.quote([sale])
+            return sale
+
+        sale = create_sale()
+
+        shipping_line, = [
+            line for line in sale.lines
+            if line.product == data.fedex_carrier.carrier_product
+        ]
+        cost, = ShippingCost.search([('sale', '=', sale.id)])
+        assert cost.service_type == 'FEDEX_2_DAY'
+        assert cost.quoted_amount == shipping_line.amount
+        assert cost.quoted_weight == round(sale._get_fedex_package_weight(), 2)
+        assert cost.billed_amount is None
+
+        Sale.confirm([sale])
+        Sale.process([sale])
+        shipment, = sale.shipments
+        Package.create([{
+            'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+            'type': type_id,
+            'moves': [('add', [shipment.outgoing_moves[0]])],
+        }])
+        Shipment.assign([shipment])
+        Shipment.pack([shipment])
+        with Transaction().set_context(company=data.company.id):
+            Shipment(shipment.id).make_fedex_labels()
+
+        cost = ShippingCost(cost.id)
+        assert cost.shipment_count == 1
+        assert cost.billed_amount == Decimal('25.17')
+        assert cost.label_date is not None
+
+        today = datetime.utcnow().date()
+        report = ShippingCost.get_fedex_cost_report(
+            today, today, lane=cost.lane
+        )
+        assert report == [{
+            'group': cost.lane,
+            'currency': data.currency_usd.id,
+            'sales': 1,
+            'labeled': 1,
+            'quoted_weight': cost.quoted_weight,
+            'billed_weight': cost.billed_weight,
+            'quoted_amount': cost.quoted_amount,
+            'billed_amount': Decimal('25.17'),
+            'margin': cost.quoted_amount - Decimal('25.17'),
+        }]
+        by_service = ShippingCost.get_fedex_cost_report(
+            today, today, group_by='service_type'
+        )
+        assert [row['group'] for row in by_service] == ['FEDEX_2_DAY']
+
+        # Open shipments are counted once completed by packing
+        sale = create_sale()
+        Sale.confirm([sale])
+        Sale.process([sale])
+        shipment, = sale.shipments
+        Shipment.write([shipment], {
+            'fedex_open_shipment': True,
+            'fedex_package_count': 1,
+        })
+        Package.create([{
+            'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+            'type': type_id,
+            'moves': [('add', [shipment.outgoing_moves[0]])],
+        }])
+        with Transaction().set_context(company=data.company.id):
+            Shipment.label_fedex_new_packages([Shipment(shipment.id)])
+            cost, = ShippingCost.search([('sale', '=', sale.id)])
+            assert not cost.shipment_count
+
+            Shipment.assign([shipment])
+            Shipment.pack([shipment])
+
+        cost = ShippingCost(cost.id)
+        assert cost.shipment_count == 1
+        assert cost.billed_amount == Decimal('25.17')
+
+    def test_fedex_close(self, dataset, transaction, monkeypatch):
+        """Ground shipments labeled since the last close are closed.
+        """
+        from datetime import datetime, timedelta
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from fedex_standin import ProcessShipmentRequest, GroundCloseRequest
+
+        Sale = self.POOL.get('sale.sale')
+        Shipment = self.POOL.get('stock.shipment.out')
+        Attachment = self.POOL.get('ir.attachment')
+        Package = self.POOL.get('stock.package')
+        Close = self.POOL.get('fedex.close')
+        ModelData = self.POOL.get('ir.model.data')
+
+        monkeypatch.setattr(
+            fedex, 'ProcessShipmentRequest', ProcessShipmentRequest
+        )
+        monkeypatch.setattr(fedex, 'GroundCloseRequest', GroundCloseRequest)
+        monkeypatch.setattr(ProcessShipmentRequest, 'sent', [])
+        monkeypatch.setattr(GroundCloseRequest, 'closed', [])
+        monkeypatch.setattr(Sale, 'apply_fedex_shipping', lambda sale: None)
+
+        data = dataset()
+        type_id = ModelData.get_id("shipping", "shipment_package_type")
+
+        def create_shipment(service_type):
+            sale, = Sale.create([{
+                'party': data.customer.id,
+                'invoice_address': data.customer.addresses[0].id,
+                'shipment_address': data.customer.addresses[0].id,
+                'company': data.company.id,
+                'currency': data.currency_usd.id,
+                'carrier': data.fedex_carrier.id,
+                'payment_term': data.payment_term.id,
+                'fedex_drop_off_type':
+                    data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+                'fedex_packaging_type':
+                    data.get_fedex_packaging_type('YOUR_PACKAGING'),
+                'fedex_service_type':
+                    data.get_fedex_service_type(service_type),
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 1,
+                    'product': data.product1.id,
+                    'unit_price': Decimal('119.00'),
+                    'description': 'KindleFire',
+                    'unit': data.uom_unit.id,
+                }])]
+            }])
+            Sale.quote([sale])
+            Sale.confirm([sale])
+            Sale.process([sale])
+            shipment, = sale.shipments
+            Package.create([{
+                'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+                'type': type_id,
+                'moves': [('add', [shipment.outgoing_moves[0]])],
+            }])
+            Shipment.assign([shipment])
+            Shipment.pack([shipment])
+            return Shipment(shipment.id)
+
+        ground1 = create_shipment('FEDEX_GROUND')
+        ground2 = create_shipment('FEDEX_GROUND')
+        express = create_shipment('FEDEX_2_DAY')
+        unlabeled = create_shipment('FEDEX_GROUND')
+        with Transaction().set_context(company=data.company.id):
+            for future in Shipment.async_make_labels(
+                    [ground1, ground2, express]).values():
+                future.result()
+
+        # Labeled while FedEx is asked to close, it is left to the next
+        Shipment.write([ground2], {
+            'fedex_label_date': datetime.utcnow() + timedelta(hours=1),
+        })
+
+        close, = Close.close_fedex_shipments()
+        assert GroundCloseRequest.closed == [
+            data.fedex_carrier.fedex_account_number
+        ]
+        assert close.carrier == data.fedex_carrier
+        assert close.shipment_count == 1
+        assert list(close.shipments) == [ground1]
+        for shipment in Shipment.browse([ground2.id, express.id, unlabeled.id]):
+            assert shipment.fedex_close is None
+        manifest, = Attachment.search([
+            ('resource', '=', '%s,%s' % (Close.__name__, close.id)),
+        ])
+        assert str(manifest.data).startswith('Closed up to')
+
+        # The carriers are given by id over RPC
+        Shipment.write([ground2], {'fedex_label_date': datetime.utcnow()})
+        close, = Close.close_fedex_shipments([data.fedex_carrier.id])
+        assert list(close.shipments) == [ground2]
+        assert Shipment(ground2.id).fedex_close == close
+
+        # Closed shipments are not closed again
+        assert Close.close_fedex_shipments() == []
+        assert len(GroundCloseRequest.closed) == 2
+
+    def test_fedex_account_balancer(self, monkeypatch):
+        """Failing accounts are left out for a growing cooldown.
+        """
+        from trytond.modules.shipping_fedex import balancer as module
+        from trytond.modules.shipping_fedex.balancer import AccountBalancer
+
+        clock = [1000.0]
+        monkeypatch.setattr(module.time, 'time', lambda: clock[0])
+        balancer = AccountBalancer(max_failures=2, cooldown=30, max_cooldown=60)
+
+        # Requests in flight are limited by account
+        assert balancer.acquire('a', max_concurrency=1)
+        assert not balancer.acquire('a', max_concurrency=1)
+        assert balancer.acquire('b')
+        balancer.release('a')
+        assert balancer.in_flight('a') == 0
+        assert balancer.acquire('a', max_concurrency=1)
+
+        balancer.record_failure('a')
+        assert balancer.health('a') == 'failing'
+        balancer.record_failure('a')
+        assert balancer.health('a') == 'disabled'
+        # Disabled accounts are only tried last
+        for _ in xrange(10):
+            assert [key for key, _ in balancer.order([
+                ('a', 100, None), ('b', 1, None),
+            ])] == ['b', 'a']
+
+        clock[0] += 30
+        assert balancer.health('a') == 'failing'
+        # The cooldown doubles on each new failure, up to max_cooldown
+        balancer.record_failure('a')
+        clock[0] += 59
+        assert balancer.health('a') == 'disabled'
+        balancer.record_failure('a')
+        clock[0] += 60
+        assert balancer.health('a') == 'failing'
+
+        balancer.record_success('a')
+        assert balancer.health('a') == 'healthy'
+
+    def test_fedex_account_failover(self, monkeypatch):
+        """Only errors caused by the account are sent with another one.
+        """
+        from trytond.modules.shipping_fedex import balancer as module
+        from trytond.modules.shipping_fedex.balancer import balancer
+        from trytond.modules.shipping_fedex.carrier import (
+            Carrier, FedexSettings,
+        )
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from trytond.modules.shipping_fedex.transport import FedexTransport
+        from fedex_standin import Element
+
+        # The account with the largest weight is tried first
+        monkeypatch.setattr(module.random, 'random', lambda: 0.5)
+        balancer.reset()
+
+        sent = []
+        errors = {}
+
+        class Request(object):
+
+            def __init__(self, credentials):
+                self.account = credentials.AccountNumber
+
+            def send_request(self, transaction_id=None):
+                sent.append(self.account)
+                if self.account not in errors:
+                    return 'reply of %s' % self.account
+                code, message = errors[self.account]
+                notification = Element()
+                notification.Severity = 'ERROR'
+                notification.Code = code
+                notification.Message = message
+                self.response = Element()
+                self.response.HighestSeverity = 'ERROR'
+                self.response.Notifications = [notification]
+                raise fedex.RequestError('[%s] %s' % (code, message))
+
+        def account(number, weight):
+            credentials = FedexSettings(
+                'key', 'password', number, 'meter', None, None, None
+            )
+            return ('%s-meter' % number, weight, 0, credentials, None)
+
+        transport = FedexTransport(
+            [account('main', 10), account('spare', 1)],
+            is_account_error=Carrier.is_fedex_account_error,
+        )
+
+        # The account failed to authenticate, the spare one is used
+        errors['main'] = ('1000', 'Authentication Failed')
+        assert transport.send(Request) == 'reply of spare'
+        assert sent == ['main', 'spare']
+        assert balancer.health('main-meter') == 'failing'
+        assert balancer.health('spare-meter') == 'healthy'
+
+        # An error of the request is the same with any account, even if its
+        # message looks like one of an account
+        del sent[:]
+        errors['main'] = ('556', 'Service unavailable for this lane')
+        with pytest.raises(fedex.RequestError):
+            transport.send(Request)
+        assert sent == ['main']
+        assert balancer.health('main-meter') == 'failing'
+
+        # An account failing too often is tried last
+        errors['main'] = ('1000', 'Authentication Failed')
+        for _ in xrange(2):
+            transport.send(Request)
+        assert balancer.health('main-meter') == 'disabled'
+        del sent[:]
+        assert transport.send(Request) == 'reply of spare'
+        assert sent == ['spare']
+
+        # When all the accounts fail the last error is raised
+        errors['spare'] = ('1000', 'Authentication Failed')
+        with pytest.raises(fedex.RequestError):
+            transport.send(Request)
+        balancer.reset()
+
+        class Limiter(object):
+            "Throttles the first request only"
+            throttled = True
+
+            def acquire(self):
+                throttled, self.throttled = self.throttled, False
+                return not throttled
+
+        # The throttled account is waited for once the other one failed
+        del errors['spare']
+        del sent[:]
+        main, spare = account('main', 10), account('spare', 1)
+        transport = FedexTransport(
+            [main, spare[:4] + (Limiter(),)], max_wait=1,
+            is_account_error=Carrier.is_fedex_account_error,
+        )
+        assert transport.send(Request) == 'reply of spare'
+        assert sent == ['main', 'spare']
+        balancer.reset()
+
+    def test_fedex_token_bucket(self, tmpdir, monkeypatch):
+        """Requests take tokens refilled at the rate of the bucket.
+        """
+        from trytond.modules.shipping_fedex import ratelimit
+        from trytond.modules.shipping_fedex.ratelimit import TokenBucket
+
+        clock = [1000.0]
+        monkeypatch.setattr(ratelimit.time, 'time', lambda: clock[0])
+
+        def sleep(seconds):
+            clock[0] += seconds
+        monkeypatch.setattr(ratelimit.time, 'sleep', sleep)
+
+        bucket = TokenBucket('510088000', 2, 3, directory=str(tmpdir))
+        assert bucket.utilization() == 0
+
+        # The burst is taken at once, then the bucket is empty
+        assert all(bucket.acquire() for _ in xrange(3))
+        assert not bucket.acquire()
+        assert bucket.utilization() == 1
+
+        # Tokens come back at the rate of the bucket
+        clock[0] += 0.5
+        assert bucket.acquire()
+        assert not bucket.acquire()
+
+        # A request waits for the next token within its timeout
+        assert bucket.acquire(timeout=1)
+        assert clock[0] == 1001.0
+        assert not bucket.acquire(timeout=0.1)
+
+        # The bucket never holds more than its capacity
+        clock[0] += 60
+        assert bucket.utilization() == 0
+        assert all(bucket.acquire() for _ in xrange(3))
+        assert not bucket.acquire()
+
+        # Buckets of the same account share their tokens, even in other
+        # processes, the others are independent
+        same = TokenBucket('510088000', 2, 3, directory=str(tmpdir))
+        assert not same.acquire()
+        other = TokenBucket('510088001', 2, 3, directory=str(tmpdir))
+        assert other.acquire()
+
+        # Without flock the bucket is shared by the threads of the process
+        monkeypatch.setattr(ratelimit, 'fcntl', None)
+        local = TokenBucket('510088002', 1, 1, directory=str(tmpdir))
+        assert local.acquire()
+        assert not TokenBucket(
+            '510088002', 1, 1, directory=str(tmpdir)
+        ).acquire()
+
+    def test_fedex_rate_utilization(self, dataset, transaction):
+        """A carrier without complete credentials reports no utilization.
+        """
+        Carrier = self.POOL.get('carrier')
+
+        data = dataset()
+
+        Carrier.write([Carrier(data.fedex_carrier.id)], {
+            'fedex_rate_limit': 10,
+        })
+        carrier = Carrier(data.fedex_carrier.id)
+        assert 0 <= carrier.get_fedex_rate_utilization(None) <= 1
+
+        # The form of a carrier being configured still opens
+        carrier.fedex_key = None
+        assert carrier.get_fedex_rate_utilization(None) is None
+
+    def test_fedex_connection_pool(self):
+        """Idle connections are reused until they expire.
+        """
+        from trytond.modules.shipping_fedex.keepalive import ConnectionPool
+
+        pool = ConnectionPool('https', 'localhost', size=1, idle_timeout=60)
+
+        connection, reused = pool.get()
+        assert not reused
+        pool.put(connection)
+        assert pool.get() == (connection, True)
+
+        # Only `size` idle connections are kept
+        other, _ = pool.get()
+        pool.put(connection)
+        pool.put(other)
+        stats = pool.get_stats()
+        assert stats['idle'] == 1
+        assert stats['discarded'] == 1
+        assert stats['in_use'] == 0
+
+        pool.idle_timeout = 0
+        _, reused = pool.get()
+        assert not reused
+        assert pool.get_stats()['expired'] == 1
+
+    def test_fedex_keepalive_retry(self):
+        """Only requests the server closed without replying are resent.
+        """
+        import errno
+        import socket
+        import httplib
+        from trytond.modules.shipping_fedex.keepalive import \
+            is_closed_before_reply
+
+        assert is_closed_before_reply(httplib.BadStatusLine("''"))
+        assert is_closed_before_reply(
+            socket.error(errno.ECONNRESET, 'Connection reset by peer')
+        )
+        assert not is_closed_before_reply(socket.timeout('timed out'))
+        assert not is_closed_before_reply(httplib.BadStatusLine('HTTP/1.1'))
+        assert not is_closed_before_reply(httplib.IncompleteRead(''))
+
+    def test_fedex_gathered_futures(self):
+        """The results gathered with a failure are discarded.
+        """
+        from trytond.modules.shipping_fedex.transport import (
+            FedexFuture, gather_futures,
+        )
+
+        class Failed(object):
+            def get(self, timeout=None):
+                raise IOError('Connection reset')
+
+        discarded = []
+        future = gather_futures([
+            FedexFuture(value=1), FedexFuture(Failed()), FedexFuture(value=3),
+        ], discard=discarded.extend)
+        with pytest.raises(IOError):
+            future.result()
+        # The futures after the failure are waited for too
+        assert discarded == [1, 3]
+
+        assert gather_futures([
+            FedexFuture(value=1), FedexFuture(value=2),
+        ], callback=sum).result() == 3
+
+    def test_fedex_lean_reply(self, tmpdir):
+        """Label images are streamed to files and left out of the reply.
+        """
+        import base64
+        from StringIO import StringIO
+        from trytond.modules.shipping_fedex import leanparse
+
+        reply = (
+            '<ProcessShipmentReply xmlns="http://fedex.com/ws/ship/v13">'
+            '<HighestSeverity>SUCCESS</HighestSeverity>'
+            '<CompletedShipmentDetail>'
+            '<MasterTrackingId><TrackingNumber>794000000001'
+            '</TrackingNumber></MasterTrackingId>'
+            '<ShipmentRating><ShipmentRateDetails><TotalNetCharge>'
+            '<Currency>USD</Currency><Amount>25.17</Amount>'
+            '</TotalNetCharge></ShipmentRateDetails></ShipmentRating>'
+            '<CompletedPackageDetails><TrackingIds>'
+            '<TrackingNumber>794000000002</TrackingNumber></TrackingIds>'
+            '<Label><Parts><Image>%s</Image></Parts></Label>'
+            '</CompletedPackageDetails></CompletedShipmentDetail>'
+            '</ProcessShipmentReply>'
+        ) % base64.b64encode('PNG image')
+
+        xml, lean_reply = leanparse.parse(StringIO(reply), str(tmpdir))
+
+        assert lean_reply.tracking_numbers == ['794000000002']
+        assert (lean_reply.amount, lean_reply.currency) == ('25.17', 'USD')
+        assert lean_reply.read_image(0) == 'PNG image'
+        assert tmpdir.listdir() == []
+        assert 'Image' in xml and base64.b64encode('PNG image') not in xml
+
+        # Errors are left to the SOAP client
+        xml, lean_reply = leanparse.parse(StringIO(
+            '<Reply><HighestSeverity>ERROR</HighestSeverity></Reply>'
+        ))
+        assert lean_reply is None
+
+    def test_fedex_commodities(self):
+        """Repeated products are declared as one commodity.
+        """
+        from trytond.modules.shipping_fedex.commodities import \
+            CommodityBuilder
+        from fedex_standin import StandinRequest
+
+        builder = CommodityBuilder(max_commodities=3)
+        for _ in xrange(3):
+            builder.add(
+                1, 'Kindle', 'Reader', '8471.30', 'US', 1.0,
+                Decimal('33.33'), 0.1, piece=1
+            )
+        builder.add(
+            1, 'Kindle', 'Reader', '8471.30', 'US', 2.0, Decimal('33.33'),
+            0.2, piece=2
+        )
+        builder.add(
+            2, 'Cover', 'Cover', '4202.99', 'CN', 5.0, Decimal('9.99'), 1.0
+        )
+
+        first, second = builder.get_fedex_commodities(
+            StandinRequest(None), 'USD'
+        )
+        assert first.Quantity == 5
+        assert first.NumberOfPieces == 2
+        assert first.CustomsValue.Amount == Decimal('166.65')
+        assert first.UnitPrice.Amount == Decimal('33.33')
+        assert first.Weight.Value == Decimal('0.5')
+        assert second.NumberOfPieces == 1
+        assert second.CountryOfManufacture == 'CN'
+        assert builder.customs_value == Decimal('216.60')
+
+        # Past the limit the same codes are merged, then the cheapest goods
+        builder.add(
+            3, 'Sleeve', 'Sleeve', '4202.99', 'CN', 1.0, Decimal('4.99'), 0.5
+        )
+        builder.add(4, 'Cable', 'Cable', None, 'CN', 1.0, Decimal('1'), 0.1)
+        builder.add(5, 'Pen', 'Pen', None, 'US', 1.0, Decimal('2'), 0.1)
+        commodities = builder.get_commodities()
+        assert len(commodities) == 3
+        assert commodities[1].harmonized_code == '4202.99'
+        assert commodities[1].description == 'Cover, Sleeve'
+        assert commodities[2].value == Decimal('3')
+        assert sum(c.value for c in commodities) == Decimal('224.59')
+
+    def test_fedex_library_loaded_lazily(self):
+        """Registering the module does not load the SOAP stack.
+        """
+        import sys
+        import subprocess
+
+        subprocess.check_call([sys.executable, '-c', '\n'.join([
+            'import sys',
+            'import trytond.modules.shipping_fedex as module',
+            'module.register()',
+            'assert "fedex" not in sys.modules, "fedex"',
+            'assert "suds" not in sys.modules, "suds"',
+        ])])
+
+    def test_fedex_query_budgets(self, dataset, transaction, monkeypatch):
+        """Quotes, rates and labels stay within their budgets as orders grow.
+        """
+        from trytond.modules.shipping_fedex.fedexlib import fedex
+        from trytond.modules.shipping_fedex.speculation import \
+            speculative_rates
+        from fedex_standin import RateService, ProcessShipmentRequest
+        from budget import SIZES, Measure, check_budget
+
+        Sale = self.POOL.get('sale.sale')
+        Shipment = self.POOL.get('stock.shipment.out')
+        Package = self.POOL.get('stock.package')
+        ModelData = self.POOL.get('ir.model.data')
+        RateCache = self.POOL.get('fedex.rate.cache')
+
+        monkeypatch.setattr(fedex, 'RateService', RateService)
+        monkeypatch.setattr(
+            fedex, 'ProcessShipmentRequest', ProcessShipmentRequest
+        )
+        monkeypatch.setattr(RateService, 'sent', [])
+        monkeypatch.setattr(ProcessShipmentRequest, 'sent', [])
+        speculative_rates.clear()
+        # Every size is rated, rather than found in the rates of other tests
+        RateCache._memory_cache.clear()
+
+        data = dataset()
+        type_id = ModelData.get_id("shipping", "shipment_package_type")
+
+        def create_sale(size, quantity=1):
+            sale, = Sale.create([{
+                'party': data.customer.id,
+                'invoice_address': data.customer.addresses[0].id,
+                'shipment_address': data.customer.addresses[0].id,
+                'company': data.company.id,
+                'currency': data.currency_usd.id,
+                'carrier': data.fedex_carrier.id,
+                'payment_term': data.payment_term.id,
+                'fedex_drop_off_type':
+                    data.get_fedex_drop_off_type('REGULAR_PICKUP'),
+                'fedex_packaging_type':
+                    data.get_fedex_packaging_type('FEDEX_BOX'),
+                'fedex_service_type':
+                    data.get_fedex_service_type('FEDEX_2_DAY'),
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': quantity,
+                    'product': product.id,
+                    'unit_price': Decimal('119.00'),
+                    'description': product.name,
+                    'unit': data.uom_unit.id,
+                } for product in [data.product1, data.product2] * size][
+                    :size
+                ])]
+            }])
+            return sale
+
+        measures = {
+            'sale.quote': [],
+            'shipment.get_fedex_shipping_cost': [],
+            'shipment.make_fedex_labels': [],
+        }
+        for size in SIZES:
+            # The caches emptied by the previous size are filled again by a
+            # sale of another weight, so that only the growth is measured
+            Sale.quote([create_sale(size, quantity=2)])
+            sale = create_sale(size)
+
+            with Measure() as measure:
+                Sale.quote([sale])
+            measures['sale.quote'].append((size, measure))
+
+            Sale.confirm([sale])
+            Sale.process([sale])
+            shipment, = sale.shipments
+            # One package by line
+            Package.create([{
+                'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+                'type': type_id,
+                'moves': [('add', [move])],
+            } for move in shipment.outgoing_moves])
+            Shipment.assign([shipment])
+            Shipment.pack([shipment])
+
+            with Transaction().set_context(fedex_force_rating=True):
+                shipment = Shipment(shipment.id)
+                with Measure() as measure:
+                    shipment.get_fedex_shipping_cost()
+            measures['shipment.get_fedex_shipping_cost'].append(
+                (size, measure)
+            )
+
+            with Transaction().set_context(company=data.company.id):
+                shipment = Shipment(shipment.id)
+                with Measure() as measure:
+                    shipment.make_fedex_labels()
+            measures['shipment.make_fedex_labels'].append((size, measure))
+            assert len(Shipment(shipment.id).packages) == size
+
+        for name, path_measures in sorted(measures.iteritems()):
+            check_budget(name, path_measures)
@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+"""
+    tracking.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import json
+import logging
+from datetime import datetime
+from functools import partial
+from collections import defaultdict
+
+from dateutil.parser import parse as parse_datetime
+from sql.functions import CurrentTimestamp
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+import metrics
+from carrier import fedex_fingerprint, clear_fedex_cache
+from fedexlib import fedex
+
+__all__ = ['FedexPackageTracking', 'FedexTrackingEvent']
+
+logger = logging.getLogger(__name__)
+
+# Largest number of tracking numbers the Track service accepts in a request
+TRACK_BATCH_SIZE = 30
+
+
+def to_utc(timestamp):
+    """
+    Returns the timestamp returned by FedEx as a naive UTC datetime
+    """
+    if timestamp is None or timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+
+
+class FedexPackageTracking(ModelSQL, ModelView):
+    """
+    FedEx Package Tracking
+
+    The tracking number returned by FedEx for each package labeled with
+    FedEx and the last status of the package. The master tracking number
+    of a shipment is the number of its first package.
+    """
+    __name__ = 'fedex.package.tracking'
+    _rec_name = 'tracking_number'
+
+    package = fields.Many2One(
+        'stock.package', 'Package', required=True, select=True,
+        readonly=True, ondelete='CASCADE'
+    )
+    shipment = fields.Many2One(
+        'stock.shipment.out', 'Shipment', select=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    tracking_number = fields.Char(
+        'Tracking Number', required=True, select=True, readonly=True
+    )
+    master = fields.Boolean('Master', readonly=True)
+    master_tracking_number = fields.Char(
+        'Master Tracking Number', select=True, readonly=True,
+        help='Tracking number of the master package the package was '
+        'labeled with'
+    )
+    status_code = fields.Char('Status Code', readonly=True)
+    status = fields.Char('Status', readonly=True)
+    delivered = fields.Boolean('Delivered', select=True, readonly=True)
+    delivery_date = fields.DateTime('Delivery Date', readonly=True)
+    last_event_date = fields.DateTime('Last Event', readonly=True)
+    last_checked = fields.DateTime('Last Checked', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(FedexPackageTracking, cls).__setup__()
+        cls._sql_constraints += [
+            ('package_uniq', 'UNIQUE(package)',
+                'A package can only be tracked once.'),
+        ]
+        cls._order.insert(0, ('last_checked', 'ASC'))
+        cls.__rpc__.update({
+            'resolve_tracking_numbers': RPC(readonly=True),
+        })
+
+    @staticmethod
+    def default_master():
+        return False
+
+    @staticmethod
+    def default_delivered():
+        return False
+
+    @classmethod
+    def resolve_tracking_numbers(cls, tracking_numbers):
+        """
+        Returns the shipment and the package of each tracking number, in
+        a single query for up to IN_MAX numbers.
+
+        :param tracking_numbers: list of tracking numbers
+        :return: dictionary mapping each tracking number found to a
+            dictionary with the ids of its shipment and package and whether
+            it is the master number of the shipment
+        """
+        ModelAccess = Pool().get('ir.model.access')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        ModelAccess.check(cls.__name__, 'read')
+
+        tracking_numbers = list(set(tracking_numbers))
+        result = {}
+        for i in xrange(0, len(tracking_numbers), cursor.IN_MAX):
+            sub_numbers = tracking_numbers[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(
+                table.tracking_number, table.shipment, table.package,
+                table.master,
+                where=table.tracking_number.in_(sub_numbers),
+                order_by=table.id.asc,
+            ))
+            for tracking_number, shipment, package, master in \
+                    cursor.fetchall():
+                # The last labeled wins if FedEx reused a number
+                result[tracking_number] = {
+                    'shipment': shipment,
+                    'package': package,
+                    'master': bool(master),
+                }
+        return result
+
+    @staticmethod
+    def get_fedex_track_request(fedex_credentials, tracking_numbers, wsdl=None):
+        """
+        Returns a Track request for the tracking numbers
+        """
+        track_request = fedex.TrackRequest(fedex_credentials, wsdl=wsdl)
+        selections = []
+        for tracking_number in tracking_numbers:
+            selection = track_request.get_element_from_type(
+                'TrackSelectionDetail'
+            )
+            selection.PackageIdentifier.Type = 'TRACKING_NUMBER_OR_DOORTAG'
+            selection.PackageIdentifier.Value = tracking_number
+            selections.append(selection)
+        track_request.SelectionDetails = selections
+        return track_request
+
+    @staticmethod
+    def parse_fedex_track_reply(response):
+        """
+        Returns a dictionary mapping the tracking numbers of the reply to
+        the values to write on their tracking records
+        """
+        statuses = {}
+        for completed in getattr(response, 'CompletedTrackDetails', []):
+            for detail in getattr(completed, 'TrackDetails', []):
+                notification = getattr(detail, 'Notification', None)
+                if notification is not None and \
+                        notification.Severity in ('ERROR', 'FAILURE'):
+                    continue
+                status = getattr(detail, 'StatusDetail', None)
+                code = getattr(status, 'Code', None)
+                values = {
+                    'status_code': code,
+                    'status': getattr(status, 'Description', None),
+                    'delivered': code == 'DL',
+                    'delivery_date': to_utc(
+                        getattr(detail, 'ActualDeliveryTimestamp', None)
+                    ),
+                }
+                events = getattr(detail, 'Events', None)
+                if events:
+                    # Events are returned most recent first
+                    values['last_event_date'] = to_utc(events[0].Timestamp)
+                statuses[str(detail.TrackingNumber)] = values
+        return statuses
+
+    @classmethod
+    def update_fedex_tracking(cls, trackings=None):
+        """
+        Asks FedEx for the status of the packages which are not delivered
+        yet. The tracking numbers of a carrier are sent in batches of
+        TRACK_BATCH_SIZE and the batches are sent concurrently.
+
+        The Track Service WSDL is read from track_wsdl in the fedex section
+        of the configuration.
+
+        :param trackings: Update these records instead of all the
+            undelivered packages
+        """
+        if trackings is None:
+            trackings = cls.search([('delivered', '=', False)])
+
+        by_carrier = defaultdict(list)
+        for tracking in trackings:
+            by_carrier[tracking.carrier].append(tracking)
+
+        now = datetime.utcnow()
+        wsdl = config.get('fedex', 'track_wsdl')
+        to_write = defaultdict(list)
+        for carrier, records in by_carrier.iteritems():
+            transport = carrier.get_fedex_transport()
+            tracking_numbers = sorted(set(r.tracking_number for r in records))
+            batches = [
+                tracking_numbers[i:i + TRACK_BATCH_SIZE]
+                for i in xrange(0, len(tracking_numbers), TRACK_BATCH_SIZE)
+            ]
+
+            def track(batch):
+                return cls.parse_fedex_track_reply(transport.send(partial(
+                    cls.get_fedex_track_request, tracking_numbers=batch,
+                    wsdl=wsdl
+                )))
+
+            statuses = {}
+            for batch, (result, exc_info) in zip(
+                    batches, transport.map(track, batches)):
+                metrics.increment('tracking.requests')
+                if exc_info is not None:
+                    metrics.increment('tracking.errors')
+                    logger.warning(
+                        'FedEx tracking failed for %s', ', '.join(batch),
+                        exc_info=exc_info
+                    )
+                    continue
+                for tracking_number in batch:
+                    statuses[tracking_number] = result.get(
+                        tracking_number, {}
+                    )
+
+            for record in records:
+                values = statuses.get(record.tracking_number)
+                if values is None:
+                    continue
+                values = dict(values, last_checked=now)
+                to_write[tuple(sorted(values.items()))].append(record)
+
+        # Packages reaching the same status are written together
+        args = []
+        delivered_shipments = []
+        for values, records in to_write.iteritems():
+            values = dict(values)
+            args.extend((records, values))
+            if values.get('delivered'):
+                delivered_shipments.extend(
+                    r.shipment.id for r in records if r.shipment
+                )
+        if args:
+            cls.write(*args)
+        cls.set_shipments_delivered(delivered_shipments)
+
+    @classmethod
+    def update_from_fedex_events(cls, tracking_numbers):
+        """
+        Updates the status of the packages from the tracking events received
+        for them, without going through the ORM.
+        """
+        Event = Pool().get('fedex.tracking.event')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        event = Event.__table__()
+
+        tracking_numbers = list(set(tracking_numbers))
+        latest = {}
+        delivered = {}
+        for i in xrange(0, len(tracking_numbers), cursor.IN_MAX):
+            sub_numbers = tracking_numbers[i:i + cursor.IN_MAX]
+            cursor.execute(*event.select(
+                event.tracking_number, event.timestamp, event.code,
+                event.description,
+                where=event.tracking_number.in_(sub_numbers),
+            ))
+            for tracking_number, timestamp, code, description in \
+                    cursor.fetchall():
+                if tracking_number not in latest or \
+                        timestamp > latest[tracking_number][0]:
+                    latest[tracking_number] = (timestamp, code, description)
+                if code == 'DL':
+                    delivered[tracking_number] = max(
+                        timestamp, delivered.get(tracking_number, timestamp)
+                    )
+
+        # Packages reaching the same status are updated together
+        to_update = defaultdict(list)
+        delivered_shipments = []
+        for i in xrange(0, len(tracking_numbers), cursor.IN_MAX):
+            sub_numbers = tracking_numbers[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(
+                table.id, table.tracking_number, table.shipment,
+                table.last_event_date,
+                where=table.tracking_number.in_(sub_numbers),
+            ))
+            for id_, tracking_number, shipment, last_event_date in \
+                    cursor.fetchall():
+                if tracking_number not in latest:
+                    continue
+                timestamp, code, description = latest[tracking_number]
+                if last_event_date is not None and \
+                        timestamp <= last_event_date:
+                    continue
+                delivery_date = delivered.get(tracking_number)
+                to_update[(
+                    code, description, timestamp,
+                    delivery_date is not None, delivery_date,
+                )].append(id_)
+                if delivery_date is not None and shipment:
+                    delivered_shipments.append(shipment)
+
+        user = Transaction().user
+        for values, ids in to_update.iteritems():
+            for i in xrange(0, len(ids), cursor.IN_MAX):
+                cursor.execute(*table.update([
+                    table.status_code, table.status, table.last_event_date,
+                    table.delivered, table.delivery_date,
+                    table.write_uid, table.write_date,
+                ], list(values) + [user, CurrentTimestamp()],
+                    where=table.id.in_(ids[i:i + cursor.IN_MAX])))
+            clear_fedex_cache(cls.__name__, ids)
+
+        cls.set_shipments_delivered(delivered_shipments)
+
+    @classmethod
+    def set_shipments_delivered(cls, shipment_ids):
+        """
+        Flags the shipments all of whose packages were delivered. Only the
+        given shipments are checked.
+        """
+        Shipment = Pool().get('stock.shipment.out')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        shipment = Shipment.__table__()
+
+        shipment_ids = list(set(shipment_ids))
+        pending = set()
+        delivered = {}
+        for i in xrange(0, len(shipment_ids), cursor.IN_MAX):
+            sub_ids = shipment_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(
+                table.shipment, table.delivered, table.delivery_date,
+                where=table.shipment.in_(sub_ids),
+            ))
+            for shipment_id, is_delivered, delivery_date in \
+                    cursor.fetchall():
+                if not is_delivered:
+                    pending.add(shipment_id)
+                elif delivery_date is not None:
+                    delivered[shipment_id] = max(
+                        delivery_date,
+                        delivered.get(shipment_id, delivery_date)
+                    )
+                else:
+                    delivered.setdefault(shipment_id, None)
+
+        # Shipments delivered at the same date are updated together
+        to_update = defaultdict(list)
+        for shipment_id, delivery_date in delivered.iteritems():
+            if shipment_id not in pending:
+                to_update[delivery_date].append(shipment_id)
+
+        user = Transaction().user
+        for delivery_date, ids in to_update.iteritems():
+            for i in xrange(0, len(ids), cursor.IN_MAX):
+                sub_ids = ids[i:i + cursor.IN_MAX]
+                cursor.execute(*shipment.update([
+                    shipment.fedex_delivered, shipment.fedex_delivery_date,
+                    shipment.write_uid, shipment.write_date,
+                ], [True, delivery_date, user, CurrentTimestamp()],
+                    where=shipment.id.in_(sub_ids)))
+                metrics.increment('tracking.shipments.delivered', len(sub_ids))
+            clear_fedex_cache(Shipment.__name__, ids)
+
+
+class FedexTrackingEvent(ModelSQL, ModelView):
+    """
+    FedEx Tracking Event
+
+    Tracking events pushed by FedEx. Events are received in batches and
+    inserted in bulk, an event received twice is only kept once.
+    """
+    __name__ = 'fedex.tracking.event'
+    _rec_name = 'tracking_number'
+
+    key = fields.Char('Key', required=True, select=True, readonly=True)
+    tracking_number = fields.Char(
+        'Tracking Number', required=True, select=True, readonly=True
+    )
+    shipment = fields.Many2One(
+        'stock.shipment.out', 'Shipment', select=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    package = fields.Many2One(
+        'stock.package', 'Package', readonly=True, ondelete='CASCADE'
+    )
+    code = fields.Char('Code', required=True, readonly=True)
+    description = fields.Char('Description', readonly=True)
+    location = fields.Char('Location', readonly=True)
+    timestamp = fields.DateTime('Timestamp', required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(FedexTrackingEvent, cls).__setup__()
+        cls._sql_constraints += [
+            ('key_uniq', 'UNIQUE(key)', 'An event can only be received once.'),
+        ]
+        cls._order.insert(0, ('timestamp', 'DESC'))
+        cls.__rpc__.update({
+            'ingest_fedex_tracking_events': RPC(readonly=False),
+        })
+
+    @staticmethod
+    def get_event_key(tracking_number, code, timestamp):
+        """
+        Returns the key identifying an event, the same event pushed twice
+        gets the same key
+        """
+        return fedex_fingerprint(
+            (tracking_number, code, timestamp.isoformat())
+        )
+
+    @classmethod
+    def ingest_fedex_tracking_events(cls, events):
+        """
+        Stores a batch of tracking events and updates the status of their
+        packages and shipments. Events are inserted with a single query per
+        thousand events, never one by one.
+
+        :param events: list of dictionaries with the tracking_number, code,
+            timestamp (datetime or ISO 8601 string) and optionally the
+            description and location of the event
+        :return: the number of new events
+        """
+        pool = Pool()
+        Tracking = pool.get('fedex.package.tracking')
+        ModelAccess = pool.get('ir.model.access')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        table = cls.__table__()
+
+        ModelAccess.check(cls.__name__, 'create')
+        metrics.increment('tracking.events.received', len(events))
+
+        rows = {}
+        for event in events:
+            tracking_number = str(event['tracking_number'])
+            timestamp = event['timestamp']
+            if isinstance(timestamp, basestring):
+                timestamp = parse_datetime(timestamp)
+            timestamp = to_utc(timestamp)
+            key = cls.get_event_key(tracking_number, event['code'], timestamp)
+            rows[key] = (
+                tracking_number, event['code'], event.get('description'),
+                event.get('location'), timestamp,
+            )
+
+        # Events already received
+        keys = rows.keys()
+        for i in xrange(0, len(keys), cursor.IN_MAX):
+            cursor.execute(*table.select(
+                table.key, where=table.key.in_(keys[i:i + cursor.IN_MAX])
+            ))
+            for key, in cursor.fetchall():
+                rows.pop(key, None)
+        if not rows:
+            return 0
+
+        tracking_numbers = list(set(row[0] for row in rows.itervalues()))
+        resolved = Tracking.resolve_tracking_numbers(tracking_numbers)
+
+        values = []
+        for key, row in rows.iteritems():
+            tracking_number, code, description, location, timestamp = row
+            found = resolved.get(tracking_number, {})
+            values.append([
+                key, tracking_number, found.get('shipment'),
+                found.get('package'), code, description, location,
+                timestamp, transaction.user, CurrentTimestamp(),
+            ])
+        columns = [
+            table.key, table.tracking_number, table.shipment, table.package,
+            table.code, table.description, table.location, table.timestamp,
+            table.create_uid, table.create_date,
+        ]
+        for i in xrange(0, len(values), 1000):
+            cursor.execute(*table.insert(columns, values[i:i + 1000]))
+        metrics.increment('tracking.events.ingested', len(values))
+        metrics.increment(
+            'tracking.events.unmatched',
+            len([n for n in tracking_numbers if n not in resolved])
+        )
+
+        Tracking.update_from_fedex_events(tracking_numbers)
+        return len(values)
+
+    @classmethod
+    def ingest_fedex_tracking_files(cls):
+        """
+        Cron ingesting the files dropped in the tracking_drop_path directory
+        of the fedex section of the configuration. Each file holds a JSON
+        list of events and is moved to the done sub-directory once its
+        events are committed, or to the failed sub-directory if it could
+        not be read or ingested, so that the next files are still ingested.
+        """
+        directory = config.get('fedex', 'tracking_drop_path')
+        if not directory or not os.path.isdir(directory):
+            return
+        done = os.path.join(directory, 'done')
+        failed = os.path.join(directory, 'failed')
+        for sub_directory in (done, failed):
+            if not os.path.isdir(sub_directory):
+                os.makedirs(sub_directory)
+
+        cursor = Transaction().cursor
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not name.endswith('.json') or not os.path.isfile(path):
+                continue
+            try:
+                with open(path) as events_file:
+                    events = json.load(events_file)
+                cls.ingest_fedex_tracking_events(events)
+            except Exception:
+                cursor.rollback()
+                metrics.increment('tracking.files.failed')
+                logger.exception(
+                    'FedEx tracking file %s could not be ingested', path
+                )
+                os.rename(path, os.path.join(failed, name))
+                continue
+            # One transaction per file, as ingesting it again is harmless
+            cursor.commit()
+            os.rename(path, os.path.join(done, name))
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+    transport.py
+
+    Sends requests to FedEx with the accounts of a carrier. A transport
+    holds no record and never uses the ORM, so it can be used from worker
+    threads, which have no transaction, to send requests concurrently.
+
+    Requests sent in the background go through a pool of threads shared by
+    the whole process, so that a worker keeps many requests in flight
+    while it goes on with its work.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+import socket
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+from trytond.config import config
+
+import metrics
+from fedexlib import fedex
+from balancer import balancer
+
+__all__ = [
+    'FedexTransport', 'FedexThrottled', 'FedexFuture', 'gather_futures',
+    'get_error_codes',
+]
+
+# Requests in flight at the same time in a process, unless max_in_flight
+# is set in the fedex section of the configuration
+DEFAULT_MAX_IN_FLIGHT = 100
+
+_pool = None
+_pool_pid = None
+_pool_lock = Lock()
+
+
+def get_pool():
+    """
+    Returns the pool of threads sending the requests of the process. It is
+    created again in a forked process, which does not inherit the threads.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(int(
+                config.get('fedex', 'max_in_flight') or DEFAULT_MAX_IN_FLIGHT
+            ))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def get_error_codes(request):
+    """
+    Returns the codes of the error notifications of the reply to a request
+    which failed, none if FedEx did not reply (eg: SOAP faults)
+    """
+    response = getattr(request, 'response', None)
+    return [
+        str(notification.Code)
+        for notification in getattr(response, 'Notifications', None) or []
+        if notification.Severity in ('ERROR', 'FAILURE')
+    ]
+
+
+class FedexThrottled(Exception):
+    """
+    Raised when no account could take a request within the allowed wait
+    """
+
+
+class FedexFuture(object):
+    """
+    The response of a request sent in the background.
+
+    :param async_result: result of the pool of threads, None when the value
+        is already known (eg: from a cache)
+    :param callback: function called with the response by the thread asking
+        for the result, so it may use the ORM. Its return value is the
+        result of the future.
+    :param errbacks: functions called with the exception raised by the
+        request before it is raised again, eg: to raise a user error
+    """
+
+    def __init__(
+        self, async_result=None, callback=None, errbacks=None, value=None
+    ):
+        self._async_result = async_result
+        self._callback = callback
+        self._errbacks = errbacks or []
+        self._value = value
+
+    def ready(self):
+        return self._async_result is None or self._async_result.ready()
+
+    def result(self, timeout=None):
+        """
+        Waits for the response and returns the result of the future
+        """
+        if self._async_result is not None:
+            try:
+                response = self._async_result.get(timeout)
+            except Exception, exc:
+                for errback in self._errbacks:
+                    errback(exc)
+                raise
+            value = response
+            if self._callback is not None:
+                value = self._callback(response)
+            self._value, self._async_result = value, None
+        return self._value
+
+
+class GatheredResult(object):
+    """
+    The results of several futures, standing for the result of the pool
+    of threads in a FedexFuture. When a future fails the others are still
+    waited for, the results they returned are passed to discard (eg: to
+    remove the files they hold) and the first error is raised.
+    """
+
+    def __init__(self, futures, discard=None):
+        self.futures = futures
+        self.discard = discard
+
+    def ready(self):
+        return all(future.ready() for future in self.futures)
+
+    def get(self, timeout=None):
+        results, error = [], None
+        for future in self.futures:
+            try:
+                results.append(future.result(timeout))
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            if self.discard is not None:
+                self.discard(results)
+            raise error[0], error[1], error[2]
+        return results
+
+
+def gather_futures(futures, callback=None, discard=None):
+    """
+    Returns a FedexFuture whose result is the list of the results of the
+    futures, passed to callback if given (see GatheredResult for discard)
+    """
+    return FedexFuture(GatheredResult(futures, discard), callback)
+
+
+class FedexTransport(object):
+    """
+    Sends FedEx requests with a list of accounts.
+
+    :param accounts: list of (key, weight, max_concurrency, credentials,
+        limiter) where limiter is a TokenBucket or None
+    :param max_wait: seconds to wait for an account before giving up
+    :param is_account_error: function telling from the codes of the error
+        notifications of a failed request (see get_error_codes) if it is
+        caused by the account, in which case the request is sent with
+        another one
+    """
+
+    def __init__(self, accounts, max_wait=0, is_account_error=None):
+        self.accounts = accounts
+        self.max_wait = max_wait or 0
+        self.is_account_error = is_account_error or (lambda error: False)
+
+    def send(self, build_request, transaction_id=None, credentials=None):
+        """
+        Builds the request with the credentials of one of the accounts and
+        sends it to FedEx.
+
+        Accounts are tried in an order given by their weight and health,
+        skipping the ones with max_concurrency requests in flight or whose
+        rate limit is reached. When the request fails because of the
+        account (see is_account_error) or of the network it is sent again
+        with the next account. The accounts that are busy or throttled are
+        waited for max_wait seconds at most, the error of the last failed
+        account is raised once all of them failed or the wait is over.
+
+        :param build_request: function returning the request to send when
+            called with the credentials of the account to use
+        :param credentials: send the request with these credentials only
+        :return: the response of FedEx
+        """
+        accounts = [
+            (key, weight, (max_concurrency, account_credentials, limiter))
+            for key, weight, max_concurrency, account_credentials, limiter
+            in self.accounts
+        ]
+        if credentials is not None:
+            accounts = [
+                (key, 1, account) for key, _, account in accounts
+                if account[1].AccountNumber == credentials.AccountNumber
+                and account[1].MeterNumber == credentials.MeterNumber
+            ] or [(
+                '%s-%s' % (credentials.AccountNumber, credentials.MeterNumber),
+                1, (0, credentials, None)
+            )]
+
+        deadline = time.time() + self.max_wait
+        last_error = None
+        failed = set()
+        while True:
+            for key, (max_concurrency, account_credentials, limiter) in \
+                    balancer.order(accounts):
+                if key in failed:
+                    continue
+                if not balancer.acquire(key, max_concurrency):
+                    continue
+                try:
+                    if limiter is not None and not limiter.acquire():
+                        # Rather use another account than wait for this one
+                        continue
+                    request = build_request(account_credentials)
+                    fedex.keepalive.install(request)
+                    try:
+                        response = request.send_request(transaction_id)
+                    except fedex.RequestError, exc:
+                        if not self.is_account_error(get_error_codes(request)):
+                            raise
+                        last_error = exc
+                    except (socket.error, IOError), exc:
+                        last_error = exc
+                    else:
+                        balancer.record_success(key)
+                        lean_reply = fedex.keepalive.pop_lean_reply()
+                        if lean_reply is not None:
+                            response.lean_reply = lean_reply
+                        return response
+                    failed.add(key)
+                    balancer.record_failure(key)
+                    metrics.increment('account.failover')
+                finally:
+                    balancer.release(key)
+
+            # The accounts that were only busy or throttled are waited for
+            if len(failed) == len(accounts):
+                raise last_error
+            if time.time() >= deadline:
+                if last_error is not None:
+                    raise last_error
+                metrics.increment('ratelimit.rejected')
+                raise FedexThrottled(', '.join(
+                    account_credentials.AccountNumber
+                    for _, _, (_, account_credentials, _) in accounts
+                ))
+            metrics.increment('ratelimit.queued')
+            time.sleep(0.05)
+
+    def submit(
+        self, build_request, transaction_id=None, credentials=None,
+        callback=None, errbacks=None
+    ):
+        """
+        Sends the request in the background, see send. build_request is
+        called from a thread of the pool and must not use the ORM.
+
+        :return: a FedexFuture
+        """
+        return FedexFuture(
+            get_pool().apply_async(
+                self.send, (build_request, transaction_id, credentials)
+            ),
+            callback, errbacks
+        )
+
+    def map(self, function, items):
+        """
+        Calls function on each item from the pool of threads. The function
+        must not use the ORM.
+
+        :return: list of (result, exc_info) in the order of the items, with
+            exc_info None when the call succeeded
+        """
+        def call(item):
+            try:
+                return function(item), None
+            except Exception:
+                return None, sys.exc_info()
+
+        items = list(items)
+        if len(items) <= 1:
+            return map(call, items)
+        return get_pool().map(call, items)